@@ -0,0 +1,266 @@
+import hashlib
+import os
+import struct
+import tarfile
+import time
+import zlib
+import config
+from Staging import Staging
+
+
+_ZIP_LOCAL = b"PK\x03\x04"
+_ZIP_END = (b"PK\x01\x02", b"PK\x05\x06", b"PK\x06\x06")
+_ZIP_DESCRIPTOR = b"PK\x07\x08"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class _Peekable:
+    """
+    Read-only stream wrapper that can look ahead and push data back.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.buf = b""
+
+    def peek(self, n):
+        while len(self.buf) < n:
+            chunk = self.stream.read(n - len(self.buf))
+            if not chunk:
+                break
+            self.buf += chunk
+        return self.buf[:n]
+
+    def unread(self, data):
+        self.buf = data + self.buf
+
+    def read(self, n=-1):
+        if n == 0:
+            # werkzeug's LimitedStream treats an empty read as a disconnect
+            return b""
+        if not self.buf:
+            return self.stream.read(n)
+        if n < 0:
+            data, self.buf = self.buf + self.stream.read(), b""
+        elif n > len(self.buf):
+            data, self.buf = self.buf + self.stream.read(n - len(self.buf)), b""
+        else:
+            data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+    def read_exact(self, n):
+        data = self.read(n)
+        while len(data) < n:
+            chunk = self.read(n - len(data))
+            if not chunk:
+                raise ValueError("truncated archive")
+            data += chunk
+        return data
+
+
+class ArchiveUpload:
+    """
+    Stage a whole batch sent as one tar (plain, gzip, bzip2, xz or, with the
+    zstandard package, zstd compressed) or zip stream. Entries are extracted
+    into UPLOAD_DIR one by one while the body arrives, keeping their
+    relative paths and mtimes; nothing is buffered beyond
+    UPLOAD_BUFFER_SIZE. The format is sniffed from the data, the content
+    type only selects this mode.
+    """
+
+    MIMETYPES = {
+        "application/x-tar", "application/tar", "application/x-gtar",
+        "application/gzip", "application/x-gzip", "application/x-compressed-tar",
+        "application/x-bzip2", "application/x-xz",
+        "application/zstd", "application/x-zstd",
+        "application/zip", "application/x-zip-compressed",
+    }
+
+    @staticmethod
+    def accepts(mimetype):
+        return mimetype in ArchiveUpload.MIMETYPES
+
+    @staticmethod
+    def _bufsize():
+        return max(int(config.UPLOAD_BUFFER_SIZE), 64 * 1024)
+
+    @staticmethod
+    def receive(stream, prefix=""):
+        """
+        Extract the archive on `stream` into UPLOAD_DIR (below `prefix` if
+        given). Regular files only; links, devices and entries escaping
+        UPLOAD_DIR are skipped.
+
+        Returns a list of {"name", "size", "sha256"} dicts for stored files.
+        Raises ValueError on a malformed or unsupported archive and OSError
+        on write failures. Files completed before an error are left in the
+        current batch; the caller discards it.
+        """
+        started = time.monotonic()
+        stored = []
+        src = _Peekable(stream)
+        try:
+            magic = src.peek(4)
+            if magic == _ZSTD_MAGIC:
+                src = _Peekable(ArchiveUpload._zstd(src))
+                magic = src.peek(4)
+            if magic == _ZIP_LOCAL:
+                ArchiveUpload._zip(src, prefix, stored)
+            else:
+                ArchiveUpload._tar(src, prefix, stored)
+        finally:
+            Staging.account("archive", sum(f["size"] for f in stored),
+                            time.monotonic() - started, len(stored))
+        return stored
+
+    @staticmethod
+    def _zstd(src):
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd compressed archives need the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(src, read_size=ArchiveUpload._bufsize())
+
+    @staticmethod
+    def _store(name, chunks, mtime, prefix, stored):
+        """
+        Write the data yielded by `chunks` to UPLOAD_DIR/prefix/name. The
+        iterator is drained even if the name is rejected, and may raise to
+        abort the entry before it is placed.
+        """
+        relpath = Staging.safe_relpath(f"{prefix}/{name}" if prefix else name)
+        if relpath is None:
+            for _ in chunks:
+                pass
+            return
+        tmp_path = Staging.tmp_file()
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as out:
+                for chunk in chunks:
+                    out.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            if mtime:
+                os.utime(tmp_path, (mtime, mtime))
+            Staging.place(tmp_path, relpath, digest.hexdigest())
+            tmp_path = None
+        finally:
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except Exception:
+                    pass
+        stored.append({"name": relpath, "size": size, "sha256": digest.hexdigest()})
+
+    # ------------------------------------------------------------------
+    # tar
+
+    @staticmethod
+    def _tar(src, prefix, stored):
+        bufsize = ArchiveUpload._bufsize()
+        try:
+            # "r|*": sequential, transparently decompressed
+            with tarfile.open(fileobj=src, mode="r|*", bufsize=bufsize) as tar:
+                for member in tar:
+                    if not member.isreg():
+                        continue
+                    f = tar.extractfile(member)
+                    ArchiveUpload._store(member.name, iter(lambda: f.read(bufsize), b""),
+                                         member.mtime, prefix, stored)
+        except (tarfile.TarError, EOFError, zlib.error) as e:
+            raise ValueError(f"bad tar archive: {e}")
+
+    # ------------------------------------------------------------------
+    # zip
+
+    @staticmethod
+    def _zip(src, prefix, stored):
+        """
+        Walk the local file headers; the central directory at the end isn't
+        needed. Deflated entries find their own end, so data descriptors
+        (sizes after the data) are fine for them; stored entries need their
+        size in the local header.
+        """
+        while True:
+            sig = src.read_exact(4)
+            if sig in _ZIP_END:
+                return
+            if sig != _ZIP_LOCAL:
+                raise ValueError("bad zip archive: unexpected record")
+            flags, method, dostime, dosdate, crc, csize, usize, nlen, xlen = struct.unpack(
+                "<2xHHHHIIIHH", src.read_exact(26))
+            name = src.read_exact(nlen).decode("utf-8" if flags & 0x800 else "cp437", "replace")
+            extra = src.read_exact(xlen)
+            if flags & 0x01:
+                raise ValueError(f"encrypted zip entry {name}")
+            zip64 = False
+            pos = 0
+            while pos + 4 <= len(extra):
+                tag, length = struct.unpack_from("<HH", extra, pos)
+                if tag == 0x0001:
+                    # zip64: the 64-bit sizes of the fields set to 0xFFFFFFFF, in order
+                    zip64 = True
+                    values = extra[pos + 4:pos + 4 + length]
+                    if usize == 0xFFFFFFFF and len(values) >= 8:
+                        usize, values = struct.unpack_from("<Q", values)[0], values[8:]
+                    if csize == 0xFFFFFFFF and len(values) >= 8:
+                        csize = struct.unpack_from("<Q", values)[0]
+                pos += 4 + length
+            if method == 0 and flags & 0x08 and not csize:
+                # sizes only in the data descriptor: fine if it follows right
+                # away (directories, empty files), else the end is unknowable
+                empty = _ZIP_DESCRIPTOR + bytes(20 if zip64 else 12)
+                if not name.endswith("/") and src.peek(len(empty)) != empty:
+                    raise ValueError(f"zip entry {name} can't be streamed (stored, size unknown)")
+            elif method not in (0, 8):
+                raise ValueError(f"zip entry {name} can't be streamed (method {method})")
+            chunks = ArchiveUpload._zip_data(src, method, csize, crc, flags & 0x08, zip64)
+            if name.endswith("/"):
+                for _ in chunks:
+                    pass
+                continue
+            year, month, day = 1980 + (dosdate >> 9), (dosdate >> 5) & 0x0F, dosdate & 0x1F
+            hour, minute, second = dostime >> 11, (dostime >> 5) & 0x3F, (dostime & 0x1F) * 2
+            try:
+                mtime = time.mktime((year, month, day, hour, minute, second, 0, 0, -1))
+            except (OverflowError, ValueError):
+                mtime = None
+            ArchiveUpload._store(name, chunks, mtime, prefix, stored)
+
+    @staticmethod
+    def _zip_data(src, method, csize, crc, descriptor, zip64):
+        bufsize = ArchiveUpload._bufsize()
+        actual = 0
+        if method == 8:
+            d = zlib.decompressobj(-15)
+            try:
+                while not d.eof:
+                    chunk = d.unconsumed_tail or src.read(bufsize)
+                    if not chunk:
+                        raise ValueError("truncated zip archive")
+                    data = d.decompress(chunk, bufsize)
+                    if data:
+                        actual = zlib.crc32(data, actual)
+                        yield data
+            except zlib.error as e:
+                raise ValueError(f"bad zip archive: {e}")
+            src.unread(d.unused_data)
+        else:
+            remaining = csize
+            while remaining:
+                data = src.read(min(bufsize, remaining))
+                if not data:
+                    raise ValueError("truncated zip archive")
+                remaining -= len(data)
+                actual = zlib.crc32(data, actual)
+                yield data
+        if descriptor:
+            head = src.read_exact(4)
+            if head == _ZIP_DESCRIPTOR:
+                head = src.read_exact(4)
+            crc = struct.unpack("<I", head)[0]
+            src.read_exact(16 if zip64 else 8)
+        if actual != crc:
+            raise ValueError("zip entry CRC mismatch")
@@ -0,0 +1,57 @@
+import os
+import threading
+import config
+
+
+class CommitJournal:
+    """
+    Append-only list of staged files (relative to UPLOAD_DIR) that changed
+    since the last commit. Each upload appends a line; a commit takes a
+    snapshot and, once the files are in the image, drops exactly the lines
+    it saw so records appended meanwhile survive.
+    """
+
+    _lock = threading.Lock()
+
+    @staticmethod
+    def record(relpath):
+        line = relpath.replace(os.sep, "/") + "\n"
+        with CommitJournal._lock:
+            with open(config.COMMIT_JOURNAL, "a", encoding="utf-8") as f:
+                f.write(line)
+
+    @staticmethod
+    def snapshot():
+        """
+        Returns (unique relpaths in first-seen order, journal size) or
+        (None, 0) if there is no journal yet.
+        """
+        with CommitJournal._lock:
+            try:
+                with open(config.COMMIT_JOURNAL, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return None, 0
+        # only complete lines count; a torn last line is left for next time
+        end = data.rfind(b"\n") + 1
+        seen = {}
+        for line in data[:end].decode("utf-8", "replace").splitlines():
+            if line:
+                seen.setdefault(line, None)
+        return list(seen), end
+
+    @staticmethod
+    def consume(upto):
+        """
+        Drop the first `upto` bytes (as returned by snapshot()).
+        """
+        with CommitJournal._lock:
+            try:
+                with open(config.COMMIT_JOURNAL, "rb") as f:
+                    rest = f.read()[upto:]
+            except FileNotFoundError:
+                rest = b""
+            tmp = config.COMMIT_JOURNAL + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(rest)
+            os.replace(tmp, config.COMMIT_JOURNAL)
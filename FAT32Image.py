@@ -0,0 +1,940 @@
+import errno
+import os
+import stat
+import struct
+import sys
+import time
+from array import array
+from FastCopy import FastCopy
+
+
+ATTR_READ_ONLY = 0x01
+ATTR_HIDDEN = 0x02
+ATTR_SYSTEM = 0x04
+ATTR_VOLUME_ID = 0x08
+ATTR_DIRECTORY = 0x10
+ATTR_ARCHIVE = 0x20
+ATTR_LFN = 0x0F
+
+END_OF_CHAIN = 0x0FFFFFFF
+BAD_CLUSTER = 0x0FFFFFF7
+ENTRY_SIZE = 32
+
+# characters allowed in an 8.3 short name besides A-Z and 0-9
+_SHORT_EXTRA = set("!#$%&'()-@^_`{}~")
+
+
+def _fat_datetime(ts):
+    t = time.localtime(ts)
+    year = min(max(t.tm_year, 1980), 2107)
+    fdate = ((year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+    ftime = (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2)
+    return fdate, ftime
+
+
+def _from_fat_datetime(fdate, ftime):
+    try:
+        return time.mktime((
+            ((fdate >> 9) & 0x7F) + 1980, (fdate >> 5) & 0x0F, fdate & 0x1F,
+            (ftime >> 11) & 0x1F, (ftime >> 5) & 0x3F, (ftime & 0x1F) * 2,
+            0, 0, -1,
+        ))
+    except (OverflowError, ValueError):
+        return 0
+
+
+def _lfn_checksum(short):
+    s = 0
+    for b in short:
+        s = (((s & 1) << 7) + (s >> 1) + b) & 0xFF
+    return s
+
+
+class NotFAT32Error(ValueError):
+    """
+    The image has no FAT32 filesystem this reader understands. Raised only
+    while opening, before anything was written.
+    """
+
+
+class FATEntry:
+    """
+    A parsed directory entry. `slots` lists the (dir cluster, index) of the
+    short entry and of all its LFN entries, so the entry can be rewritten
+    or deleted in place.
+    """
+
+    __slots__ = ("name", "short", "attr", "cluster", "size", "mtime", "slots")
+
+    def __init__(self, name, short, attr, cluster, size, mtime, slots):
+        self.name = name
+        self.short = short
+        self.attr = attr
+        self.cluster = cluster
+        self.size = size
+        self.mtime = mtime
+        self.slots = slots
+
+    @property
+    def is_dir(self):
+        return bool(self.attr & ATTR_DIRECTORY)
+
+
+class _Dir:
+    """
+    Cached view of one directory: its cluster chain, live entries by
+    lower-cased name, used short names and the first never-used slot.
+    """
+
+    __slots__ = ("cluster", "chain", "entries", "shorts", "end", "label")
+
+    def __init__(self, cluster, chain):
+        self.cluster = cluster
+        self.chain = chain
+        self.entries = {}
+        self.shorts = set()
+        self.end = 0
+        self.label = None
+
+
+class FAT32Image:
+    """
+    Minimal FAT32 reader/writer operating directly on a disk image, so files
+    can be published without losetup/mount. Understands both an MBR
+    partitioned image (as laid down by USBStorage.image_create()) and a bare
+    "superfloppy" filesystem. The FAT is held in memory and written back to
+    every FAT copy on flush()/close().
+    """
+
+    def __init__(self, path, writable=True):
+        self.path = path
+        self.writable = writable
+        # unbuffered, so file data copied in-kernel through the raw fd
+        # (FastCopy.copy_range) can never be shadowed by a stale read buffer
+        self.f = open(path, "r+b" if writable else "rb", buffering=0)
+        try:
+            self._load()
+        except Exception:
+            self.f.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ------------------------------------------------------------------
+    # geometry
+
+    @staticmethod
+    def partition_offset(f):
+        """
+        Returns the byte offset of the FAT filesystem inside the image: 0 for
+        a superfloppy, otherwise the start of the first MBR partition.
+        """
+        f.seek(0)
+        sector = f.read(512)
+        if len(sector) < 512 or sector[510:512] != b"\x55\xaa":
+            raise NotFAT32Error("no boot sector or MBR signature")
+        if sector[0] in (0xEB, 0xE9) and sector[82:87] == b"FAT32":
+            return 0
+        for i in range(4):
+            entry = sector[446 + 16 * i: 446 + 16 * (i + 1)]
+            ptype = entry[4]
+            lba = struct.unpack_from("<I", entry, 8)[0]
+            if ptype != 0 and lba:
+                return lba * 512
+        raise NotFAT32Error("no partition found in MBR")
+
+    def _load(self):
+        self.base = FAT32Image.partition_offset(self.f)
+        self.f.seek(self.base)
+        bs = self.f.read(512)
+        (self.bytes_per_sector, self.sectors_per_cluster, self.reserved_sectors,
+         self.num_fats, root_entries, total16, _media, fat16) = struct.unpack_from(
+            "<HBHBHHBH", bs, 11)
+        total32, fat32, self.ext_flags = struct.unpack_from("<IIH", bs, 32)[0:3]
+        self.root_cluster, self.fsinfo_sector, self.backup_sector = struct.unpack_from(
+            "<IHH", bs, 44)
+        if fat16 != 0 or root_entries != 0 or fat32 == 0:
+            raise NotFAT32Error("not a FAT32 filesystem")
+        if self.bytes_per_sector not in (512, 1024, 2048, 4096) or not self.sectors_per_cluster:
+            raise NotFAT32Error("invalid FAT32 boot sector")
+
+        self.total_sectors = total32 or total16
+        self.fat_sectors = fat32
+        self.cluster_size = self.bytes_per_sector * self.sectors_per_cluster
+        self.fat_offset = self.base + self.reserved_sectors * self.bytes_per_sector
+        data_sector = self.reserved_sectors + self.num_fats * self.fat_sectors
+        self.data_offset = self.base + data_sector * self.bytes_per_sector
+        self.cluster_count = (self.total_sectors - data_sector) // self.sectors_per_cluster
+
+        # ext_flags bit 7 set means only the FAT in bits 0-3 is active
+        self.active_fat = self.ext_flags & 0x0F if self.ext_flags & 0x80 else 0
+        entries = min(self.cluster_count + 2, self.fat_sectors * self.bytes_per_sector // 4)
+        self.f.seek(self.fat_offset + self.active_fat * self.fat_sectors * self.bytes_per_sector)
+        self.fat = array("I")
+        self.fat.frombytes(self.f.read(entries * 4))
+        if sys.byteorder != "little":
+            self.fat.byteswap()
+        self._fat_dirty = None
+
+        self.free_count = None
+        self.next_free = 2
+        if self.fsinfo_sector:
+            self.f.seek(self.base + self.fsinfo_sector * self.bytes_per_sector)
+            fsinfo = self.f.read(512)
+            if (struct.unpack_from("<I", fsinfo, 0)[0] == 0x41615252
+                    and struct.unpack_from("<I", fsinfo, 484)[0] == 0x61417272):
+                # the free count hint is often stale after a host wrote to the
+                # image, so it is recomputed from the FAT when first needed
+                nxt = struct.unpack_from("<I", fsinfo, 492)[0]
+                if 2 <= nxt < self.cluster_count + 2:
+                    self.next_free = nxt
+        self.per_cluster = self.cluster_size // ENTRY_SIZE
+        self._dirs = {}
+
+    @staticmethod
+    def format(path, size, label="NO NAME", partitioned=True):
+        """
+        Create a sparse image of `size` bytes at `path` holding an MBR with
+        one FAT32 (LBA) partition starting at 1 MiB, the same layout
+        USBStorage.image_create() gets from parted + mkfs.vfat. Only the
+        boot sectors, FSInfo, the first FAT sectors and the root directory
+        are written, so this takes the same time for any image size.
+        Raises ValueError if the size is too small for FAT32.
+        """
+        bps = 512
+        part_lba = 2048 if partitioned else 0
+        sectors = size // bps - part_lba
+        if sectors <= 0:
+            raise ValueError("image too small")
+
+        # cluster size by volume size, as recommended by Microsoft
+        for limit, spc in ((532480, 1), (16777216, 8), (33554432, 16), (67108864, 32)):
+            if sectors <= limit:
+                break
+        else:
+            spc = 64
+        num_fats = 2
+        reserved = 32
+        fat_sectors = -(-(sectors - reserved) // ((256 * spc + num_fats) // 2))
+        # start the data region on a cluster boundary (good for SD erase blocks)
+        reserved += (-(part_lba + reserved + num_fats * fat_sectors)) % spc
+        clusters = (sectors - reserved - num_fats * fat_sectors) // spc
+        if clusters < 65525:
+            raise ValueError(f"{size} bytes is too small for FAT32")
+
+        serial = int(time.time() * 1000) & 0xFFFFFFFF
+        raw_label = label.upper().encode("ascii", "replace")[:11].ljust(11)
+
+        bs = bytearray(bps)
+        bs[0:3] = b"\xeb\x58\x90"
+        bs[3:11] = b"MSWIN4.1"
+        struct.pack_into("<HBHBHHBHHHII", bs, 11, bps, spc, reserved, num_fats,
+                         0, 0, 0xF8, 0, 63, 255, part_lba, sectors)
+        struct.pack_into("<IHHIHH", bs, 36, fat_sectors, 0, 0, 2, 1, 6)
+        struct.pack_into("<BBBI", bs, 64, 0x80, 0, 0x29, serial)
+        bs[71:82] = raw_label
+        bs[82:90] = b"FAT32   "
+        bs[510:512] = b"\x55\xaa"
+
+        fsinfo = bytearray(bps)
+        struct.pack_into("<I", fsinfo, 0, 0x41615252)
+        struct.pack_into("<III", fsinfo, 484, 0x61417272, clusters - 1, 3)
+        struct.pack_into("<I", fsinfo, 508, 0xAA550000)
+
+        fat = struct.pack("<III", 0x0FFFFFF8, 0x0FFFFFFF, END_OF_CHAIN)
+        fdate, ftime = _fat_datetime(time.time())
+        vol = bytearray(ENTRY_SIZE)
+        vol[0:11] = raw_label
+        vol[11] = ATTR_VOLUME_ID | ATTR_ARCHIVE
+        struct.pack_into("<HH", vol, 22, ftime, fdate)
+
+        base = part_lba * bps
+        with open(path, "wb") as f:
+            f.truncate(size)
+            if partitioned:
+                mbr = bytearray(bps)
+                struct.pack_into("<I", mbr, 440, serial)
+                # LBA-only entry: CHS fields set to the "beyond 8 GB" marker
+                struct.pack_into("<B3sB3sII", mbr, 446, 0x00, b"\xfe\xff\xff", 0x0C,
+                                 b"\xfe\xff\xff", part_lba, sectors)
+                mbr[510:512] = b"\x55\xaa"
+                f.write(mbr)
+            for sector, data in ((0, bs), (1, fsinfo), (6, bs), (7, fsinfo)):
+                f.seek(base + sector * bps)
+                f.write(data)
+            for n in range(num_fats):
+                f.seek(base + (reserved + n * fat_sectors) * bps)
+                f.write(fat)
+            f.seek(base + (reserved + num_fats * fat_sectors) * bps)
+            f.write(vol)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def cluster_offset(self, cluster):
+        return self.data_offset + (cluster - 2) * self.cluster_size
+
+    # ------------------------------------------------------------------
+    # FAT
+
+    def _get(self, cluster):
+        return self.fat[cluster] & 0x0FFFFFFF
+
+    def _set(self, cluster, value):
+        self.fat[cluster] = (self.fat[cluster] & 0xF0000000) | (value & 0x0FFFFFFF)
+        if self._fat_dirty is None:
+            self._fat_dirty = [cluster, cluster]
+        else:
+            lo, hi = self._fat_dirty
+            self._fat_dirty = [min(lo, cluster), max(hi, cluster)]
+
+    def chain(self, cluster):
+        out = []
+        limit = self.cluster_count + 2
+        while 2 <= cluster < limit and len(out) < limit:
+            out.append(cluster)
+            cluster = self._get(cluster)
+        return out
+
+    def free_clusters(self):
+        if self.free_count is None:
+            # entry 0 and 1 are reserved and never zero
+            self.free_count = self.fat[2:self.cluster_count + 2].count(0)
+        return self.free_count
+
+    def free_bytes(self):
+        return self.free_clusters() * self.cluster_size
+
+    def _find_free(self, start):
+        limit = self.cluster_count + 2
+        for lo, hi in ((start, limit), (2, start)):
+            try:
+                return self.fat.index(0, lo, hi)
+            except ValueError:
+                continue
+            except TypeError:
+                # array.index() without start/stop (Python < 3.10)
+                for c in range(lo, hi):
+                    if self.fat[c] == 0:
+                        return c
+        return None
+
+    def allocate(self, count, after=None):
+        """
+        Allocate `count` clusters as one chain (appended to `after` if
+        given) and return the list. Prefers contiguous runs.
+        """
+        if count <= 0:
+            return []
+        if self.free_clusters() < count:
+            raise OSError(errno.ENOSPC, "No space left on FAT32 image")
+        out = []
+        c = self.next_free
+        limit = self.cluster_count + 2
+        while len(out) < count:
+            if not (2 <= c < limit) or self.fat[c] & 0x0FFFFFFF:
+                c = self._find_free(c if 2 <= c < limit else 2)
+                if c is None:
+                    raise OSError(errno.ENOSPC, "No space left on FAT32 image")
+            out.append(c)
+            c += 1
+        prev = after
+        for c in out:
+            if prev is not None:
+                self._set(prev, c)
+            prev = c
+        self._set(out[-1], END_OF_CHAIN)
+        self.free_count -= count
+        self.next_free = out[-1] + 1 if out[-1] + 1 < limit else 2
+        return out
+
+    def release(self, cluster):
+        chain = self.chain(cluster)
+        for c in chain:
+            self._set(c, 0)
+        if self.free_count is not None:
+            self.free_count += len(chain)
+        return len(chain)
+
+    def runs(self, clusters):
+        """
+        Group a cluster list into (first cluster, count) runs of
+        consecutive clusters.
+        """
+        out = []
+        for c in clusters:
+            if out and out[-1][0] + out[-1][1] == c:
+                out[-1][1] += 1
+            else:
+                out.append([c, 1])
+        return [tuple(r) for r in out]
+
+    # ------------------------------------------------------------------
+    # directories
+
+    def _read_dir(self, cluster):
+        d = self._dirs.get(cluster)
+        if d is not None:
+            return d
+        chain = self.chain(cluster)
+        d = _Dir(cluster, chain)
+        lfn = []
+        lfn_slots = []
+        lfn_sum = None
+        index = 0
+        done = False
+        for c in chain:
+            self.f.seek(self.cluster_offset(c))
+            data = self.f.read(self.cluster_size)
+            for i in range(self.per_cluster):
+                raw = data[i * ENTRY_SIZE:(i + 1) * ENTRY_SIZE]
+                first = raw[0]
+                if first == 0x00:
+                    done = True
+                    break
+                index += 1
+                if first == 0xE5:
+                    lfn, lfn_slots = [], []
+                    continue
+                attr = raw[11]
+                if attr & 0x3F == ATTR_LFN:
+                    if first & 0x40:
+                        lfn, lfn_slots = [], []
+                        lfn_sum = raw[13]
+                    chars = raw[1:11] + raw[14:26] + raw[28:32]
+                    lfn.insert(0, chars)
+                    lfn_slots.append((c, i))
+                    continue
+                short = bytes(raw[0:11])
+                if short[0] == 0x05:
+                    short = b"\xe5" + short[1:]
+                if attr & ATTR_VOLUME_ID:
+                    d.label = (c, i, raw[0:11].decode("latin-1").rstrip())
+                    lfn, lfn_slots = [], []
+                    continue
+                if short in (b".          ", b"..         "):
+                    lfn, lfn_slots = [], []
+                    continue
+                name = None
+                if lfn and lfn_sum == _lfn_checksum(short):
+                    name = b"".join(lfn).decode("utf-16-le", "replace")
+                    end = name.find("\x00")
+                    if end >= 0:
+                        name = name[:end]
+                if not name:
+                    name = self._short_display(short, raw[12])
+                hi, = struct.unpack_from("<H", raw, 20)
+                wtime, wdate, lo, size = struct.unpack_from("<HHHI", raw, 22)
+                entry = FATEntry(name, short, attr, (hi << 16) | lo, size,
+                                 _from_fat_datetime(wdate, wtime), lfn_slots + [(c, i)])
+                d.entries[name.lower()] = entry
+                d.shorts.add(short)
+                lfn, lfn_slots = [], []
+            if done:
+                break
+        d.end = index
+        self._dirs[cluster] = d
+        return d
+
+    @staticmethod
+    def _short_display(short, case_flags):
+        base = short[:8].decode("latin-1").rstrip()
+        ext = short[8:].decode("latin-1").rstrip()
+        if case_flags & 0x08:
+            base = base.lower()
+        if case_flags & 0x10:
+            ext = ext.lower()
+        return base + ("." + ext if ext else "")
+
+    def _lookup_dir(self, relpath, create=False):
+        """
+        Returns the _Dir for the directory `relpath` ("" for root), creating
+        missing components when `create` is set. Returns None if missing.
+        """
+        d = self._read_dir(self.root_cluster)
+        for part in self._split(relpath):
+            entry = d.entries.get(part.lower())
+            if entry is None:
+                if not create:
+                    return None
+                entry = self._mkdir_in(d, part)
+            elif not entry.is_dir:
+                raise NotADirectoryError(relpath)
+            d = self._read_dir(entry.cluster)
+        return d
+
+    @staticmethod
+    def _split(relpath):
+        return [p for p in relpath.replace("\\", "/").split("/") if p not in ("", ".")]
+
+    def _slot_offset(self, d, index):
+        return self.cluster_offset(d.chain[index // self.per_cluster]) + \
+            (index % self.per_cluster) * ENTRY_SIZE
+
+    def _make_short(self, d, name):
+        """
+        Returns (short name bytes, needs_lfn) for a long name.
+        """
+        stripped = name.lstrip(".")
+        if "." in stripped:
+            base, ext = stripped.rsplit(".", 1)
+        else:
+            base, ext = stripped, ""
+        lossy = stripped != name or " " in name
+
+        def conv(s):
+            nonlocal lossy
+            out = []
+            for ch in s.replace(" ", "").upper():
+                if ("A" <= ch <= "Z") or ("0" <= ch <= "9") or ch in _SHORT_EXTRA:
+                    out.append(ch)
+                else:
+                    out.append("_")
+                    lossy = True
+            return "".join(out)
+
+        sbase, sext = conv(base), conv(ext)
+        if len(sbase) > 8 or len(sext) > 3 or not sbase:
+            lossy = True
+        sbase, sext = sbase[:8] or "_", sext[:3]
+
+        # like Linux vfat's shortname=mixed, anything that isn't upper case
+        # gets a long name entry rather than relying on NT case flags
+        if base != base.upper() or ext != ext.upper():
+            lossy = True
+
+        if not lossy:
+            short = (sbase.ljust(8) + sext.ljust(3)).encode("ascii")
+            if short not in d.shorts:
+                return short, False
+
+        def candidate(tail, stem):
+            return ((stem[:8 - len(tail)] + tail).ljust(8) + sext.ljust(3)).encode("ascii")
+
+        for n in range(1, 5):
+            short = candidate(f"~{n}", sbase)
+            if short not in d.shorts:
+                return short, True
+        # like Windows, switch to a hashed stem once the simple tails are used
+        h = 0
+        for ch in name:
+            h = (h * 31 + ord(ch)) & 0xFFFF
+        stem = sbase[:2] + f"{h:04X}"
+        for n in range(1, 1000000):
+            short = candidate(f"~{n}", stem)
+            if short not in d.shorts:
+                return short, True
+        raise OSError(errno.EEXIST, f"no free short name for {name}")
+
+    def _ensure_slots(self, d, count):
+        """
+        Make sure `count` never-used slots exist after d.end, growing the
+        directory chain with zeroed clusters as needed.
+        """
+        needed = d.end + count + 1  # keep a terminating zero entry if possible
+        while len(d.chain) * self.per_cluster < needed:
+            c = self.allocate(1, after=d.chain[-1] if d.chain else None)[0]
+            self._zero_cluster(c)
+            d.chain.append(c)
+
+    def _zero_cluster(self, c):
+        self.f.seek(self.cluster_offset(c))
+        self.f.write(b"\x00" * self.cluster_size)
+
+    def _short_entry(self, short, attr, cluster, size, mtime, case_flags=0):
+        fdate, ftime = _fat_datetime(mtime)
+        raw = bytearray(ENTRY_SIZE)
+        raw[0:11] = short
+        if raw[0] == 0xE5:
+            raw[0] = 0x05
+        raw[11] = attr
+        raw[12] = case_flags
+        struct.pack_into("<BHHHHHHHI", raw, 13, 0, ftime, fdate, fdate,
+                         cluster >> 16, ftime, fdate, cluster & 0xFFFF, size)
+        return raw
+
+    def _add_entry(self, d, name, attr, cluster, size, mtime):
+        short, needs_lfn = self._make_short(d, name)
+        raws = []
+        if needs_lfn:
+            csum = _lfn_checksum(short)
+            encoded = name.encode("utf-16-le")
+            units = [encoded[i:i + 2] for i in range(0, len(encoded), 2)]
+            if len(units) > 255:
+                raise OSError(errno.ENAMETOOLONG, f"file name too long: {name}")
+            if len(units) % 13:
+                units.append(b"\x00\x00")
+            while len(units) % 13:
+                units.append(b"\xff\xff")
+            parts = [b"".join(units[i:i + 13]) for i in range(0, len(units), 13)]
+            for seq in range(len(parts), 0, -1):
+                chars = parts[seq - 1]
+                raw = bytearray(ENTRY_SIZE)
+                raw[0] = seq | (0x40 if seq == len(parts) else 0)
+                raw[1:11] = chars[0:10]
+                raw[11] = ATTR_LFN
+                raw[13] = csum
+                raw[14:26] = chars[10:22]
+                raw[28:32] = chars[22:26]
+                raws.append(raw)
+        raws.append(self._short_entry(short, attr, cluster, size, mtime))
+
+        self._ensure_slots(d, len(raws))
+        slots = []
+        start = d.end
+        for k, raw in enumerate(raws):
+            index = start + k
+            self.f.seek(self._slot_offset(d, index))
+            self.f.write(raw)
+            slots.append((d.chain[index // self.per_cluster], index % self.per_cluster))
+        d.end = start + len(raws)
+        entry = FATEntry(name, short, attr, cluster, size, mtime, slots)
+        d.entries[name.lower()] = entry
+        d.shorts.add(short)
+        return entry
+
+    def _rewrite_short(self, entry, case_flags=None):
+        c, i = entry.slots[-1]
+        off = self.cluster_offset(c) + i * ENTRY_SIZE
+        if case_flags is None:
+            self.f.seek(off + 12)
+            case_flags = self.f.read(1)[0]
+        self.f.seek(off)
+        self.f.write(self._short_entry(entry.short, entry.attr, entry.cluster,
+                                       entry.size, entry.mtime, case_flags))
+
+    def _mkdir_in(self, d, name):
+        c = self.allocate(1)[0]
+        self._zero_cluster(c)
+        now = time.time()
+        parent = 0 if d.cluster == self.root_cluster else d.cluster
+        self.f.seek(self.cluster_offset(c))
+        self.f.write(self._short_entry(b".          ", ATTR_DIRECTORY, c, 0, now))
+        self.f.write(self._short_entry(b"..         ", ATTR_DIRECTORY, parent, 0, now))
+        entry = self._add_entry(d, name, ATTR_DIRECTORY, c, 0, now)
+        sub = _Dir(c, [c])
+        sub.end = 2
+        self._dirs[c] = sub
+        return entry
+
+    def _delete_entry(self, d, entry):
+        for c, i in entry.slots:
+            self.f.seek(self.cluster_offset(c) + i * ENTRY_SIZE)
+            self.f.write(b"\xe5")
+        d.entries.pop(entry.name.lower(), None)
+        d.shorts.discard(entry.short)
+        if not d.entries and d.label is None:
+            self._compact_empty(d)
+
+    def _compact_empty(self, d):
+        """
+        Once a directory holds no live entries, zero it and drop its extra
+        clusters so deleted slots don't accumulate across commits.
+        """
+        keep = d.chain[:1]
+        # subdirectories keep their "." and ".." entries
+        head = b""
+        if d.cluster != self.root_cluster:
+            self.f.seek(self.cluster_offset(keep[0]))
+            head = self.f.read(2 * ENTRY_SIZE)
+        if len(d.chain) > 1:
+            self._set(keep[0], END_OF_CHAIN)
+            self.release(d.chain[1])
+        d.chain = keep
+        self._zero_cluster(keep[0])
+        self.f.seek(self.cluster_offset(keep[0]))
+        self.f.write(head)
+        d.end = len(head) // ENTRY_SIZE
+
+    # ------------------------------------------------------------------
+    # public API
+
+    def stat(self, relpath):
+        """
+        Returns the FATEntry for `relpath`, or None if it doesn't exist.
+        """
+        parts = self._split(relpath)
+        if not parts:
+            return None
+        d = self._lookup_dir("/".join(parts[:-1]))
+        if d is None:
+            return None
+        return d.entries.get(parts[-1].lower())
+
+    def listdir(self, relpath=""):
+        d = self._lookup_dir(relpath)
+        if d is None:
+            raise FileNotFoundError(relpath)
+        return list(d.entries.values())
+
+    def walk(self, relpath=""):
+        """
+        Yields (relative path, FATEntry) for every file and directory below
+        `relpath`, parents before children.
+        """
+        for entry in self.listdir(relpath):
+            path = f"{relpath}/{entry.name}" if relpath else entry.name
+            yield path, entry
+            if entry.is_dir:
+                yield from self.walk(path)
+
+    def extents(self, entry):
+        """
+        Returns the (image byte offset, length) ranges holding a file's data.
+        """
+        out = []
+        remaining = entry.size
+        for first, count in self.runs(self.chain(entry.cluster)):
+            if remaining <= 0:
+                break
+            length = min(count * self.cluster_size, remaining)
+            out.append((self.cluster_offset(first), length))
+            remaining -= length
+        return out
+
+    def touch(self, relpath, mtime):
+        """
+        Set the modification time of an existing entry.
+        """
+        entry = self.stat(relpath)
+        if entry is None:
+            raise FileNotFoundError(relpath)
+        entry.mtime = mtime
+        self._rewrite_short(entry)
+
+    def makedirs(self, relpath):
+        self._lookup_dir(relpath, create=True)
+
+    def write_file(self, relpath, src, size=None, mtime=None, bufsize=4 * 1024 * 1024):
+        """
+        Store the file at `src` (a path or a readable binary file object) as
+        `relpath`, replacing an existing file of the same name. Parent
+        directories are created as needed.
+        """
+        parts = self._split(relpath)
+        if not parts:
+            raise ValueError("empty path")
+        if isinstance(src, (str, bytes, os.PathLike)):
+            st = os.stat(src)
+            with open(src, "rb") as fsrc:
+                return self.write_file(relpath, fsrc, st.st_size,
+                                       st.st_mtime if mtime is None else mtime, bufsize)
+        if size is None:
+            size = os.fstat(src.fileno()).st_size
+        if mtime is None:
+            mtime = time.time()
+
+        d = self._lookup_dir("/".join(parts[:-1]), create=True)
+        entry = d.entries.get(parts[-1].lower())
+        if entry is not None and entry.is_dir:
+            raise IsADirectoryError(relpath)
+
+        # regular files are copied in-kernel; pipes, sockets and in-memory
+        # streams go through read()/write()
+        try:
+            src_fd = src.fileno()
+            if not stat.S_ISREG(os.fstat(src_fd).st_mode):
+                src_fd = None
+        except (AttributeError, OSError, ValueError):
+            src_fd = None
+
+        # the new data goes into fresh clusters and the entry only points
+        # at them once the copy succeeded, so a failed copy leaves the old
+        # file intact; only if both don't fit is the old chain given up
+        # first, and the entry then removed on failure
+        count = -(-size // self.cluster_size)
+        old = entry.cluster if entry is not None else 0
+        replaced = False
+        if old and self.free_clusters() < count:
+            self.release(old)
+            entry.cluster = old = 0
+            replaced = True
+        clusters = []
+        try:
+            clusters = self.allocate(count)
+            remaining = size
+            src_offset = src.tell() if src_fd is not None else 0
+            for run, n in self.runs(clusters):
+                left = min(n * self.cluster_size, remaining)
+                if src_fd is not None:
+                    # one in-kernel copy per contiguous run of clusters
+                    copied = FastCopy.copy_range(src_fd, self.f.fileno(), src_offset,
+                                                 self.cluster_offset(run), left)
+                    if copied != left:
+                        raise OSError(errno.EIO, f"short read while copying {relpath}")
+                    src_offset += left
+                    remaining -= left
+                    continue
+                self.f.seek(self.cluster_offset(run))
+                while left > 0:
+                    chunk = src.read(min(bufsize, left))
+                    if not chunk:
+                        raise OSError(errno.EIO, f"short read while copying {relpath}")
+                    self.f.write(chunk)
+                    left -= len(chunk)
+                    remaining -= len(chunk)
+        except BaseException:
+            if clusters:
+                self.release(clusters[0])
+            if replaced:
+                # its old contents are already gone; don't leave a dangling entry
+                self._delete_entry(d, entry)
+            raise
+        first = clusters[0] if clusters else 0
+
+        if entry is None:
+            try:
+                entry = self._add_entry(d, parts[-1], ATTR_ARCHIVE, first, size, mtime)
+            except BaseException:
+                if first:
+                    self.release(first)
+                raise
+        else:
+            entry.cluster, entry.size, entry.mtime = first, size, mtime
+            entry.attr |= ATTR_ARCHIVE
+            self._rewrite_short(entry)
+            if old:
+                self.release(old)
+        return entry
+
+    def remove(self, relpath):
+        """
+        Delete a file or, recursively, a directory.
+        """
+        parts = self._split(relpath)
+        if not parts:
+            raise ValueError("refusing to remove the root directory")
+        d = self._lookup_dir("/".join(parts[:-1]))
+        entry = d.entries.get(parts[-1].lower()) if d is not None else None
+        if entry is None:
+            raise FileNotFoundError(relpath)
+        self._remove_entry(d, entry)
+
+    def _remove_entry(self, d, entry):
+        if entry.is_dir:
+            sub = self._read_dir(entry.cluster)
+            for child in list(sub.entries.values()):
+                self._remove_entry(sub, child)
+            self._dirs.pop(entry.cluster, None)
+        if entry.cluster:
+            self.release(entry.cluster)
+        self._delete_entry(d, entry)
+
+    def clear(self):
+        """
+        Remove everything from the root directory except the volume label.
+        """
+        root = self._read_dir(self.root_cluster)
+        for entry in list(root.entries.values()):
+            self._remove_entry(root, entry)
+
+    def reformat(self):
+        """
+        Quick format in place: free every cluster and empty the root
+        directory, keeping the boot sector, volume label and bad cluster
+        marks. Unlike clear() this never walks the tree, so it takes the
+        same time however much the volume holds.
+        """
+        root = self._read_dir(self.root_cluster)
+        label = None
+        if root.label is not None:
+            c, i, _ = root.label
+            self.f.seek(self.cluster_offset(c) + i * ENTRY_SIZE)
+            label = self.f.read(ENTRY_SIZE)
+
+        limit = self.cluster_count + 2
+        raw = self.fat[2:limit].tobytes()
+        used = len(raw.rstrip(b"\x00"))
+        bad = []
+        pattern = array("I", [BAD_CLUSTER]).tobytes()
+        i = raw.find(pattern)
+        while i >= 0:
+            if i % 4 == 0:
+                bad.append(2 + i // 4)
+            i = raw.find(pattern, i + 1)
+        self.fat[2:limit] = array("I", bytes(len(raw)))
+        for c in bad:
+            self.fat[c] = BAD_CLUSTER
+        self._set(self.root_cluster, END_OF_CHAIN)
+        if used:
+            # only the part of the FAT that was in use needs writing back
+            lo, hi = self._fat_dirty
+            first = 2 + (len(raw) - len(raw.lstrip(b"\x00"))) // 4
+            self._fat_dirty = [min(lo, first), max(hi, 2 + (used - 1) // 4)]
+        self.free_count = self.cluster_count - 1 - len(bad)
+        self.next_free = 2
+
+        self._zero_cluster(self.root_cluster)
+        if label is not None:
+            self.f.seek(self.cluster_offset(self.root_cluster))
+            self.f.write(label)
+        self._dirs = {}
+
+    def set_label(self, label, serial=None):
+        """
+        Update the volume label (boot sector, backup boot sector and root
+        directory entry) and optionally the volume serial number.
+        """
+        raw = label.upper().encode("ascii", "replace")[:11].ljust(11)
+        sectors = [0] + ([self.backup_sector] if self.backup_sector else [])
+        for sector in sectors:
+            off = self.base + sector * self.bytes_per_sector
+            if serial is not None:
+                self.f.seek(off + 67)
+                self.f.write(struct.pack("<I", serial & 0xFFFFFFFF))
+            self.f.seek(off + 71)
+            self.f.write(raw)
+        root = self._read_dir(self.root_cluster)
+        if root.label is not None:
+            c, i, _ = root.label
+            self.f.seek(self.cluster_offset(c) + i * ENTRY_SIZE)
+            self.f.write(self._short_entry(raw, ATTR_VOLUME_ID | ATTR_ARCHIVE, 0, 0, time.time()))
+            root.label = (c, i, raw.decode("ascii").rstrip())
+        else:
+            self._ensure_slots(root, 1)
+            index = root.end
+            self.f.seek(self._slot_offset(root, index))
+            self.f.write(self._short_entry(raw, ATTR_VOLUME_ID | ATTR_ARCHIVE, 0, 0, time.time()))
+            root.label = (root.chain[index // self.per_cluster], index % self.per_cluster,
+                          raw.decode("ascii").rstrip())
+            root.end += 1
+
+    def flush(self):
+        if not self.writable:
+            return
+        if self._fat_dirty is not None:
+            lo, hi = self._fat_dirty
+            bps = self.bytes_per_sector
+            # write back whole sectors covering the dirty range
+            first = (lo * 4) // bps * bps // 4
+            last = min(len(self.fat), -(-((hi + 1) * 4) // bps) * bps // 4)
+            part = self.fat[first:last]
+            if sys.byteorder != "little":
+                part.byteswap()
+            data = part.tobytes()
+            mirrored = not (self.ext_flags & 0x80)
+            for n in range(self.num_fats):
+                if not mirrored and n != self.active_fat:
+                    continue
+                self.f.seek(self.fat_offset + n * self.fat_sectors * bps + first * 4)
+                self.f.write(data)
+            self._fat_dirty = None
+        if self.fsinfo_sector:
+            off = self.base + self.fsinfo_sector * self.bytes_per_sector
+            self.f.seek(off + 488)
+            free = self.free_count if self.free_count is not None else 0xFFFFFFFF
+            self.f.write(struct.pack("<II", free, self.next_free))
+        self.f.flush()
+
+    def close(self, sync=True):
+        if self.f.closed:
+            return
+        try:
+            self.flush()
+            if self.writable and sync:
+                os.fsync(self.f.fileno())
+        finally:
+            self.f.close()
@@ -0,0 +1,159 @@
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import shutil
+import time
+import config
+
+
+FICLONE = 0x40049409
+
+# errors meaning "this kernel/filesystem pair can't do it", not real I/O errors
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+
+class FastCopy:
+    """
+    Copy helpers built on os.copy_file_range() and os.sendfile(), so file
+    data moves inside the kernel in COPY_CHUNK_SIZE steps instead of being
+    read into Python. Each falls back to the next method when the kernel or
+    filesystem pair doesn't support it (e.g. copy_file_range across
+    filesystems on newer kernels).
+    """
+
+    _libc = None
+
+    @staticmethod
+    def copy_range(fd_in, fd_out, offset_in, offset_out, count):
+        """
+        Copy `count` bytes from fd_in@offset_in to fd_out@offset_out.
+        Returns the number of bytes copied (short only at EOF of fd_in).
+        """
+        chunk = max(int(config.COPY_CHUNK_SIZE), 64 * 1024)
+        done = 0
+        if hasattr(os, "copy_file_range"):
+            try:
+                while done < count:
+                    n = os.copy_file_range(fd_in, fd_out, min(chunk, count - done),
+                                           offset_in + done, offset_out + done)
+                    if n == 0:
+                        return done
+                    done += n
+                return done
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+        try:
+            os.lseek(fd_out, offset_out + done, os.SEEK_SET)
+            while done < count:
+                n = os.sendfile(fd_out, fd_in, offset_in + done, min(chunk, count - done))
+                if n == 0:
+                    return done
+                done += n
+            return done
+        except OSError as e:
+            if e.errno not in _UNSUPPORTED:
+                raise
+        while done < count:
+            data = os.pread(fd_in, min(chunk, count - done), offset_in + done)
+            if not data:
+                break
+            view = memoryview(data)
+            while view:
+                n = os.pwrite(fd_out, view, offset_out + done)
+                done += n
+                view = view[n:]
+        return done
+
+    @staticmethod
+    def copy_file(src, dst, fsync=False):
+        """
+        Copy src to dst (data and timestamps, like shutil.copy2) and return
+        (bytes copied, seconds). With `fsync` the data is fdatasync'ed
+        before returning.
+        """
+        started = time.monotonic()
+        fd_in = os.open(src, os.O_RDONLY)
+        try:
+            size = os.fstat(fd_in).st_size
+            try:
+                os.posix_fadvise(fd_in, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            except (AttributeError, OSError):
+                pass
+            fd_out = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                copied = FastCopy.copy_range(fd_in, fd_out, 0, 0, size)
+                if fsync:
+                    os.fdatasync(fd_out)
+            finally:
+                os.close(fd_out)
+        finally:
+            os.close(fd_in)
+        shutil.copystat(src, dst)
+        return copied, time.monotonic() - started
+
+    @staticmethod
+    def clone_file(src, dst):
+        """
+        Copy src to dst keeping it sparse: a reflink (FICLONE) where the
+        filesystem supports it, otherwise only the data extents found with
+        SEEK_DATA/SEEK_HOLE are copied. Cost scales with the data in src,
+        not its apparent size.
+        """
+        fd_in = os.open(src, os.O_RDONLY)
+        try:
+            size = os.fstat(fd_in).st_size
+            fd_out = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                try:
+                    fcntl.ioctl(fd_out, FICLONE, fd_in)
+                    return
+                except OSError:
+                    pass
+                os.ftruncate(fd_out, size)
+                pos = 0
+                while pos < size:
+                    try:
+                        start = os.lseek(fd_in, pos, os.SEEK_DATA)
+                        end = os.lseek(fd_in, start, os.SEEK_HOLE)
+                    except OSError as e:
+                        if e.errno == errno.ENXIO:
+                            break  # only a hole remains
+                        if e.errno not in _UNSUPPORTED:
+                            raise
+                        start, end = pos, size
+                    FastCopy.copy_range(fd_in, fd_out, start, start, end - start)
+                    pos = end
+                os.fsync(fd_out)
+            finally:
+                os.close(fd_out)
+        finally:
+            os.close(fd_in)
+
+    @staticmethod
+    def syncfs(path):
+        """
+        Flush only the filesystem containing `path` (syncfs(2)). Falls back
+        to os.sync() where syncfs isn't available.
+        """
+        if FastCopy._libc is None:
+            FastCopy._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                                         use_errno=True)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if FastCopy._libc.syncfs(fd) != 0:
+                os.sync()
+        except AttributeError:
+            os.sync()
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def fsync_path(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
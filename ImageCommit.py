@@ -0,0 +1,876 @@
+import errno
+import os
+import shutil
+import stat
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+import config
+from CommitJournal import CommitJournal
+from FAT32Image import FAT32Image, NotFAT32Error
+from FastCopy import FastCopy
+from ImageIndex import ImageIndex
+from Jobs import Jobs
+from Metrics import Metrics
+from Staging import Staging
+from USBGadget import USBGadget
+from USBStorage import USBStorage
+
+
+class ImageCommit:
+    """
+    Copies staged uploads into a backing image and clears it, using either
+    the loop-mount engine or the mount-free FAT32Image engine
+    (config.COMMIT_ENGINE), and publishes the result to the host.
+
+    Staged files are merged into the image one by one; in "incremental"
+    COMMIT_MODE only the files recorded in the CommitJournal are touched.
+    In "ab" IMAGE_MODE the batch is first written into the inactive image
+    while the host keeps reading the active one, the LUN is flipped, and the
+    same batch is then replayed into the previously active image so both
+    stay in sync without a full copy. With MASS_STORAGE_LUNS > 1 each batch
+    is instead written into a fresh image on one LUN (chosen by
+    LUN_ROTATION) while the other LUNs stay attached.
+
+    commit(), clear() and reload() are serialized behind one lock; uploads
+    don't take it and keep running in parallel, into batches of their own
+    that a commit only picks up once sealed (see Staging).
+    """
+
+    _lock = threading.RLock()
+
+    @staticmethod
+    def staged():
+        """
+        Move sealed upload batches into UPLOAD_DIR and return (entries,
+        journal_pos). Entries are (relpath, (size, mtime_ns)) for every
+        staged file to commit: all of UPLOAD_DIR in "full" COMMIT_MODE,
+        only the files recorded in the journal in "incremental" mode. Pass
+        journal_pos to CommitJournal.consume() once the entries are
+        committed.
+        """
+        with Jobs.phase("absorb"):
+            Staging.absorb()
+        names, journal_pos = CommitJournal.snapshot()
+        if config.COMMIT_MODE != "incremental" or names is None:
+            names = []
+            for root, dirs, files in os.walk(config.UPLOAD_DIR):
+                dirs.sort()
+                rel = os.path.relpath(root, config.UPLOAD_DIR)
+                for name in sorted(files):
+                    names.append(os.path.normpath(os.path.join(rel, name)))
+        entries = []
+        for rel in names:
+            try:
+                st = os.stat(os.path.join(config.UPLOAD_DIR, rel))
+            except OSError:
+                # already committed, or removed before we got to it
+                continue
+            if stat.S_ISREG(st.st_mode):
+                entries.append((rel, (st.st_size, st.st_mtime_ns)))
+        return entries, journal_pos
+
+    @staticmethod
+    def _flush(image, mounted=False):
+        """
+        Make the committed data durable. By default only the image's own
+        writes are flushed (syncfs on a still-mounted target, then fsync of
+        the image file) rather than every filesystem on the SD card.
+        """
+        if config.COPY_FLUSH == "global":
+            try:
+                os.sync()
+            except Exception:
+                try:
+                    subprocess.run(["sync"], check=False)
+                except Exception:
+                    pass
+            return
+        try:
+            if mounted:
+                FastCopy.syncfs(config.DATA_DIR)
+            FastCopy.fsync_path(image)
+        except Exception:
+            os.sync()
+
+    @staticmethod
+    def _report(rel, nbytes, seconds):
+        if nbytes >= config.COPY_REPORT_MIN_BYTES:
+            rate = nbytes / seconds / (1024 * 1024) if seconds > 0 else float("inf")
+            print(f"ImageCommit: {rel}: {nbytes} bytes in {seconds:.3f}s ({rate:.1f} MiB/s)")
+
+    @staticmethod
+    def _remove_source(rel, key):
+        """
+        Delete a committed staging file unless it was replaced after the
+        snapshot, then prune directories it leaves empty.
+        """
+        src_path = os.path.join(config.UPLOAD_DIR, rel)
+        try:
+            st = os.stat(src_path)
+            if (st.st_size, st.st_mtime_ns) != key:
+                return
+            os.remove(src_path)
+        except OSError:
+            return
+        parent = os.path.dirname(rel)
+        while parent:
+            try:
+                os.rmdir(os.path.join(config.UPLOAD_DIR, parent))
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
+
+    @staticmethod
+    def _unchanged(size, mtime, key):
+        # FAT keeps mtimes with 2 s resolution
+        return (config.COMMIT_MODE == "incremental" and size == key[0]
+                and abs(mtime - key[1] / 1e9) <= 2)
+
+    @staticmethod
+    def _identical(index, rel, sha256, key, size, mtime):
+        """
+        True if the image entry for `rel` (`size` bytes, modified at `mtime`)
+        already holds the staged file's content, so only its mtime needs
+        updating.
+        """
+        if not config.DEDUP or not ImageIndex.identical(index, rel, sha256, size, mtime):
+            return False
+        Metrics.inc("receiveit_dedup_skipped_files_total")
+        Metrics.inc("receiveit_dedup_skipped_bytes_total", key[0])
+        return True
+
+    @staticmethod
+    def stage_existing(sha256, relpath):
+        """
+        Stage `relpath` with content `sha256` without the client sending
+        it: cloned from a staged file with that content, or copied out of a
+        backing image. Returns where it came from ("staged", "image"), or
+        "present" if the image already holds it at `relpath` and there is
+        nothing to commit. Returns None if the content is unknown.
+        """
+        if config.MASS_STORAGE_LUNS <= 1:
+            # already in the image under this name: nothing to send or stage,
+            # whether or not a copy is staged too
+            image = USBStorage.active_image()
+            with ImageCommit._lock:
+                index = ImageIndex.load(image)
+                for name in ImageIndex.names(index, sha256):
+                    if (ImageIndex.key(name) == ImageIndex.key(relpath) and ImageCommit._extract(
+                            image, index, name, sha256, relpath) == "present"):
+                        return "present"
+
+        staged = ImageIndex.staged_with(sha256)
+        if relpath.replace(os.sep, "/") in staged:
+            return "staged"
+        source = ImageIndex.staged_file(staged[0]) if staged else None
+        if source is not None:
+            tmp = Staging.tmp_file()
+            FastCopy.clone_file(source, tmp)
+            Staging.place(tmp, relpath, sha256)
+            return "staged"
+
+        # the image must not change while we read from it
+        with ImageCommit._lock:
+            for image in USBStorage.lun_images():
+                index = ImageIndex.load(image)
+                for name in ImageIndex.names(index, sha256):
+                    source = ImageCommit._extract(image, index, name, sha256, relpath)
+                    if source is not None:
+                        return source
+        return None
+
+    @staticmethod
+    def _extract(image, index, name, sha256, relpath):
+        """
+        Copy image entry `name` to staging as `relpath` if it still holds
+        content `sha256`.
+        """
+        same = (config.MASS_STORAGE_LUNS <= 1
+                and ImageIndex.key(name) == ImageIndex.key(relpath))
+        tmp = Staging.tmp_file()
+        try:
+            if USBStorage.mounted_image() == image:
+                path = os.path.join(config.DATA_DIR, name)
+                st = os.stat(path)
+                if not ImageIndex.identical(index, name, sha256, st.st_size, st.st_mtime):
+                    return None
+                if same:
+                    return "present"
+                FastCopy.copy_file(path, tmp, fsync=True)
+            else:
+                with FAT32Image(image, writable=False) as img:
+                    entry = img.stat(name)
+                    if entry is None or entry.is_dir or not ImageIndex.identical(
+                            index, name, sha256, entry.size, entry.mtime):
+                        return None
+                    if same:
+                        return "present"
+                    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                    try:
+                        pos = 0
+                        for offset, length in img.extents(entry):
+                            pos += FastCopy.copy_range(img.f.fileno(), fd, offset, pos, length)
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+            Staging.place(tmp, relpath, sha256)
+            return "image"
+        except (OSError, ValueError):
+            return None
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    @staticmethod
+    def _copy_mounted(image, entries, remove, keep_mounted=False):
+        os.makedirs(config.DATA_DIR, exist_ok=True)
+        with Jobs.phase("mount"):
+            USBStorage.mount(image)
+        index = ImageIndex.load(image)
+        try:
+            with Jobs.phase("copy"):
+                for rel, key in entries:
+                    src_path = os.path.join(config.UPLOAD_DIR, rel)
+                    dst_path = os.path.join(config.DATA_DIR, rel)
+                    try:
+                        # merge per file: existing files in the same directory stay
+                        st = os.stat(dst_path) if os.path.exists(dst_path) else None
+                        sha256 = ImageIndex.staged_hash(rel, key)
+                        if st is not None and ImageCommit._identical(
+                                index, rel, sha256, key, st.st_size, st.st_mtime):
+                            os.utime(dst_path, ns=(key[1], key[1]))
+                            ImageIndex.record(index, rel, sha256, key[0], key[1] / 1e9)
+                        elif st is None or not ImageCommit._unchanged(st.st_size, st.st_mtime, key):
+                            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+                            nbytes, seconds = FastCopy.copy_file(
+                                src_path, dst_path, fsync=config.COPY_FLUSH == "file")
+                            ImageCommit._report(rel, nbytes, seconds)
+                            ImageIndex.record(index, rel, sha256, key[0], key[1] / 1e9)
+                            # only bytes actually written count, not dedup/unchanged skips
+                            Jobs.progress(nbytes)
+                        if remove:
+                            ImageCommit._remove_source(rel, key)
+                    except Exception:
+                        # ignore individual file errors
+                        pass
+        finally:
+            ImageIndex.save(image, index)
+            ImageCommit._finish_mounted(image, keep_mounted)
+
+    @staticmethod
+    def _finish_mounted(image, keep_mounted=False):
+        if not keep_mounted:
+            with Jobs.phase("umount"):
+                USBStorage.umount(image)
+            # tweak FAT volume metadata to prod Windows into re-caching
+            with Jobs.phase("bump_fat_volume_metadata"):
+                try:
+                    USBStorage.bump_fat_volume_metadata(image)
+                except Exception:
+                    pass
+        with Jobs.phase("sync"):
+            ImageCommit._flush(image, mounted=keep_mounted)
+
+    @staticmethod
+    def _copy_direct(image, entries, remove, keep_mounted=False):
+        USBStorage.release(image)
+        index = ImageIndex.load(image)
+        with FAT32Image(image) as img:
+            try:
+                with Jobs.phase("copy"):
+                    for rel, key in entries:
+                        src_path = os.path.join(config.UPLOAD_DIR, rel)
+                        try:
+                            cur = img.stat(rel)
+                            sha256 = ImageIndex.staged_hash(rel, key)
+                            if cur is not None and not cur.is_dir and ImageCommit._identical(
+                                    index, rel, sha256, key, cur.size, cur.mtime):
+                                img.touch(rel, key[1] / 1e9)
+                                ImageIndex.record(index, rel, sha256, key[0], key[1] / 1e9)
+                            elif cur is None or not ImageCommit._unchanged(cur.size, cur.mtime, key):
+                                started = time.monotonic()
+                                img.write_file(rel, src_path)
+                                ImageCommit._report(rel, key[0], time.monotonic() - started)
+                                ImageIndex.record(index, rel, sha256, key[0], key[1] / 1e9)
+                                # only bytes actually written count, not dedup/unchanged skips
+                                Jobs.progress(key[0])
+                            if remove:
+                                ImageCommit._remove_source(rel, key)
+                        except OSError as e:
+                            if e.errno == errno.ENOSPC:
+                                raise
+                            # ignore individual file errors
+                            pass
+            finally:
+                ImageIndex.save(image, index)
+            ImageCommit._bump_direct(img)
+
+    @staticmethod
+    def _bump_direct(img):
+        # same label scheme as USBStorage.bump_fat_volume_metadata()
+        with Jobs.phase("bump_fat_volume_metadata"):
+            img.set_label(f"RECEIVE{int(time.time()) % 100000:05d}",
+                          serial=int(time.time() * 1000) & 0xFFFFFFFF)
+            img.flush()
+
+    @staticmethod
+    def _clear_mounted(image):
+        with Jobs.phase("mount"):
+            USBStorage.mount(image)
+        try:
+            with Jobs.phase("clear"):
+                for name in os.listdir(config.DATA_DIR):
+                    path = os.path.join(config.DATA_DIR, name)
+                    try:
+                        if os.path.islink(path) or os.path.isfile(path):
+                            os.remove(path)
+                        elif os.path.isdir(path):
+                            shutil.rmtree(path)
+                    except Exception:
+                        pass
+        finally:
+            ImageCommit._finish_mounted(image)
+
+    @staticmethod
+    def _clear_direct(image):
+        USBStorage.release(image)
+        with FAT32Image(image) as img:
+            with Jobs.phase("clear"):
+                img.clear()
+            ImageCommit._bump_direct(img)
+
+    @staticmethod
+    def _run(direct, mounted, what, *args):
+        started = time.monotonic()
+        engine = config.COMMIT_ENGINE
+        if engine == "direct":
+            try:
+                direct(*args)
+            except NotFAT32Error as e:
+                # not a FAT32 image (e.g. small mkfs.vfat default); use the loop path.
+                # Raised on open only: later errors mean the image may be half
+                # written, and replaying the operation on it would be wrong
+                print(f"ImageCommit: direct {what} unavailable ({e}), using loop mount")
+                engine = "loop"
+                mounted(*args)
+        else:
+            mounted(*args)
+        print(f"ImageCommit: {what} via {engine} engine took {time.monotonic() - started:.3f}s")
+
+    @staticmethod
+    def _copy(image, entries, remove=True, keep_mounted=False):
+        # a manifest that still matches the image only needs the entries
+        # this commit touched; anything else (e.g. the host wrote) needs a
+        # full rebuild
+        status = ImageIndex.status(image)
+        ImageCommit._run(ImageCommit._copy_direct, ImageCommit._copy_mounted,
+                         "commit", image, entries, remove, keep_mounted)
+        if remove:
+            ImageIndex.prune_staged()
+        ImageCommit._index(image, [rel for rel, key in entries]
+                           if status is not None and not status["stale"] else None)
+
+    @staticmethod
+    def _clear_format(image):
+        USBStorage.release(image)
+        with FAT32Image(image) as img:
+            with Jobs.phase("clear"):
+                img.reformat()
+            ImageCommit._bump_direct(img)
+
+    @staticmethod
+    def _clear_template(image):
+        USBStorage.release(image)
+        with Jobs.phase("clear"):
+            USBStorage.image_copy(USBStorage.template_create(), image)
+        try:
+            with FAT32Image(image) as img:
+                ImageCommit._bump_direct(img)
+        except NotFAT32Error:
+            with Jobs.phase("bump_fat_volume_metadata"):
+                try:
+                    USBStorage.bump_fat_volume_metadata(image)
+                except Exception:
+                    pass
+
+    @staticmethod
+    def _clear(image):
+        started = time.monotonic()
+        mode = config.CLEAR_MODE
+        try:
+            if mode == "template":
+                ImageCommit._clear_template(image)
+            elif mode == "format":
+                ImageCommit._clear_format(image)
+        except (OSError, NotFAT32Error) as e:
+            # no template or not a FAT32 image; remove entries one by one
+            print(f"ImageCommit: {mode} clear unavailable ({e}), deleting entries")
+            mode = "delete"
+        if mode in ("template", "format"):
+            print(f"ImageCommit: clear via {mode} took {time.monotonic() - started:.3f}s")
+        else:
+            ImageCommit._run(ImageCommit._clear_direct, ImageCommit._clear_mounted, "clear", image)
+        ImageIndex.reset(image)
+        ImageCommit._index(image)
+
+    @staticmethod
+    def _index(image, changed=None):
+        # refresh the manifest behind /files and /status, only re-reading
+        # the `changed` entries if given
+        with Jobs.phase("index"):
+            if changed is None:
+                ImageIndex.rebuild(image)
+            else:
+                ImageIndex.update(image, changed)
+
+    @staticmethod
+    @contextmanager
+    def reading():
+        """
+        Hold off commit, clear and reload while the block reads from an
+        image, so it never sees one half written.
+        """
+        with ImageCommit._lock:
+            yield
+
+    @staticmethod
+    def refresh_index(image):
+        """
+        Re-read the manifest of `image`, e.g. after the host wrote to it.
+        Reads the image file directly, so the host keeps its media.
+        """
+        with ImageCommit._lock:
+            ImageIndex.rebuild(image)
+
+    @staticmethod
+    def detach(lun=0):
+        # If gadget is active, detach media first so the backing file isn't busy
+        if USBGadget.is_initialized():
+            with Jobs.phase("detach"):
+                USBGadget.detach_mass_storage_media(lun)
+
+    @staticmethod
+    def _image_create(image=None):
+        with Jobs.phase("image_create"):
+            USBStorage.image_create(image)
+
+    @staticmethod
+    def publish(image=None, lun=0):
+        image = image or USBStorage.active_image()
+        # update mass storage media without touching serial function
+        if USBGadget.is_initialized():
+            with Jobs.phase("replace_mass_storage_image"):
+                USBGadget.replace_mass_storage_image(image, lun)
+        else:
+            # gadget not previously initialized; create full gadget (includes serial + ms)
+            with Jobs.phase("gadget_init"):
+                USBGadget.init()
+
+    @staticmethod
+    def _flip(target):
+        """
+        Present `target` to the host and record it as the active A/B image.
+        The inactive image is marked out of sync until the caller replays
+        the change into it.
+        """
+        if USBGadget.is_initialized():
+            ImageCommit.publish(target)
+            USBStorage.set_active_image(target, synced=False)
+        else:
+            # init() attaches whatever active_image() returns
+            USBStorage.set_active_image(target, synced=False)
+            ImageCommit.publish(target)
+
+    @staticmethod
+    def resync():
+        """
+        If an earlier A/B operation was interrupted between the flip and the
+        replay, rebuild the inactive image as a full copy of the active one.
+        """
+        if USBStorage.images_synced():
+            return
+        active = USBStorage.active_image()
+        inactive = USBStorage.inactive_image()
+        print(f"ImageCommit: resyncing {inactive} from {active}")
+        ImageCommit._image_create(active)
+        with Jobs.phase("resync"):
+            USBStorage.release(inactive)
+            USBStorage.image_copy(active, inactive)
+            ImageIndex.copy(active, inactive)
+        ImageCommit._index(inactive)
+        USBStorage.set_active_image(active, synced=True)
+
+    @staticmethod
+    def commit():
+        with ImageCommit._lock:
+            ImageCommit._commit()
+
+    @staticmethod
+    def _commit():
+        entries, journal_pos = ImageCommit.staged()
+        ImageCommit._commit_batch(entries)
+        CommitJournal.consume(journal_pos)
+
+    @staticmethod
+    def _commit_batch(entries, atomic=False):
+        """
+        Copy `entries` into the image(s) and publish them. With `atomic`,
+        nothing of the batch is left in the image if that fails before the
+        host sees it. Returns the image the batch was published in.
+        """
+        if config.MASS_STORAGE_LUNS > 1:
+            return ImageCommit._commit_luns(entries, atomic)
+        if config.IMAGE_MODE == "ab":
+            return ImageCommit._commit_ab(entries, atomic)
+        ImageCommit.detach()
+        undo = None
+        published = False
+        try:
+            # ensure backing image exists
+            ImageCommit._image_create()
+            image = USBStorage.active_image()
+            undo = ImageCommit._undo_save(image, entries) if atomic else None
+            try:
+                ImageCommit._copy(image, entries)
+                if atomic:
+                    ImageCommit._verify(image, entries)
+            except Exception:
+                if undo is not None:
+                    ImageCommit._undo(undo)
+                raise
+            ImageCommit.publish()
+            published = True
+        finally:
+            if not published:
+                # give the host its media back whatever failed, the error
+                # that got us here is the one to report
+                try:
+                    ImageCommit.publish()
+                except Exception as e:
+                    print(f"ImageCommit: re-publishing after a failed commit failed: {e}")
+            if undo is not None:
+                shutil.rmtree(undo["dir"], ignore_errors=True)
+        return image
+
+    @staticmethod
+    def _commit_ab(entries, atomic=False):
+        ImageCommit.resync()
+        previous = USBStorage.active_image()
+        target = USBStorage.inactive_image()
+        ImageCommit._image_create(target)
+        undo = ImageCommit._undo_save(target, entries) if atomic else None
+        flipping = False
+        try:
+            ImageCommit._copy(target, entries, remove=False)
+            if atomic:
+                ImageCommit._verify(target, entries)
+            flipping = True
+            ImageCommit._flip(target)
+        except Exception:
+            if undo is None:
+                raise
+            ImageCommit._undo(undo)
+            if flipping:
+                # the swap may have left the host without media
+                USBStorage.set_active_image(previous, synced=True)
+                ImageCommit.publish(previous)
+            raise
+        finally:
+            if undo is not None:
+                shutil.rmtree(undo["dir"], ignore_errors=True)
+
+        # the previous image is no longer visible to the host; bring it up to
+        # date. In incremental mode it stays mounted, so the next commit
+        # (which targets it) can skip the mount.
+        other = USBStorage.inactive_image()
+        ImageCommit._image_create(other)
+        ImageCommit._copy(other, entries, remove=True,
+                          keep_mounted=config.COMMIT_MODE == "incremental")
+        USBStorage.set_active_image(target, synced=True)
+        return target
+
+    @staticmethod
+    def _fresh(image):
+        """
+        Replace `image` with a blank one from the template.
+        """
+        USBStorage.release(image)
+        USBStorage.image_delete(image)
+        ImageIndex.reset(image)
+        ImageCommit._image_create(image)
+        ImageCommit._index(image)
+
+    @staticmethod
+    def _commit_luns(entries, atomic=False):
+        """
+        Publish the batch on a LUN of its own. "round_robin" reuses the LUN
+        holding the oldest batch; "latest" builds the batch on the oldest
+        of lun.1.. and then swaps it onto lun.0, moving the previous newest
+        batch to the LUN it came from. Either way the LUNs not being rebuilt
+        stay attached and readable throughout. With `atomic` the batch is
+        built next to the LUN's image, which stays attached until the batch
+        is complete and is kept until the batch is published.
+        """
+        if not entries:
+            return None
+        images = USBStorage.lun_images()
+        seq = USBStorage.lun_seq()
+        latest = config.LUN_ROTATION == "latest"
+        lun = min(range(1 if latest else 0, len(images)), key=lambda n: seq[n])
+        image = images[lun]
+
+        old = None
+        if atomic:
+            build = image + ".new"
+            ImageCommit._fresh(build)
+            try:
+                ImageCommit._copy(build, entries, remove=True)
+                ImageCommit._verify(build, entries)
+            except Exception:
+                USBStorage.image_delete(build)
+                ImageIndex.reset(build)
+                raise
+            ImageCommit.detach(lun)
+            old = (image + ".old", ImageIndex.load(image), list(images), list(seq))
+            USBStorage.image_move(image, old[0])
+            index = ImageIndex.load(build)
+            USBStorage.image_move(build, image)
+            ImageIndex.save(image, index)
+            ImageIndex.reset(build)
+            ImageCommit._index(image)
+        else:
+            ImageCommit.detach(lun)
+            ImageCommit._fresh(image)
+            ImageCommit._copy(image, entries, remove=True)
+
+        newest = max(seq) + 1
+        if latest:
+            images[0], images[lun] = image, images[0]
+            seq[0], seq[lun] = newest, seq[0]
+        else:
+            seq[lun] = newest
+        try:
+            USBStorage.set_lun_images(images, seq)
+            if latest:
+                # previous batch first, so the host never loses it
+                ImageCommit.publish(images[lun], lun)
+                ImageCommit.publish(images[0], 0)
+            else:
+                ImageCommit.publish(image, lun)
+        except Exception:
+            if old is None:
+                raise
+            print(f"ImageCommit: rolling back {image}")
+            USBStorage.image_move(old[0], image)
+            ImageIndex.save(image, old[1])
+            ImageCommit._index(image)
+            USBStorage.set_lun_images(old[2], old[3])
+            for n in {0, lun}:
+                try:
+                    ImageCommit.publish(old[2][n], n)
+                except Exception as e:
+                    print(f"ImageCommit: republishing lun {n} failed: {e}")
+            raise
+        if old is not None:
+            USBStorage.image_delete(old[0])
+            ImageIndex.reset(old[0])
+        return image
+
+    @staticmethod
+    def transaction(batch):
+        """
+        Commit and publish exactly the files of the unsealed upload batch
+        `batch`, all or nothing: if the copy or the publish fails, the
+        image is put back the way it was and the batch is dropped. Returns
+        (image, [{"name", "size", "mtime", "sha256"}, ...]) for what landed,
+        read back from the image index.
+        """
+        with ImageCommit._lock:
+            with Jobs.phase("absorb"):
+                names = Staging.absorb([batch], journal=False)
+            if not names:
+                raise ValueError("nothing to publish")
+            entries = []
+            for rel in names:
+                st = os.stat(os.path.join(config.UPLOAD_DIR, rel))
+                entries.append((rel, (st.st_size, st.st_mtime_ns)))
+            try:
+                image = ImageCommit._commit_batch(entries, atomic=True)
+            except Exception:
+                for rel, key in entries:
+                    ImageCommit._remove_source(rel, key)
+                ImageIndex.prune_staged()
+                raise
+            index = ImageIndex.load(image)
+            manifest = []
+            for rel, _ in entries:
+                rec = index.get(ImageIndex.key(rel))
+                manifest.append({"name": rec[3], "size": rec[1], "mtime": rec[2],
+                                 "sha256": rec[0]})
+            return image, manifest
+
+    @staticmethod
+    def _verify(image, entries):
+        """
+        Raise unless every entry landed in `image` with its full size
+        (the copy loops skip files that fail individually).
+        """
+        index = ImageIndex.load(image)
+        for rel, key in entries:
+            rec = index.get(ImageIndex.key(rel))
+            if rec is None or rec[1] != key[0]:
+                raise OSError(errno.EIO, f"{rel} was not written to {os.path.basename(image)}")
+
+    @staticmethod
+    def _undo_save(image, entries):
+        """
+        Before a transactional copy into `image`: keep the files `entries`
+        will overwrite and note the directories they will create, so
+        _undo() can put the image back. The caller removes undo["dir"].
+        """
+        undo = {"image": image, "dir": Staging.tmp_file()[:-len(".part")] + ".undo",
+                "index": ImageIndex.load(image), "saved": [], "new": [], "dirs": []}
+        with Jobs.phase("undo_save"):
+            ImageCommit._run(ImageCommit._undo_save_direct, ImageCommit._undo_save_mounted,
+                             "undo save", undo, [rel.replace(os.sep, "/") for rel, _ in entries])
+        return undo
+
+    @staticmethod
+    def _undo_note(undo, name, parent_exists):
+        # only the topmost missing directory needs removing
+        parts = name.split("/")
+        for i in range(1, len(parts)):
+            d = "/".join(parts[:i])
+            if d in undo["dirs"]:
+                return
+            if not parent_exists(d):
+                undo["dirs"].append(d)
+                return
+
+    @staticmethod
+    def _undo_save_direct(undo, names):
+        USBStorage.release(undo["image"])
+        with FAT32Image(undo["image"], writable=False) as img:
+            for name in names:
+                ImageCommit._undo_note(undo, name, lambda d: img.stat(d) is not None)
+                entry = img.stat(name)
+                if entry is None:
+                    undo["new"].append(name)
+                    continue
+                if entry.is_dir:
+                    continue
+                dst = os.path.join(undo["dir"], name)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+                try:
+                    pos = 0
+                    for offset, length in img.extents(entry):
+                        pos += FastCopy.copy_range(img.f.fileno(), fd, offset, pos, length)
+                finally:
+                    os.close(fd)
+                os.utime(dst, (entry.mtime, entry.mtime))
+                undo["saved"].append(name)
+
+    @staticmethod
+    def _undo_save_mounted(undo, names):
+        with Jobs.phase("mount"):
+            USBStorage.mount(undo["image"])
+        for name in names:
+            ImageCommit._undo_note(
+                undo, name, lambda d: os.path.isdir(os.path.join(config.DATA_DIR, d)))
+            path = os.path.join(config.DATA_DIR, name)
+            if not os.path.lexists(path):
+                undo["new"].append(name)
+                continue
+            if not os.path.isfile(path):
+                continue
+            dst = os.path.join(undo["dir"], name)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copy2(path, dst)
+            undo["saved"].append(name)
+
+    @staticmethod
+    def _undo(undo):
+        """
+        Put back what _undo_save() kept.
+        """
+        print(f"ImageCommit: rolling back {undo['image']}")
+        with Jobs.phase("rollback"):
+            ImageCommit._run(ImageCommit._undo_direct, ImageCommit._undo_mounted,
+                             "rollback", undo)
+            ImageIndex.save(undo["image"], undo["index"])
+        ImageCommit._index(undo["image"])
+
+    @staticmethod
+    def _undo_direct(undo):
+        USBStorage.release(undo["image"])
+        with FAT32Image(undo["image"]) as img:
+            for name in undo["new"] + undo["saved"] + undo["dirs"]:
+                try:
+                    img.remove(name)
+                except FileNotFoundError:
+                    pass
+            for name in undo["saved"]:
+                img.write_file(name, os.path.join(undo["dir"], name))
+            ImageCommit._bump_direct(img)
+
+    @staticmethod
+    def _undo_mounted(undo):
+        with Jobs.phase("mount"):
+            USBStorage.mount(undo["image"])
+        try:
+            for name in undo["new"] + undo["saved"]:
+                try:
+                    os.remove(os.path.join(config.DATA_DIR, name))
+                except FileNotFoundError:
+                    pass
+            for name in undo["dirs"]:
+                shutil.rmtree(os.path.join(config.DATA_DIR, name), ignore_errors=True)
+            for name in undo["saved"]:
+                shutil.copy2(os.path.join(undo["dir"], name), os.path.join(config.DATA_DIR, name))
+        finally:
+            ImageCommit._finish_mounted(undo["image"])
+
+    @staticmethod
+    def clear():
+        with ImageCommit._lock:
+            ImageCommit._clear_all()
+
+    @staticmethod
+    def _clear_all():
+        if config.MASS_STORAGE_LUNS > 1:
+            images = USBStorage.lun_images()
+            for lun, image in enumerate(images):
+                ImageCommit.detach(lun)
+                ImageCommit._fresh(image)
+            USBStorage.set_lun_images(images, [0] * len(images))
+            for lun, image in enumerate(images):
+                ImageCommit.publish(image, lun)
+            return
+        if config.IMAGE_MODE == "ab":
+            ImageCommit.resync()
+            target = USBStorage.inactive_image()
+            ImageCommit._image_create(target)
+            ImageCommit._clear(target)
+            ImageCommit._flip(target)
+            other = USBStorage.inactive_image()
+            ImageCommit._image_create(other)
+            ImageCommit._clear(other)
+            USBStorage.set_active_image(target, synced=True)
+            return
+        ImageCommit.detach()
+        ImageCommit._image_create()
+        ImageCommit._clear(USBStorage.active_image())
+        ImageCommit.publish()
+
+    @staticmethod
+    def reload():
+        with ImageCommit._lock:
+            # ensure backing images exist
+            for lun, image in enumerate(USBStorage.lun_images()):
+                ImageCommit._image_create(image)
+
+                # swap media without touching serial
+                ImageCommit.publish(image, lun)
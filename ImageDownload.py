@@ -0,0 +1,128 @@
+import os
+import config
+from FAT32Image import FAT32Image
+from ImageCommit import ImageCommit
+from ImageIndex import ImageIndex
+from Metrics import Metrics
+from Staging import Staging
+from USBStorage import USBStorage
+
+
+class ImageDownload:
+    """
+    Read single files back out of a published image while the host keeps
+    it attached. The file is looked up with the read-only FAT32Image reader
+    (or in DATA_DIR while this process has the image loop-mounted, since
+    the image file may lag behind the mount's cache) and its data is then
+    sent straight from the image file's extents with sendfile(2), falling
+    back to plain reads where the server gives us no socket (e.g. the
+    Flask test client).
+
+    The lookup runs under the commit lock, so it never sees a half-written
+    directory; the transfer itself doesn't hold it. If the image changes
+    while a file is being sent (a commit in "single" IMAGE_MODE, or the
+    host writing), the response is cut short, which a client detects from
+    Content-Length.
+    """
+
+    @staticmethod
+    def open(image, relpath):
+        """
+        Look up `relpath` in `image`. Returns a dict with the open file
+        ("file"), the byte ranges holding its data ("extents"), its "name",
+        "size", "mtime" and "sha256" (if the manifest knows it), or None if
+        there is no such file.
+        """
+        relpath = Staging.safe_relpath(relpath)
+        if relpath is None:
+            return None
+        name = relpath.replace(os.sep, "/")
+        with ImageCommit.reading():
+            if USBStorage.mounted_image() == image:
+                path = os.path.join(config.DATA_DIR, relpath)
+                try:
+                    f = open(path, "rb", buffering=0)
+                except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+                    return None
+                st = os.fstat(f.fileno())
+                found = {"file": f, "extents": [(0, st.st_size)], "name": name,
+                         "size": st.st_size, "mtime": st.st_mtime, "watch": path}
+            else:
+                f = open(image, "rb", buffering=0)
+                try:
+                    with FAT32Image(image, writable=False) as img:
+                        entry = img.stat(relpath)
+                        if entry is None or entry.is_dir:
+                            f.close()
+                            return None
+                        found = {"file": f, "extents": img.extents(entry), "name": name,
+                                 "size": entry.size, "mtime": entry.mtime, "watch": image}
+                except (NotADirectoryError, ValueError):
+                    f.close()
+                    return None
+                except Exception:
+                    f.close()
+                    raise
+            found["generation"] = ImageDownload._generation(found["watch"])
+        index = ImageIndex.load(image)
+        rec = index.get(ImageIndex.key(name))
+        found["sha256"] = rec[0] if rec and ImageIndex.identical(
+            index, name, rec[0], found["size"], found["mtime"]) else None
+        return found
+
+    @staticmethod
+    def _generation(path):
+        try:
+            st = os.stat(path)
+            return (st.st_ino, st.st_size, st.st_mtime_ns)
+        except OSError:
+            return None
+
+    @staticmethod
+    def segments(extents, start, stop):
+        """
+        Returns the (image offset, length) ranges holding bytes
+        [start, stop) of a file stored in `extents`.
+        """
+        out = []
+        pos = 0
+        for offset, length in extents:
+            lo, hi = max(start, pos), min(stop, pos + length)
+            if lo < hi:
+                out.append((offset + lo - pos, hi - lo))
+            pos += length
+            if pos >= stop:
+                break
+        return out
+
+    @staticmethod
+    def stream(found, start, stop, sock=None):
+        """
+        Yields bytes [start, stop) of the file returned by open(). With
+        `sock` (the connection's socket), yields nothing but an initial
+        b"" that makes the server send the headers, then sends the data
+        with sendfile(2) itself.
+        """
+        f = found["file"]
+        chunk = max(int(config.COPY_CHUNK_SIZE), 64 * 1024)
+        if sock is not None:
+            yield b""
+        for offset, length in ImageDownload.segments(found["extents"], start, stop):
+            while length:
+                n = min(chunk, length)
+                if sock is not None:
+                    sent = sock.sendfile(f, offset, n)
+                else:
+                    data = os.pread(f.fileno(), n, offset)
+                    sent = len(data)
+                    if data:
+                        yield data
+                if not sent:
+                    return
+                Metrics.inc("receiveit_download_bytes_total", sent)
+                offset += sent
+                length -= sent
+                if ImageDownload._generation(found["watch"]) != found["generation"]:
+                    print(f"ImageDownload: {found['watch']} changed while sending "
+                          f"{found['name']}, response cut short")
+                    return
@@ -0,0 +1,363 @@
+import json
+import os
+import threading
+import time
+import config
+from FAT32Image import FAT32Image
+
+
+class ImageIndex:
+    """
+    Content hashes of staged uploads and of the files already in each
+    backing image, so commit can leave byte-identical files alone and
+    clients can ask whether a file needs to be sent at all.
+
+    Staged hashes come from the upload paths (SHA-256 computed while the
+    data streams in) and are kept in an append-only UPLOAD_HASHES file as
+    (relpath, sha256, size, mtime_ns, path); a record only counts while the
+    staged file, in UPLOAD_DIR or still at `path` in its sealed batch, has
+    that size and mtime. The per-image index lives in
+    IMAGE_INDEX_DIR and maps lower-cased paths (FAT is case-insensitive) to
+    [sha256, size, FAT mtime, name, clusters]. It is tied to the image's
+    inode, and each record is only trusted while the image entry still has
+    that size and mtime, since the host can change the image behind our
+    back.
+
+    The index is a full manifest of the image (every file, hashed or not,
+    plus free/used space), so listings and space queries never need a
+    mount. A commit only updates the entries it wrote, as long as nothing
+    else changed the image since the manifest was made; otherwise, and
+    after a clear, it is rebuilt from the image's directory tree.
+    """
+
+    _lock = threading.Lock()
+    # relpath -> (sha256, size, mtime_ns, batch path), loaded from UPLOAD_HASHES on first use
+    _staged = None
+
+    @staticmethod
+    def key(relpath):
+        return relpath.replace(os.sep, "/").lower()
+
+    # ------------------------------------------------------------------
+    # staged uploads
+
+    @staticmethod
+    def _load_staged():
+        if ImageIndex._staged is None:
+            staged = {}
+            try:
+                with open(config.UPLOAD_HASHES, "r", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            rec = json.loads(line)
+                            staged[rec["name"]] = (rec["sha256"], rec["size"], rec["mtime_ns"],
+                                                   rec.get("path"))
+                        except (ValueError, KeyError):
+                            # torn last line
+                            continue
+            except FileNotFoundError:
+                pass
+            ImageIndex._staged = staged
+        return ImageIndex._staged
+
+    @staticmethod
+    def stage(relpath, sha256, placed, path):
+        """
+        Record the hash of the file for UPLOAD_DIR/relpath just placed at
+        `placed`; it can be found at `path` once its batch is sealed.
+        """
+        st = os.stat(placed)
+        name = relpath.replace(os.sep, "/")
+        rec = {"name": name, "sha256": sha256, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+               "path": path}
+        with ImageIndex._lock:
+            ImageIndex._load_staged()[name] = (sha256, st.st_size, st.st_mtime_ns, path)
+            with open(config.UPLOAD_HASHES, "a", encoding="utf-8") as f:
+                f.write(json.dumps(rec) + "\n")
+
+    @staticmethod
+    def staged_hash(relpath, key):
+        """
+        Returns the SHA-256 of the staged file if it was recorded for the
+        file as it is now (`key` is (size, mtime_ns)), else None.
+        """
+        with ImageIndex._lock:
+            rec = ImageIndex._load_staged().get(relpath.replace(os.sep, "/"))
+        if rec is not None and (rec[1], rec[2]) == tuple(key):
+            return rec[0]
+        return None
+
+    @staticmethod
+    def _staged_file(name, rec):
+        for path in (os.path.join(config.UPLOAD_DIR, name), rec[3]):
+            try:
+                st = os.stat(path) if path else None
+            except OSError:
+                continue
+            if st is not None and (st.st_size, st.st_mtime_ns) == (rec[1], rec[2]):
+                return path
+        return None
+
+    @staticmethod
+    def staged_file(name):
+        """
+        Returns where the staged file `name` with its recorded content is,
+        or None.
+        """
+        with ImageIndex._lock:
+            rec = ImageIndex._load_staged().get(name)
+        return ImageIndex._staged_file(name, rec) if rec is not None else None
+
+    @staticmethod
+    def prune_staged():
+        """
+        Drop records of staged files that were committed or replaced and
+        rewrite UPLOAD_HASHES with what is left.
+        """
+        with ImageIndex._lock:
+            staged = ImageIndex._load_staged()
+            for name, rec in list(staged.items()):
+                if ImageIndex._staged_file(name, rec) is None:
+                    del staged[name]
+            tmp = config.UPLOAD_HASHES + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                for name, (sha256, size, mtime_ns, path) in staged.items():
+                    f.write(json.dumps({"name": name, "sha256": sha256, "size": size,
+                                        "mtime_ns": mtime_ns, "path": path}) + "\n")
+            os.replace(tmp, config.UPLOAD_HASHES)
+
+    @staticmethod
+    def staged_with(sha256):
+        """
+        Returns the staged relpaths currently holding content `sha256`.
+        """
+        with ImageIndex._lock:
+            candidates = [(name, rec) for name, rec in ImageIndex._load_staged().items()
+                          if rec[0] == sha256]
+        return [name for name, rec in candidates if ImageIndex._staged_file(name, rec)]
+
+    # ------------------------------------------------------------------
+    # image contents
+
+    @staticmethod
+    def _path(image):
+        return os.path.join(config.IMAGE_INDEX_DIR, os.path.basename(image) + ".json")
+
+    @staticmethod
+    def manifest(image):
+        """
+        Returns the stored index document of `image` ({"inode", "files",
+        "summary", ...}), or None if there is none or the image file was
+        replaced since it was written.
+        """
+        try:
+            with open(ImageIndex._path(image), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("inode") == os.stat(image).st_ino and isinstance(data.get("files"), dict):
+                return data
+        except (OSError, ValueError):
+            pass
+        return None
+
+    @staticmethod
+    def load(image):
+        """
+        Returns the index of `image` ({} if there is none or the image file
+        was replaced since it was written).
+        """
+        data = ImageIndex.manifest(image)
+        return data["files"] if data is not None else {}
+
+    @staticmethod
+    def save(image, index, summary=None):
+        os.makedirs(config.IMAGE_INDEX_DIR, exist_ok=True)
+        path = ImageIndex._path(image)
+        tmp = path + ".tmp"
+        st = os.stat(image)
+        data = {"inode": st.st_ino, "files": index}
+        if summary is not None:
+            data["summary"] = summary
+            data["image_mtime_ns"] = st.st_mtime_ns
+        else:
+            # keep the last summary; status() reports it stale until the
+            # next rebuild() or update()
+            old = ImageIndex.manifest(image)
+            if old is not None and "summary" in old:
+                data["summary"] = old["summary"]
+                data["image_mtime_ns"] = old["image_mtime_ns"]
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    @staticmethod
+    def rebuild(image):
+        """
+        Re-read the directory tree of `image` into a full manifest, keeping
+        the hashes of entries that haven't changed. The image must not be
+        written meanwhile.
+        """
+        old = ImageIndex.load(image)
+        files = {}
+        try:
+            with FAT32Image(image, writable=False) as img:
+                for path, entry in img.walk():
+                    if entry.is_dir:
+                        continue
+                    key = ImageIndex.key(path)
+                    rec = old.get(key)
+                    sha256 = rec[0] if rec and ImageIndex.identical(
+                        old, path, rec[0], entry.size, entry.mtime) else None
+                    files[key] = [sha256, entry.size, entry.mtime, path,
+                                  -(-entry.size // img.cluster_size)]
+                summary = ImageIndex._summary(img, len(files))
+        except (OSError, ValueError) as e:
+            print(f"ImageIndex: can't read {image} ({e}), manifest not updated")
+            return
+        ImageIndex.save(image, files, summary)
+
+    @staticmethod
+    def _summary(img, count):
+        free = img.free_bytes()
+        total = img.cluster_count * img.cluster_size
+        return {
+            "files": count,
+            "used_bytes": total - free,
+            "free_bytes": free,
+            "total_bytes": total,
+            "cluster_size": img.cluster_size,
+            "updated": time.time(),
+        }
+
+    @staticmethod
+    def _lookup(img, relpath):
+        """
+        Returns (path as named in the image, FATEntry) for `relpath`, or
+        (None, None) if it doesn't exist.
+        """
+        path = ""
+        entry = None
+        for part in relpath.replace(os.sep, "/").split("/"):
+            if entry is not None and not entry.is_dir:
+                return None, None
+            entry = img.stat(f"{path}/{part}" if path else part)
+            if entry is None:
+                return None, None
+            path = f"{path}/{entry.name}" if path else entry.name
+        return path, entry
+
+    @staticmethod
+    def update(image, relpaths):
+        """
+        Re-read only the entries `relpaths` of `image` (written or removed
+        since the manifest was made) and the free space into its manifest.
+        Only valid if nothing else changed the image meanwhile; falls back
+        to rebuild() if there is no full manifest to update.
+        """
+        data = ImageIndex.manifest(image)
+        if data is None or "summary" not in data:
+            ImageIndex.rebuild(image)
+            return
+        files = data["files"]
+        try:
+            with FAT32Image(image, writable=False) as img:
+                for relpath in relpaths:
+                    key = ImageIndex.key(relpath)
+                    path, entry = ImageIndex._lookup(img, relpath)
+                    if entry is None or entry.is_dir:
+                        files.pop(key, None)
+                        continue
+                    rec = files.get(key)
+                    sha256 = rec[0] if rec and ImageIndex.identical(
+                        files, path, rec[0], entry.size, entry.mtime) else None
+                    files[key] = [sha256, entry.size, entry.mtime, path,
+                                  -(-entry.size // img.cluster_size)]
+                summary = ImageIndex._summary(img, len(files))
+        except (OSError, ValueError) as e:
+            print(f"ImageIndex: can't read {image} ({e}), manifest not updated")
+            return
+        ImageIndex.save(image, files, summary)
+
+    @staticmethod
+    def status(image):
+        """
+        Returns the manifest summary of `image` plus whether the image file
+        changed since (e.g. written by the host), or None without a manifest.
+        """
+        data = ImageIndex.manifest(image)
+        if data is None or "summary" not in data:
+            return None
+        try:
+            stale = os.stat(image).st_mtime_ns != data["image_mtime_ns"]
+        except OSError:
+            stale = True
+        return dict(data["summary"], stale=stale)
+
+    @staticmethod
+    def listing(image, prefix=""):
+        """
+        Returns [{"name", "size", "mtime", "sha256", "clusters"}, ...] from
+        the manifest of `image`, sorted by name, optionally only below
+        directory `prefix`.
+        """
+        prefix = prefix.strip("/").lower()
+        out = []
+        for key, rec in ImageIndex.load(image).items():
+            if prefix and not key.startswith(prefix + "/"):
+                continue
+            out.append({"name": rec[3], "size": rec[1], "mtime": rec[2], "sha256": rec[0],
+                        "clusters": rec[4] if len(rec) > 4 else None})
+        out.sort(key=lambda f: f["name"].lower())
+        return out
+
+    @staticmethod
+    def reset(image):
+        try:
+            os.remove(ImageIndex._path(image))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def copy(src, dst):
+        """
+        Carry the index of `src` over to `dst` after dst became a copy of it.
+        """
+        ImageIndex.save(dst, ImageIndex.load(src))
+
+    @staticmethod
+    def record(index, relpath, sha256, size, mtime):
+        """
+        Note that `relpath` in the image now holds content `sha256` (None
+        if unknown).
+        """
+        index[ImageIndex.key(relpath)] = [sha256, size, mtime, relpath.replace(os.sep, "/")]
+
+    @staticmethod
+    def identical(index, relpath, sha256, size, mtime):
+        """
+        True if the image entry for `relpath` (currently `size` bytes,
+        modified at `mtime`) is known to hold content `sha256`.
+        """
+        rec = index.get(ImageIndex.key(relpath))
+        # FAT keeps mtimes with 2 s resolution
+        return (sha256 is not None and rec is not None and rec[0] == sha256
+                and rec[1] == size and abs(rec[2] - mtime) <= 2)
+
+    @staticmethod
+    def names(index, sha256):
+        """
+        Returns the image paths recorded with content `sha256`.
+        """
+        return [rec[3] for rec in index.values() if sha256 is not None and rec[0] == sha256]
+
+    @staticmethod
+    def find(sha256, images):
+        """
+        Returns {"staged": [relpath, ...], "image": [relpath, ...]} for
+        content `sha256` across the staging area and `images`.
+        """
+        found = []
+        for image in images:
+            for name in ImageIndex.names(ImageIndex.load(image), sha256):
+                if name not in found:
+                    found.append(name)
+        return {"staged": ImageIndex.staged_with(sha256), "image": found}
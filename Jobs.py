@@ -0,0 +1,181 @@
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import config
+from Metrics import Metrics
+from Profiler import Profiler
+
+
+class Job:
+    def __init__(self, kind, func, coalesce=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.func = func
+        self.coalesce = coalesce
+        self.requests = 1
+        self.not_before = 0
+        self.deadline = 0
+        if coalesce:
+            now = time.monotonic()
+            self.not_before = now + config.COMMIT_COALESCE_MS / 1000.0
+            self.deadline = now + config.COMMIT_COALESCE_MAX_MS / 1000.0
+        self.state = "queued"
+        self.phase = None
+        self.bytes_copied = 0
+        self.files_copied = 0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "requests": self.requests,
+            "state": self.state,
+            "phase": self.phase,
+            "bytes_copied": self.bytes_copied,
+            "files_copied": self.files_copied,
+            "result": self.result,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+        }
+
+
+class Jobs:
+    """
+    Single background worker that owns all USBStorage/USBGadget operations.
+    Requests submit a job and get its id back right away; the worker runs
+    jobs one at a time in submission order. Code running inside a job
+    reports progress through Jobs.phase() and Jobs.progress().
+
+    Coalescing jobs (commit, clear) are debounced: a request that arrives
+    while an identical job is still queued at the tail of the queue joins
+    that job instead of adding another, and a queued job waits until no
+    new request joined it for COMMIT_COALESCE_MS (at most
+    COMMIT_COALESCE_MAX_MS). Since a job only looks at the staging area
+    once it starts, every joined request's files are included and all of
+    them see the same completion.
+    """
+
+    _lock = threading.Lock()
+    _wakeup = threading.Condition(_lock)
+    _queue = deque()
+    _jobs = OrderedDict()
+    _worker = None
+    _current = threading.local()
+
+    @staticmethod
+    def submit(kind, func, coalesce=False):
+        with Jobs._lock:
+            tail = Jobs._queue[-1] if Jobs._queue else None
+            if coalesce and tail is not None and tail.coalesce and tail.kind == kind:
+                tail.requests += 1
+                Metrics.inc("receiveit_job_requests_coalesced_total", kind=kind)
+                tail.not_before = min(
+                    time.monotonic() + config.COMMIT_COALESCE_MS / 1000.0, tail.deadline)
+                return tail
+            job = Job(kind, func, coalesce)
+            Jobs._jobs[job.id] = job
+            while len(Jobs._jobs) > max(int(config.JOBS_HISTORY), 1):
+                oldest = next(iter(Jobs._jobs.values()))
+                if not oldest.done.is_set():
+                    break
+                Jobs._jobs.popitem(last=False)
+            Jobs._queue.append(job)
+            if Jobs._worker is None or not Jobs._worker.is_alive():
+                Jobs._worker = threading.Thread(target=Jobs._run, name="jobs", daemon=True)
+                Jobs._worker.start()
+            Jobs._wakeup.notify()
+        return job
+
+    @staticmethod
+    def get(job_id):
+        with Jobs._lock:
+            return Jobs._jobs.get(job_id)
+
+    @staticmethod
+    def recent():
+        with Jobs._lock:
+            return list(Jobs._jobs.values())
+
+    @staticmethod
+    def _run():
+        while True:
+            with Jobs._lock:
+                while True:
+                    while not Jobs._queue:
+                        Jobs._wakeup.wait()
+                    delay = Jobs._queue[0].not_before - time.monotonic()
+                    if delay <= 0:
+                        break
+                    Jobs._wakeup.wait(delay)
+                job = Jobs._queue.popleft()
+            Jobs._execute(job)
+
+    @staticmethod
+    def _execute(job):
+        job.state = "running"
+        job.started = time.time()
+        Jobs._current.job = job
+        try:
+            with Profiler.profile(job.kind):
+                job.result = job.func()
+            job.state = "done"
+        except Exception as e:
+            job.state = "failed"
+            job.error = str(e) or e.__class__.__name__
+            print(f"Jobs: {job.kind} job {job.id} failed")
+            traceback.print_exc()
+        finally:
+            Jobs._current.job = None
+            job.phase = None
+            job.finished = time.time()
+            Metrics.inc("receiveit_jobs_total", kind=job.kind, state=job.state)
+            Metrics.observe("receiveit_job_seconds", job.finished - job.started, kind=job.kind)
+            job.done.set()
+
+    @staticmethod
+    def current():
+        return getattr(Jobs._current, "job", None)
+
+    @staticmethod
+    @contextmanager
+    def phase(name):
+        """
+        Mark the running job (if any) as being in phase `name` and record
+        how long the phase took.
+        """
+        job = Jobs.current()
+        previous = job.phase if job is not None else None
+        if job is not None:
+            job.phase = name
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            Metrics.observe("receiveit_phase_seconds", time.monotonic() - started,
+                            job=job.kind if job is not None else "", phase=name)
+            if job is not None:
+                job.phase = previous
+
+    @staticmethod
+    def progress(nbytes, files=1):
+        """
+        Count `files` files of `nbytes` bytes as written into an image;
+        files left alone (dedup, unchanged) aren't reported.
+        """
+        Metrics.inc("receiveit_commit_bytes_total", nbytes)
+        Metrics.inc("receiveit_commit_files_total", files)
+        job = Jobs.current()
+        if job is not None:
+            job.bytes_copied += nbytes
+            job.files_copied += files
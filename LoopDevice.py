@@ -0,0 +1,188 @@
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import struct
+import threading
+from FAT32Image import FAT32Image
+from Profiler import Profiler
+
+
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_SET_STATUS64 = 0x4C04
+LOOP_CONFIGURE = 0x4C0A
+LOOP_CTL_GET_FREE = 0x4C82
+LO_FLAGS_AUTOCLEAR = 4
+BLKFLSBUF = 0x1261
+
+# struct loop_info64: device, inode, rdevice, offset, sizelimit, number,
+# encrypt_type, encrypt_key_size, flags, file_name, crypt_name, encrypt_key, init
+_LOOP_INFO64 = "<5Q4I64s64s32s2Q"
+# struct loop_config is {fd, block_size, loop_info64, 8 reserved u64}
+
+
+class LoopDevice:
+    """
+    Loop devices and mounts without losetup/mount(8): devices are taken from
+    /dev/loop-control and configured with LOOP_CONFIGURE (LOOP_SET_FD +
+    LOOP_SET_STATUS64 on kernels before 5.8), filesystems are mounted with
+    mount(2)/umount2(2).
+
+    Instead of scanning partitions and waiting for /dev/loopXp1 to appear,
+    the device starts at the FAT partition (lo_offset), so it can be mounted
+    as soon as it is configured. Devices are kept in a pool, one per image,
+    for the life of the process and rebound only when the image file is
+    replaced. They are bound with LO_FLAGS_AUTOCLEAR, so the kernel frees
+    them when the process exits.
+    """
+
+    _lock = threading.Lock()
+    # abspath -> (loop fd, device, (st_dev, st_ino) of the image)
+    _pool = {}
+    _libc = None
+
+    @staticmethod
+    def _c():
+        if LoopDevice._libc is None:
+            LoopDevice._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                                           use_errno=True)
+        return LoopDevice._libc
+
+    @staticmethod
+    def _configure(loop_fd, backing_fd, offset, name):
+        info = struct.pack(_LOOP_INFO64, 0, 0, 0, offset, 0, 0, 0, 0,
+                           LO_FLAGS_AUTOCLEAR, os.fsencode(name)[-63:], b"", b"", 0, 0)
+        try:
+            fcntl.ioctl(loop_fd, LOOP_CONFIGURE,
+                        struct.pack("<II", backing_fd, 0) + info + bytes(8 * 8))
+            return
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOTTY):
+                raise
+        # pre-5.8 kernels: two steps
+        fcntl.ioctl(loop_fd, LOOP_SET_FD, backing_fd)
+        try:
+            fcntl.ioctl(loop_fd, LOOP_SET_STATUS64, info)
+        except OSError:
+            fcntl.ioctl(loop_fd, LOOP_CLR_FD, 0)
+            raise
+
+    @staticmethod
+    def _bind(image, offset):
+        backing_fd = os.open(image, os.O_RDWR | os.O_CLOEXEC)
+        try:
+            ctl = os.open("/dev/loop-control", os.O_RDWR | os.O_CLOEXEC)
+            try:
+                # another process may grab the same free device; retry
+                for _ in range(8):
+                    n = fcntl.ioctl(ctl, LOOP_CTL_GET_FREE)
+                    dev = f"/dev/loop{n}"
+                    loop_fd = os.open(dev, os.O_RDWR | os.O_CLOEXEC)
+                    try:
+                        LoopDevice._configure(loop_fd, backing_fd, offset, image)
+                        return loop_fd, dev
+                    except OSError as e:
+                        os.close(loop_fd)
+                        if e.errno != errno.EBUSY:
+                            raise
+                raise OSError(errno.EBUSY, "no free loop device")
+            finally:
+                os.close(ctl)
+        finally:
+            # the loop device holds its own reference to the file
+            os.close(backing_fd)
+
+    @staticmethod
+    def get(image, offset=None):
+        """
+        Returns the loop device bound to `image`, binding a free one at the
+        FAT partition (or `offset`) if needed. Raises OSError if loop
+        devices are unavailable.
+        """
+        image = os.path.abspath(image)
+        st = os.stat(image)
+        with LoopDevice._lock:
+            entry = LoopDevice._pool.get(image)
+            if entry and entry[2] == (st.st_dev, st.st_ino):
+                return entry[1]
+            if entry:
+                # image was replaced underneath us
+                LoopDevice._release(image)
+            if offset is None:
+                with open(image, "rb") as f:
+                    try:
+                        offset = FAT32Image.partition_offset(f)
+                    except ValueError:
+                        offset = 0
+            with Profiler.span("loop_bind", image=image, offset=offset):
+                loop_fd, dev = LoopDevice._bind(image, offset)
+            LoopDevice._pool[image] = (loop_fd, dev, (st.st_dev, st.st_ino))
+            print(f"LoopDevice: bound {image} at offset {offset} to {dev}")
+            return dev
+
+    @staticmethod
+    def bound(image):
+        return os.path.abspath(image) in LoopDevice._pool
+
+    @staticmethod
+    def _release(image):
+        loop_fd, dev, _ = LoopDevice._pool.pop(image)
+        try:
+            fcntl.ioctl(loop_fd, LOOP_CLR_FD, 0)
+        except OSError:
+            # still mounted; autoclear detaches it on unmount
+            pass
+        os.close(loop_fd)
+
+    @staticmethod
+    def release(image):
+        """
+        Unbind the loop device of `image`, if any.
+        """
+        with LoopDevice._lock:
+            if os.path.abspath(image) in LoopDevice._pool:
+                LoopDevice._release(os.path.abspath(image))
+
+    @staticmethod
+    def sync(image):
+        """
+        Write back what was written through the loop device into the image
+        file (nothing else closes the device while it is pooled).
+        """
+        entry = LoopDevice._pool.get(os.path.abspath(image))
+        if entry:
+            os.fsync(entry[0])
+
+    @staticmethod
+    def invalidate(image):
+        """
+        Drop the loop device's buffer cache, so a mount sees changes made
+        to the image file since it was last mounted (BLKFLSBUF).
+        """
+        entry = LoopDevice._pool.get(os.path.abspath(image))
+        if entry:
+            fcntl.ioctl(entry[0], BLKFLSBUF, 0)
+
+    @staticmethod
+    def mount(dev, target, fstype="vfat", flags=0, data=None):
+        with Profiler.span("mount", dev=dev, target=target):
+            if LoopDevice._c().mount(os.fsencode(dev), os.fsencode(target), fstype.encode(),
+                                     ctypes.c_ulong(flags),
+                                     data.encode() if data else None) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, f"mount {dev} on {target}: {os.strerror(err)}")
+
+    @staticmethod
+    def umount(target):
+        """
+        Unmount `target`; returns False if nothing was mounted there.
+        """
+        with Profiler.span("umount", target=target):
+            if LoopDevice._c().umount2(os.fsencode(target), 0) != 0:
+                err = ctypes.get_errno()
+                if err == errno.EINVAL:
+                    return False
+                raise OSError(err, f"umount {target}: {os.strerror(err)}")
+        return True
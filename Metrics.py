@@ -0,0 +1,137 @@
+import math
+import threading
+
+
+_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+_BYTES_PER_SECOND = tuple(2 ** n * 1024 * 1024 for n in range(-2, 8))  # 256 KiB/s .. 128 MiB/s
+
+
+class Metrics:
+    """
+    In-process counters, histograms and scrape-time gauges, rendered in the
+    Prometheus text format by /metrics. Updating a metric is a dict lookup
+    and an add under one lock, so instrumentation stays on permanently;
+    gauges are only evaluated when scraped.
+    """
+
+    _lock = threading.Lock()
+    # name -> (type, help, buckets)
+    _meta = {}
+    # name -> {label tuple: value} for counters, {label tuple: [bucket counts..., sum, count]}
+    # for histograms
+    _values = {}
+    # name -> callable returning [(labels dict, value), ...]
+    _gauges = {}
+
+    @staticmethod
+    def counter(name, help):
+        Metrics._meta[name] = ("counter", help, None)
+        Metrics._values[name] = {}
+
+    @staticmethod
+    def histogram(name, help, buckets=_SECONDS):
+        Metrics._meta[name] = ("histogram", help, tuple(buckets))
+        Metrics._values[name] = {}
+
+    @staticmethod
+    def gauge(name, help, func):
+        Metrics._meta[name] = ("gauge", help, None)
+        Metrics._gauges[name] = func
+
+    @staticmethod
+    def inc(name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with Metrics._lock:
+            values = Metrics._values[name]
+            values[key] = values.get(key, 0) + value
+
+    @staticmethod
+    def observe(name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        buckets = Metrics._meta[name][2]
+        with Metrics._lock:
+            values = Metrics._values[name]
+            counts = values.get(key)
+            if counts is None:
+                counts = values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs:
+            return ""
+        escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+                   for _, v in pairs)
+        return "{" + ",".join(f"{k}=\"{v}\"" for (k, _), v in zip(pairs, escaped)) + "}"
+
+    @staticmethod
+    def _number(value):
+        if value == math.inf:
+            return "+Inf"
+        if isinstance(value, float) and value.is_integer() and abs(value) < 2 ** 53:
+            return str(int(value))
+        return repr(value) if isinstance(value, float) else str(value)
+
+    @staticmethod
+    def render():
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        with Metrics._lock:
+            snapshot = {name: {k: (list(v) if isinstance(v, list) else v) for k, v in values.items()}
+                        for name, values in Metrics._values.items()}
+        for name, (kind, help, buckets) in Metrics._meta.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "gauge":
+                try:
+                    samples = Metrics._gauges[name]()
+                except Exception as e:
+                    print(f"Metrics: gauge {name} failed: {e}")
+                    samples = []
+                for labels, value in samples:
+                    if value is not None:
+                        lines.append(f"{name}{Metrics._labels(tuple(sorted(labels.items())))} "
+                                     f"{Metrics._number(value)}")
+                continue
+            for key, value in snapshot[name].items():
+                if kind == "counter":
+                    lines.append(f"{name}{Metrics._labels(key)} {Metrics._number(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (math.inf,), value[:-2] + [value[-1] - sum(value[:-2])]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{Metrics._labels(key + (('le', Metrics._number(bound)),))} "
+                                 f"{cumulative}")
+                lines.append(f"{name}_sum{Metrics._labels(key)} {Metrics._number(value[-2])}")
+                lines.append(f"{name}_count{Metrics._labels(key)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+Metrics.counter("receiveit_upload_bytes_total", "Bytes received by upload endpoints.")
+Metrics.counter("receiveit_upload_files_total", "Files staged by upload endpoints.")
+Metrics.histogram("receiveit_upload_seconds", "Duration of upload requests.")
+Metrics.histogram("receiveit_upload_throughput_bytes_per_second",
+                  "Throughput of upload requests.", _BYTES_PER_SECOND)
+Metrics.counter("receiveit_download_bytes_total", "Bytes sent back out of images by /files.")
+Metrics.counter("receiveit_jobs_total", "Finished background jobs.")
+Metrics.counter("receiveit_job_requests_coalesced_total",
+                "Requests merged into an already queued job.")
+Metrics.histogram("receiveit_job_seconds", "Duration of background jobs.")
+Metrics.histogram("receiveit_phase_seconds", "Time spent in each commit/clear phase.")
+Metrics.counter("receiveit_commit_bytes_total", "Bytes copied into images.")
+Metrics.counter("receiveit_commit_files_total", "Files copied into images.")
+Metrics.counter("receiveit_dedup_skipped_files_total",
+                "Staged files already in the image with identical content.")
+Metrics.counter("receiveit_dedup_skipped_bytes_total", "Bytes not copied thanks to dedup.")
+Metrics.counter("receiveit_configfs_writes_total",
+                "Gadget attribute updates, by result (written, skipped, failed).")
+Metrics.counter("receiveit_configfs_write_retries_total",
+                "Retried configfs writes (attribute busy).")
+Metrics.histogram("receiveit_media_swap_seconds", "Duration of mass storage media swaps.")
@@ -0,0 +1,194 @@
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import deque
+from contextlib import contextmanager
+import config
+
+
+class Profiler:
+    """
+    On-demand profiling of the upload/commit/clear paths plus an always-on
+    trace of the slow system calls underneath them.
+
+    Profiler.arm(n) (POST /debug/profile or SIGUSR2) makes the next `n`
+    operations of a PROFILE_KINDS kind run under cProfile, and under
+    tracemalloc if asked for. Each one leaves <time>-<kind>-<id>.prof
+    (pstats), .spans.json and .mem.txt in PROFILE_DIR, which keeps the
+    newest PROFILE_KEEP profiles.
+
+    Spans (every subprocess USBStorage runs, loop/mount calls and configfs
+    writes) are cheap enough to record all the time into a ring buffer of
+    the last TRACE_SPANS (GET /debug/trace); a profiled operation also
+    saves the spans it produced.
+    """
+
+    _lock = threading.Lock()
+    _armed = 0
+    _memory = False
+    _spans = deque(maxlen=max(int(config.TRACE_SPANS), 1))
+    # spans of the operation profiled on this thread, if any
+    _current = threading.local()
+
+    @staticmethod
+    def arm(count, memory=False):
+        """
+        Profile the next `count` operations (0 disarms).
+        """
+        with Profiler._lock:
+            Profiler._armed = max(int(count), 0)
+            Profiler._memory = bool(memory)
+        print(f"Profiler: armed for {Profiler._armed} operations"
+              f"{' with tracemalloc' if memory else ''}")
+
+    @staticmethod
+    def status():
+        with Profiler._lock:
+            armed, memory = Profiler._armed, Profiler._memory
+        try:
+            profiles = sorted(f for f in os.listdir(config.PROFILE_DIR) if f.endswith(".prof"))
+        except OSError:
+            profiles = []
+        return {"armed": armed, "memory": memory, "dir": config.PROFILE_DIR,
+                "profiles": profiles}
+
+    @staticmethod
+    def _take(kind):
+        if kind not in config.PROFILE_KINDS:
+            return None
+        with Profiler._lock:
+            if Profiler._armed <= 0:
+                return None
+            Profiler._armed -= 1
+            return Profiler._memory
+
+    @staticmethod
+    @contextmanager
+    def profile(kind):
+        """
+        Run the block under the profiler if profiling is armed and `kind`
+        is one of PROFILE_KINDS, else just run it.
+        """
+        memory = Profiler._take(kind)
+        if memory is None:
+            yield
+            return
+
+        spans = Profiler._current.spans = []
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # another thread's profile is running (one profiler per process)
+            prof = None
+        # tracemalloc is process wide: whoever started it stops it
+        traced = memory and not tracemalloc.is_tracing()
+        if traced:
+            tracemalloc.start(int(config.PROFILE_TRACEMALLOC_FRAMES))
+        before = tracemalloc.take_snapshot() if memory and tracemalloc.is_tracing() else None
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            seconds = time.monotonic() - started
+            if prof is not None:
+                prof.disable()
+            after = tracemalloc.take_snapshot() if before is not None else None
+            peak = tracemalloc.get_traced_memory()[1] if before is not None else None
+            if traced:
+                tracemalloc.stop()
+            Profiler._current.spans = None
+            try:
+                Profiler._save(kind, seconds, prof, spans, before, after, peak)
+            except Exception as e:
+                print(f"Profiler: can't write {kind} profile: {e}")
+
+    @staticmethod
+    def profiled(kind):
+        """
+        Decorator form of profile(), for Flask views.
+        """
+        def wrap(func):
+            def wrapper(*args, **kwargs):
+                with Profiler.profile(kind):
+                    return func(*args, **kwargs)
+            wrapper.__name__ = func.__name__
+            wrapper.__doc__ = func.__doc__
+            return wrapper
+        return wrap
+
+    @staticmethod
+    def _save(kind, seconds, prof, spans, before, after, peak):
+        os.makedirs(config.PROFILE_DIR, exist_ok=True)
+        stem = os.path.join(config.PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{kind}-"
+                                                f"{uuid.uuid4().hex[:6]}")
+        if prof is not None:
+            prof.dump_stats(stem + ".prof")
+        else:
+            # keep a marker, rotation and status() go by the .prof files
+            open(stem + ".prof", "wb").close()
+        with open(stem + ".spans.json", "w", encoding="utf-8") as f:
+            json.dump({"kind": kind, "seconds": seconds, "cprofile": prof is not None,
+                       "spans": spans}, f, indent=1)
+        if after is not None:
+            with open(stem + ".mem.txt", "w", encoding="utf-8") as f:
+                f.write(f"peak traced: {peak} bytes\n\ngrowth by line:\n")
+                for stat in after.compare_to(before, "lineno")[:50]:
+                    f.write(f"{stat}\n")
+                f.write("\nlargest at end:\n")
+                for stat in after.statistics("traceback")[:10]:
+                    f.write(f"{stat}\n")
+                    for line in stat.traceback.format():
+                        f.write(f"    {line}\n")
+        print(f"Profiler: {kind} took {seconds:.3f} s, profile in {stem}.*")
+        Profiler._rotate()
+
+    @staticmethod
+    def _rotate():
+        profiles = [f for f in os.listdir(config.PROFILE_DIR) if f.endswith(".prof")]
+        # names only have 1 s resolution
+        profiles.sort(key=lambda f: os.stat(os.path.join(config.PROFILE_DIR, f)).st_mtime_ns)
+        for name in profiles[:max(len(profiles) - max(int(config.PROFILE_KEEP), 1), 0)]:
+            stem = name[:-len(".prof")]
+            for ext in (".prof", ".spans.json", ".mem.txt"):
+                try:
+                    os.remove(os.path.join(config.PROFILE_DIR, stem + ext))
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    @contextmanager
+    def span(name, **attrs):
+        """
+        Record how long the block took as span `name` with `attrs`.
+        """
+        started = time.time()
+        t0 = time.monotonic()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = str(e) or e.__class__.__name__
+            raise
+        finally:
+            span = {"name": name, "start": started, "seconds": time.monotonic() - t0,
+                    "thread": threading.current_thread().name, **attrs}
+            if error is not None:
+                span["error"] = error
+            # deque.append is atomic, no lock needed
+            Profiler._spans.append(span)
+            spans = getattr(Profiler._current, "spans", None)
+            if spans is not None:
+                spans.append(span)
+
+    @staticmethod
+    def trace(limit=None):
+        """
+        Returns the most recent spans, oldest first.
+        """
+        spans = list(Profiler._spans)
+        return spans[-limit:] if limit else spans
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+import config
+from Metrics import Metrics
+from Staging import Staging
+
+
+class ResumableUpload:
+    """
+    Resumable uploads: a session is created for one file, byte ranges are
+    written at offsets and the session is finalized into UPLOAD_DIR. Each
+    session keeps its data in <id>.part and its state in <id>.json under
+    UPLOAD_SESSIONS_DIR. The recorded offset only moves forward after the
+    data up to it has been fsynced, so it survives a crash or power loss.
+    """
+
+    _lock = threading.Lock()
+    _session_locks = {}
+
+    @staticmethod
+    def _paths(upload_id):
+        if not upload_id or not all(c in "0123456789abcdef" for c in upload_id):
+            raise KeyError(upload_id)
+        base = os.path.join(config.UPLOAD_SESSIONS_DIR, upload_id)
+        return base + ".part", base + ".json"
+
+    @staticmethod
+    def _session_lock(upload_id):
+        with ResumableUpload._lock:
+            return ResumableUpload._session_locks.setdefault(upload_id, threading.Lock())
+
+    @staticmethod
+    def _save(state):
+        _, state_path = ResumableUpload._paths(state["id"])
+        state["updated"] = time.time()
+        tmp = state_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, state_path)
+
+    @staticmethod
+    def _load(upload_id, repair=False):
+        """
+        Read the session state. With `repair` (only while holding the
+        session lock: a running write may be past the recorded offset)
+        data beyond the recorded offset is cut off.
+        """
+        data_path, state_path = ResumableUpload._paths(upload_id)
+        try:
+            with open(state_path, "r") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            raise KeyError(upload_id)
+        try:
+            # anything past the recorded offset was never acknowledged
+            if repair and os.path.getsize(data_path) > state["offset"]:
+                os.truncate(data_path, state["offset"])
+            elif not os.path.exists(data_path):
+                state["offset"] = 0
+        except FileNotFoundError:
+            state["offset"] = 0
+        return state
+
+    @staticmethod
+    def expire():
+        """
+        Remove sessions that have not been written to for UPLOAD_SESSION_TTL.
+        """
+        try:
+            names = os.listdir(config.UPLOAD_SESSIONS_DIR)
+        except FileNotFoundError:
+            return
+        now = time.time()
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            upload_id = name[:-len(".json")]
+            try:
+                state = ResumableUpload._load(upload_id)
+                if now - state.get("updated", 0) > config.UPLOAD_SESSION_TTL:
+                    ResumableUpload.abort(upload_id)
+            except Exception:
+                pass
+
+    @staticmethod
+    def create(name, size=None):
+        """
+        Start a session for a file that will be stored as UPLOAD_DIR/name.
+        `size` is optional; when given, writes past it are refused and
+        finalize requires exactly that many bytes.
+        """
+        relpath = Staging.safe_relpath(name)
+        if relpath is None:
+            raise ValueError("invalid file name")
+        if size is not None:
+            size = int(size)
+            if size < 0:
+                raise ValueError("invalid size")
+
+        ResumableUpload.expire()
+        os.makedirs(config.UPLOAD_SESSIONS_DIR, exist_ok=True)
+        state = {
+            "id": uuid.uuid4().hex,
+            "name": relpath,
+            "size": size,
+            "offset": 0,
+            "created": time.time(),
+        }
+        data_path, _ = ResumableUpload._paths(state["id"])
+        open(data_path, "wb").close()
+        ResumableUpload._save(state)
+        return state
+
+    @staticmethod
+    def status(upload_id):
+        return ResumableUpload._load(upload_id)
+
+    @staticmethod
+    def write(upload_id, offset, stream):
+        """
+        Write the bytes read from `stream` at `offset`. The offset may point
+        anywhere up to the committed offset (re-sent bytes simply overwrite),
+        but never past it. Whatever was received before the stream broke off
+        is kept and committed. Returns the updated state.
+        """
+        with ResumableUpload._session_lock(upload_id):
+            state = ResumableUpload._load(upload_id, repair=True)
+            offset = int(offset)
+            if offset < 0 or offset > state["offset"]:
+                raise ValueError(f"offset must be between 0 and {state['offset']}")
+
+            data_path, _ = ResumableUpload._paths(upload_id)
+            bufsize = max(int(config.UPLOAD_BUFFER_SIZE), 64 * 1024)
+            limit = state["size"]
+            pos = offset
+            started = time.monotonic()
+            try:
+                with open(data_path, "r+b") as f:
+                    f.seek(offset)
+                    try:
+                        while True:
+                            chunk = stream.read(bufsize)
+                            if not chunk:
+                                break
+                            if limit is not None and pos + len(chunk) > limit:
+                                raise ValueError(f"data exceeds declared size {limit}")
+                            f.write(chunk)
+                            pos += len(chunk)
+                    finally:
+                        f.flush()
+                        os.fdatasync(f.fileno())
+            finally:
+                if pos > state["offset"]:
+                    state["offset"] = pos
+                    ResumableUpload._save(state)
+                Staging.account("resumable", pos - offset, time.monotonic() - started)
+            return state
+
+    @staticmethod
+    def finalize(upload_id, sha256=None):
+        """
+        Verify the session is complete, hash it and move it into UPLOAD_DIR.
+        Returns {"name", "size", "sha256"} of the placed file.
+        """
+        with ResumableUpload._session_lock(upload_id):
+            state = ResumableUpload._load(upload_id, repair=True)
+            if state["size"] is not None and state["offset"] != state["size"]:
+                raise ValueError(
+                    f"incomplete upload: {state['offset']} of {state['size']} bytes")
+
+            data_path, state_path = ResumableUpload._paths(upload_id)
+            digest = hashlib.sha256()
+            bufsize = max(int(config.UPLOAD_BUFFER_SIZE), 64 * 1024)
+            with open(data_path, "rb") as f:
+                while True:
+                    chunk = f.read(bufsize)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+            if sha256 and digest.hexdigest() != sha256.lower():
+                raise ValueError("sha256 mismatch")
+
+            Staging.place(data_path, state["name"], digest.hexdigest())
+            os.remove(state_path)
+            Metrics.inc("receiveit_upload_files_total", method="resumable")
+        with ResumableUpload._lock:
+            ResumableUpload._session_locks.pop(upload_id, None)
+        return {"name": state["name"], "size": state["offset"], "sha256": digest.hexdigest()}
+
+    @staticmethod
+    def abort(upload_id):
+        data_path, state_path = ResumableUpload._paths(upload_id)
+        found = False
+        for path in (data_path, state_path):
+            try:
+                os.remove(path)
+                found = True
+            except FileNotFoundError:
+                pass
+        with ResumableUpload._lock:
+            ResumableUpload._session_locks.pop(upload_id, None)
+        if not found:
+            raise KeyError(upload_id)
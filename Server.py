@@ -0,0 +1,88 @@
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.serving import BaseWSGIServer, make_server
+import config
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug's WSGI server with requests handed to a fixed-size worker
+    pool, so a slow upload never blocks other clients and the number of
+    threads (and their memory) stays bounded on the Pi. At most `backlog`
+    accepted connections wait for a free worker; beyond that the server
+    stops accepting and further clients queue in the kernel's listen
+    backlog instead of piling up in memory.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, backlog=0):
+        super().__init__(host, port, app)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+        self.slots = threading.BoundedSemaphore(threads + max(backlog, 0))
+
+    def process_request(self, request, client_address):
+        self.slots.acquire()
+        try:
+            self.pool.submit(self._process_request, request, client_address)
+        except Exception:
+            self.slots.release()
+            raise
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(wait=False)
+
+
+class Server:
+    @staticmethod
+    def notify(state):
+        """
+        Send a sd_notify(3) message (e.g. "READY=1") to systemd. No-op when
+        not started by systemd with Type=notify.
+        """
+        addr = os.environ.get("NOTIFY_SOCKET")
+        if not addr:
+            return False
+        if addr.startswith("@"):
+            addr = "\0" + addr[1:]
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+                sock.sendto(state.encode(), addr)
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def serve(app):
+        """
+        Serve `app` on SERVER_HOST:SERVER_PORT until interrupted.
+        """
+        if config.SERVER == "flask":
+            # what app.run() does, minus the reloader, but binding first so
+            # READY is only sent once clients can connect
+            server = make_server(config.SERVER_HOST, config.SERVER_PORT, app, threaded=True)
+            print(f"Server: listening on {config.SERVER_HOST}:{config.SERVER_PORT} "
+                  f"(Flask development server)")
+        else:
+            server = PooledWSGIServer(config.SERVER_HOST, config.SERVER_PORT, app,
+                                      max(1, int(config.SERVER_THREADS)), int(config.SERVER_BACKLOG))
+            print(f"Server: listening on {config.SERVER_HOST}:{config.SERVER_PORT} "
+                  f"with {server.pool._max_workers} workers")
+        # the socket is bound and listening: clients can connect from here on
+        Server.notify("READY=1")
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
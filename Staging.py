@@ -0,0 +1,186 @@
+import os
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import config
+from CommitJournal import CommitJournal
+from ImageIndex import ImageIndex
+from Metrics import Metrics
+
+
+class Staging:
+    """
+    Uploads are staged in batches: the files placed by one upload request
+    collect in UPLOAD_BATCHES_DIR/<batch>.open and the directory is renamed
+    to UPLOAD_BATCHES_DIR/<batch> (sealed) when the request ends. Only the
+    commit job moves sealed batches into UPLOAD_DIR (absorb()), so a commit
+    never sees half of a request and uploads keep running while it copies.
+    """
+
+    # batch directory of the upload request running on this thread
+    _current = threading.local()
+
+    @staticmethod
+    def safe_relpath(name):
+        """
+        Normalize a client supplied file name into a relative path below
+        UPLOAD_DIR. Returns None if the name is empty or would escape it.
+        """
+        if not name:
+            return None
+        parts = [p for p in name.replace("\\", "/").split("/")
+                 if p not in ("", ".")]
+        if not parts or ".." in parts:
+            return None
+        return os.path.join(*parts)
+
+    @staticmethod
+    def tmp_file():
+        """
+        Returns a fresh path in UPLOAD_TMP_DIR. The temp dir lives next to
+        UPLOAD_DIR so finished files can be moved into place with a rename.
+        """
+        os.makedirs(config.UPLOAD_TMP_DIR, exist_ok=True)
+        return os.path.join(config.UPLOAD_TMP_DIR, uuid.uuid4().hex + ".part")
+
+    @staticmethod
+    @contextmanager
+    def batch(seal=True):
+        """
+        Collect the files this thread places inside the block into one
+        batch and seal it when the block ends, also on errors: every file
+        placed is complete. Nested blocks join the outer batch. Yields the
+        batch path; with `seal` off the batch stays open at path + ".open"
+        for the caller to absorb() or discard(), and its name ends in
+        "-private" so seal_orphans() drops it instead of sealing it.
+        """
+        if getattr(Staging._current, "batch", None) is not None:
+            yield Staging._current.batch
+            return
+        # names sort in start order, which is the order commit absorbs them
+        path = os.path.join(config.UPLOAD_BATCHES_DIR,
+                            f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}"
+                            f"{'' if seal else '-private'}")
+        Staging._current.batch = path
+        try:
+            yield path
+        finally:
+            Staging._current.batch = None
+            if seal and os.path.isdir(path + ".open"):
+                os.replace(path + ".open", path)
+
+    @staticmethod
+    def place(tmp_path, relpath, sha256=None):
+        """
+        Atomically move a finished temp file to relpath in the current
+        batch; outside batch() the file is sealed as a batch of its own.
+        The SHA-256 of its content, if the caller computed it, goes into
+        the ImageIndex.
+        """
+        batch = getattr(Staging._current, "batch", None)
+        if batch is None:
+            with Staging.batch():
+                Staging.place(tmp_path, relpath, sha256)
+            return
+        dst = os.path.join(batch + ".open", relpath)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        os.replace(tmp_path, dst)
+        if sha256 is not None:
+            ImageIndex.stage(relpath, sha256, dst, os.path.join(batch, relpath))
+
+    @staticmethod
+    def absorb(batches=None, journal=True):
+        """
+        Move the files of every sealed batch (or of the batch directories
+        `batches`) into UPLOAD_DIR, oldest batch first, and mark them dirty
+        in the commit journal unless `journal` is off. Called by the commit
+        job only. Returns the relpaths moved.
+        """
+        if batches is None:
+            try:
+                batches = [os.path.join(config.UPLOAD_BATCHES_DIR, n)
+                           for n in sorted(os.listdir(config.UPLOAD_BATCHES_DIR))
+                           if not n.endswith(".open")]
+            except FileNotFoundError:
+                return []
+        moved = []
+        for batch in batches:
+            for root, dirs, files in os.walk(batch):
+                dirs.sort()
+                for f in sorted(files):
+                    rel = os.path.relpath(os.path.join(root, f), batch)
+                    dst = os.path.join(config.UPLOAD_DIR, rel)
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    os.replace(os.path.join(root, f), dst)
+                    if journal:
+                        CommitJournal.record(rel)
+                    moved.append(rel)
+            shutil.rmtree(batch, ignore_errors=True)
+        return moved
+
+    @staticmethod
+    def discard(batch):
+        """
+        Drop batch `batch` (path as yielded by batch()), open or sealed.
+        """
+        for path in (batch + ".open", batch):
+            shutil.rmtree(path, ignore_errors=True)
+
+    @staticmethod
+    def seal_orphans():
+        """
+        Seal batches left open by a previous run; whatever they hold was
+        placed complete. Unsealed (/publish) batches are discarded instead:
+        they were meant to be published all at once or not at all. Call
+        before serving uploads.
+        """
+        try:
+            names = os.listdir(config.UPLOAD_BATCHES_DIR)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(config.UPLOAD_BATCHES_DIR, name)
+            if name.endswith("-private.open"):
+                print(f"Staging: discarding unpublished batch {name}")
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.endswith(".open"):
+                print(f"Staging: sealing batch {name} left open")
+                os.replace(path, path[:-len(".open")])
+
+    @staticmethod
+    def pending():
+        """
+        Returns the number of sealed and still open batches.
+        """
+        try:
+            names = os.listdir(config.UPLOAD_BATCHES_DIR)
+        except FileNotFoundError:
+            names = []
+        open_ = sum(1 for n in names if n.endswith(".open"))
+        return {"sealed": len(names) - open_, "open": open_}
+
+    @staticmethod
+    def free_space():
+        """
+        Returns free bytes on the filesystem holding UPLOAD_DIR, or None.
+        """
+        try:
+            os.makedirs(config.UPLOAD_DIR, exist_ok=True)
+            return shutil.disk_usage(config.UPLOAD_DIR).free
+        except Exception:
+            return None
+
+    @staticmethod
+    def account(method, nbytes, seconds, files=0):
+        """
+        Record an upload request's volume and duration in Metrics.
+        """
+        Metrics.inc("receiveit_upload_bytes_total", nbytes, method=method)
+        if files:
+            Metrics.inc("receiveit_upload_files_total", files, method=method)
+        Metrics.observe("receiveit_upload_seconds", seconds, method=method)
+        if seconds > 0 and nbytes:
+            Metrics.observe("receiveit_upload_throughput_bytes_per_second",
+                            nbytes / seconds, method=method)
@@ -0,0 +1,85 @@
+import hashlib
+import os
+import time
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, File, MultipartDecoder, NeedData
+import config
+from Staging import Staging
+
+
+class StreamingUpload:
+    @staticmethod
+    def receive(stream, content_type, field="file"):
+        """
+        Parse a multipart/form-data body straight off the request stream and
+        write every `field` part into its staging file in a single pass,
+        hashing the data as it arrives. At most UPLOAD_BUFFER_SIZE bytes of
+        the body are held in memory at a time.
+
+        Returns a list of {"name", "size", "sha256"} dicts for stored files.
+        Raises ValueError on a malformed body and OSError on write failures;
+        the temp file of an interrupted part is removed in both cases.
+        """
+        mimetype, options = parse_options_header(content_type or "")
+        boundary = options.get("boundary")
+        if mimetype != "multipart/form-data" or not boundary:
+            raise ValueError("expected multipart/form-data with a boundary")
+
+        bufsize = max(int(config.UPLOAD_BUFFER_SIZE), 64 * 1024)
+        decoder = MultipartDecoder(
+            boundary.encode("latin-1"), max_form_memory_size=2 * bufsize)
+
+        started = time.monotonic()
+        stored = []
+        # state of the file part currently being written
+        out = None
+        tmp_path = None
+        relpath = None
+        digest = None
+        size = 0
+
+        try:
+            done = False
+            while not done:
+                event = decoder.next_event()
+                if isinstance(event, NeedData):
+                    chunk = stream.read(bufsize)
+                    decoder.receive_data(chunk if chunk else None)
+                elif isinstance(event, File):
+                    relpath = None
+                    if event.name == field:
+                        relpath = Staging.safe_relpath(event.filename)
+                    if relpath is not None:
+                        tmp_path = Staging.tmp_file()
+                        out = open(tmp_path, "wb")
+                        digest = hashlib.sha256()
+                        size = 0
+                elif isinstance(event, Data):
+                    if out is not None:
+                        out.write(event.data)
+                        digest.update(event.data)
+                        size += len(event.data)
+                        if not event.more_data:
+                            out.close()
+                            out = None
+                            Staging.place(tmp_path, relpath, digest.hexdigest())
+                            tmp_path = None
+                            stored.append({
+                                "name": relpath,
+                                "size": size,
+                                "sha256": digest.hexdigest(),
+                            })
+                elif isinstance(event, Epilogue):
+                    done = True
+        finally:
+            if out is not None:
+                out.close()
+            if tmp_path is not None:
+                try:
+                    os.remove(tmp_path)
+                except Exception:
+                    pass
+            Staging.account("streaming", sum(f["size"] for f in stored),
+                            time.monotonic() - started, len(stored))
+
+        return stored
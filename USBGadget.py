@@ -1,16 +1,26 @@
 import os
+import select
 import shutil
+import socket
 import time
 import config
+from Metrics import Metrics
+from Profiler import Profiler
 from USBStorage import USBStorage
 
 
 class USBGadget:
+    # attributes the kernel may change behind our back (e.g. the host
+    # ejecting the medium clears lun.N/file); always read before writing
+    _VOLATILE = ("file",)
+    _cache = {"dirs": set(), "attrs": {}, "links": set()}
+
     @staticmethod
     def _write(path, data):
         try:
-            with open(path, "w") as f:
-                f.write(str(data))
+            with Profiler.span("configfs_write", path=path, value=str(data)):
+                with open(path, "w") as f:
+                    f.write(str(data))
             return True
         except Exception:
             try:
@@ -44,19 +54,154 @@ class USBGadget:
                 pass
             return False
 
+    @staticmethod
+    def _write_retry(path, data, timeout=0.25):
+        """
+        _write() with short, growing back-off while configfs reports busy,
+        for at most `timeout` seconds.
+        """
+        deadline = time.monotonic() + timeout
+        delay = 0.005
+        while True:
+            if USBGadget._write(path, data):
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            Metrics.inc("receiveit_configfs_write_retries_total")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    @staticmethod
+    def _wait_until(predicate, timeout, interval=0.01):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
+        return True
+
+    @staticmethod
+    def udc_name():
+        """
+        Returns the UDC the gadget is bound to, or the first available one.
+        """
+        bound = (USBGadget._read(os.path.join(config.GADGET_PATH, "UDC")) or "").strip()
+        if bound:
+            return bound
+        try:
+            udcs = os.listdir(config.UDC_PATH)
+            return udcs[0] if udcs else None
+        except Exception:
+            return None
+
+    @staticmethod
+    def udc_state():
+        """
+        Returns the USB device state of the UDC ("configured", "suspended",
+        "not attached", ...) or None if unknown.
+        """
+        udc = USBGadget.udc_name()
+        if not udc:
+            return None
+        state = USBGadget._read(os.path.join(config.UDC_PATH, udc, "state"))
+        return state.strip() if state else None
+
+    @staticmethod
+    def _settle(seconds, done=None):
+        """
+        Give the host up to `seconds` to notice a media change, but only
+        while a host is connected and configured; with no host (cable
+        unplugged or bus suspended) there is nobody to wait for. Returns as
+        soon as `done()` reports the change observed, so `seconds` is only
+        an upper bound. Returns the time waited.
+        """
+        state = USBGadget.udc_state()
+        if state is not None and state != "configured":
+            return 0.0
+        if done is None:
+            time.sleep(seconds)
+            return seconds
+        started = time.monotonic()
+        USBGadget._wait_until(done, seconds, 0.02)
+        return time.monotonic() - started
+
+    @staticmethod
+    def _lun_empty(lun):
+        lun_file = os.path.join(config.GADGET_PATH, lun, "file")
+        return lambda: not (USBGadget._read(lun_file) or "").strip()
+
+    @staticmethod
+    def _host_read(path):
+        """
+        Returns a predicate that turns true once the host read `path` after
+        this call, seen as its atime moving (the LUN reads go through the
+        page cache like any reader), or None if the atime won't move: under
+        relatime only the first read after a write updates it, and with
+        noatime nothing does.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_atime_ns > max(st.st_mtime_ns, st.st_ctime_ns):
+            return None
+
+        def read():
+            try:
+                return os.stat(path).st_atime_ns > st.st_atime_ns
+            except OSError:
+                return False
+        return read
+
     @staticmethod
     def is_ready():
         """
         Returns True if configfs is available and at least one UDC is present.
         """
-        if not os.path.isdir("/sys/kernel/config"):
+        if not os.path.isdir(config.CONFIGFS_PATH):
             return False
         try:
-            udcs = os.listdir("/sys/class/udc")
+            udcs = os.listdir(config.UDC_PATH)
             return len(udcs) > 0
         except Exception:
             return False
 
+    @staticmethod
+    def wait_for_udc(timeout=None):
+        """
+        Block until is_ready() is True, woken by kernel uevents for the udc
+        subsystem instead of a fixed sleep. Falls back to polling every
+        UDC_POLL_INTERVAL seconds if the uevent socket can't be opened.
+        Returns False if `timeout` seconds pass first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        sock = None
+        try:
+            # NETLINK_KOBJECT_UEVENT, multicast group 1 (kernel events)
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, 15)
+            sock.bind((0, 1))
+        except (AttributeError, OSError):
+            sock = None
+        try:
+            # subscribe first, then check, so an event in between isn't lost
+            while not USBGadget.is_ready():
+                wait = config.UDC_POLL_INTERVAL
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return False
+                if sock is None:
+                    time.sleep(wait)
+                    continue
+                ready, _, _ = select.select([sock], [], [], wait)
+                if ready:
+                    # drain; any event is just a hint to re-check is_ready()
+                    sock.recv(8192)
+            return True
+        finally:
+            if sock is not None:
+                sock.close()
+
     @staticmethod
     def is_initialized():
         """
@@ -64,6 +209,121 @@ class USBGadget:
         """
         return os.path.isdir(config.GADGET_PATH)
 
+    @staticmethod
+    def spec(images=None):
+        """
+        Returns the desired gadget as a nested dict mirroring the configfs
+        tree below GADGET_PATH: dict values are directories, string values
+        are attributes, and a config's "functions" list names the functions
+        linked into it. `images` maps LUN numbers to backing files (default:
+        USBStorage.lun_images()).
+        """
+        if images is None:
+            images = dict(enumerate(USBStorage.lun_images()))
+        return {
+            "idVendor": "0x1d6b",
+            "idProduct": "0x0104",
+            "bcdDevice": "0x0100",
+            "bcdUSB": "0x0200",
+            "strings": {"0x409": {
+                "serialnumber": "receiveit",
+                "manufacturer": "receiveit",
+                "product": "ReceiveIt",
+            }},
+            "functions": {
+                "acm.usb0": {},
+                "mass_storage.0": USBGadget._luns_spec(images),
+            },
+            "configs": {"c.1": {
+                "MaxPower": "250",
+                "strings": {"0x409": {"configuration": "Config 1"}},
+                "functions": ["acm.usb0", "mass_storage.0"],
+            }},
+        }
+
+    @staticmethod
+    def _flatten(node, prefix="", dirs=None, attrs=None, links=None):
+        """
+        Flattens a spec into ordered lists of directories, (attribute, value)
+        pairs and (link, target) pairs, all relative to GADGET_PATH.
+        """
+        if dirs is None:
+            dirs, attrs, links = [], [], []
+        for name, value in node.items():
+            rel = os.path.join(prefix, name)
+            if isinstance(value, dict):
+                dirs.append(rel)
+                USBGadget._flatten(value, rel, dirs, attrs, links)
+            elif isinstance(value, list):
+                for fn in value:
+                    links.append((os.path.join(prefix, fn), os.path.join("functions", fn)))
+            else:
+                attrs.append((rel, str(value)))
+        return dirs, attrs, links
+
+    @staticmethod
+    def _cached():
+        """
+        Returns the cached view of the live configfs tree, dropping it if
+        the gadget has disappeared underneath us.
+        """
+        if not USBGadget.is_initialized():
+            USBGadget._cache = {"dirs": set(), "attrs": {}, "links": set()}
+        return USBGadget._cache
+
+    @staticmethod
+    def _set(rel, value):
+        """
+        Writes a gadget attribute only if it differs from the cached (or,
+        for volatile attributes, the live) value and confirms it by reading
+        it back. Returns True if the attribute now holds `value`.
+        """
+        cache = USBGadget._cached()["attrs"]
+        path = os.path.join(config.GADGET_PATH, rel)
+        if os.path.basename(rel) in USBGadget._VOLATILE or rel not in cache:
+            cur = USBGadget._read(path)
+            cache[rel] = cur.strip() if cur is not None else None
+        if cache[rel] == value:
+            Metrics.inc("receiveit_configfs_writes_total", result="skipped")
+            return True
+        cache.pop(rel, None)
+        if not USBGadget._write_retry(path, value):
+            Metrics.inc("receiveit_configfs_writes_total", result="failed")
+            return False
+        cur = USBGadget._read(path)
+        cache[rel] = cur.strip() if cur is not None else None
+        ok = cache[rel] == value
+        Metrics.inc("receiveit_configfs_writes_total", result="written" if ok else "failed")
+        return ok
+
+    @staticmethod
+    def apply(spec):
+        """
+        Brings configfs in line with `spec`, creating missing directories and
+        links and writing only the attributes that differ. Returns True if
+        every attribute was applied.
+        """
+        cache = USBGadget._cached()
+        dirs, attrs, links = USBGadget._flatten(spec)
+        for rel in [""] + dirs:
+            if rel not in cache["dirs"]:
+                if USBGadget._ensure_dir(os.path.join(config.GADGET_PATH, rel)):
+                    cache["dirs"].add(rel)
+        ok = True
+        for rel, value in attrs:
+            ok = USBGadget._set(rel, value) and ok
+        for rel, target in links:
+            if rel in cache["links"]:
+                continue
+            link = os.path.join(config.GADGET_PATH, rel)
+            try:
+                if not os.path.islink(link):
+                    os.symlink(os.path.join(config.GADGET_PATH, target), link)
+                cache["links"].add(rel)
+            except Exception:
+                ok = False
+        return ok
+
     @staticmethod
     def init():
         """
@@ -76,84 +336,21 @@ class USBGadget:
             # already created
             return
 
-        # ensure backing file exists
-        USBStorage.image_create()
-
-        # basic gadget attributes
-        USBGadget._ensure_dir(config.GADGET_PATH)
-        USBGadget._write(os.path.join(
-            config.GADGET_PATH, "idVendor"), "0x1d6b")
-        USBGadget._write(os.path.join(
-            config.GADGET_PATH, "idProduct"), "0x0104")
-        USBGadget._write(os.path.join(
-            config.GADGET_PATH, "bcdDevice"), "0x0100")
-        USBGadget._write(os.path.join(config.GADGET_PATH, "bcdUSB"), "0x0200")
-
-        # english strings
-        strings = os.path.join(config.GADGET_PATH, "strings", "0x409")
-        USBGadget._ensure_dir(strings)
-        USBGadget._write(os.path.join(strings, "serialnumber"), "receiveit")
-        USBGadget._write(os.path.join(strings, "manufacturer"), "receiveit")
-        USBGadget._write(os.path.join(strings, "product"), "ReceiveIt")
-
-        # configuration
-        cfg = os.path.join(config.GADGET_PATH, "configs", "c.1")
-        USBGadget._ensure_dir(cfg)
-        USBGadget._write(os.path.join(cfg, "MaxPower"), "250")
-        cfg_strings = os.path.join(cfg, "strings", "0x409")
-        USBGadget._ensure_dir(cfg_strings)
-        USBGadget._write(os.path.join(
-            cfg_strings, "configuration"), "Config 1")
-
-        # functions: acm (serial) and mass_storage
-        funcs = os.path.join(config.GADGET_PATH, "functions")
-        acm = os.path.join(funcs, "acm.usb0")
-        ms = os.path.join(funcs, "mass_storage.0")
-        USBGadget._ensure_dir(acm)
-        USBGadget._ensure_dir(ms)
-
-        # configure mass storage lun
-        lun_file = os.path.join(ms, "lun.0", "file")
-        # create lun.0 directory if required
-        USBGadget._ensure_dir(os.path.join(ms, "lun.0"))
-        USBGadget._write(lun_file, os.path.abspath(config.DATA_IMAGE))
-        # optional: mark removable
-        try:
-            USBGadget._write(os.path.join(ms, "lun.0", "removable"), "1")
-        except Exception:
-            pass
+        # ensure backing files exist
+        USBStorage.images_create()
 
-        # link functions into config
-        try:
-            acm_link = os.path.join(cfg, "acm.usb0")
-            ms_link = os.path.join(cfg, "mass_storage.0")
-            if not os.path.exists(acm_link):
-                os.symlink(acm, acm_link)
-            if not os.path.exists(ms_link):
-                os.symlink(ms, ms_link)
-        except Exception:
-            # best-effort linking; cleanup on failure below
-            pass
+        USBGadget.apply(USBGadget.spec())
 
         # bind gadget to first available UDC
-        udc_list = os.listdir("/sys/class/udc")
+        udc_list = os.listdir(config.UDC_PATH)
         if not udc_list:
             raise RuntimeError("no UDC available to bind gadget")
         udc = udc_list[0]
-        USBGadget._write(os.path.join(config.GADGET_PATH, "UDC"), udc)
+        USBGadget._set("UDC", udc)
 
-        # diagnostic prints: show what got written/read back for vendor/product and UDC
-        try:
-            with open(os.path.join(config.GADGET_PATH, "idVendor"), "r") as f:
-                v = f.read().strip()
-            with open(os.path.join(config.GADGET_PATH, "idProduct"), "r") as f:
-                p = f.read().strip()
-            print(f"USBGadget: idVendor={v} idProduct={p} bound_UDC={udc}")
-        except Exception:
-            try:
-                print("USBGadget: unable to read back idVendor/idProduct after init")
-            except Exception:
-                pass
+        attrs = USBGadget._cache["attrs"]
+        print(f"USBGadget: idVendor={attrs.get('idVendor')} "
+              f"idProduct={attrs.get('idProduct')} bound_UDC={attrs.get('UDC')}")
 
         # allow some time for host to enumerate
         time.sleep(0.1)
@@ -215,6 +412,7 @@ class USBGadget:
                 os.rmdir(config.GADGET_PATH)
             except Exception:
                 pass
+        USBGadget._cache = {"dirs": set(), "attrs": {}, "links": set()}
 
     @staticmethod
     def remove_mass_storage():
@@ -224,6 +422,7 @@ class USBGadget:
         """
         cfg = os.path.join(config.GADGET_PATH, "configs", "c.1")
         ms_link = os.path.join(cfg, "mass_storage.0")
+        USBGadget._cached()["links"].discard(os.path.join("configs", "c.1", "mass_storage.0"))
         try:
             if os.path.islink(ms_link) or os.path.exists(ms_link):
                 os.unlink(ms_link)
@@ -232,128 +431,158 @@ class USBGadget:
             return False
 
     @staticmethod
-    def add_mass_storage():
+    def _lun(lun):
+        return os.path.join("functions", "mass_storage.0", f"lun.{lun}")
+
+    @staticmethod
+    def _luns_spec(images):
         """
-        Ensure the mass_storage function exists, point its lun.0/file to the DATA_IMAGE and
-        link it into the active config. Safe to call when gadget/config already exists.
+        The LUN directories of the mass_storage function, one per
+        MASS_STORAGE_LUNS; only LUNs listed in `images` get a backing file.
         """
-        funcs = os.path.join(config.GADGET_PATH, "functions")
-        ms = os.path.join(funcs, "mass_storage.0")
-        USBGadget._ensure_dir(ms)
-        # ensure lun directory and set backing file
-        USBGadget._ensure_dir(os.path.join(ms, "lun.0"))
-        lun_file = os.path.join(ms, "lun.0", "file")
-        # try a few times to write the lun file in case the kernel/configfs is briefly busy
-        written = False
-        for _ in range(5):
-            if USBGadget._write(lun_file, os.path.abspath(config.DATA_IMAGE)):
-                written = True
-                break
-            time.sleep(0.05)
-        try:
-            USBGadget._write(os.path.join(ms, "lun.0", "removable"), "1")
-        except Exception:
-            pass
+        luns = {}
+        for n in range(max(1, config.MASS_STORAGE_LUNS)):
+            luns[f"lun.{n}"] = {"removable": "1"}
+            if n in images:
+                luns[f"lun.{n}"]["file"] = os.path.abspath(images[n])
+        return luns
 
-        cfg = os.path.join(config.GADGET_PATH, "configs", "c.1")
-        ms_link = os.path.join(cfg, "mass_storage.0")
-        try:
-            if not os.path.exists(ms_link):
-                os.symlink(ms, ms_link)
-                # small delay to allow host to notice the function (reduces race on re-enumeration)
-                time.sleep(0.05)
-            return written
-        except Exception:
-            return False
+    @staticmethod
+    def _mass_storage_spec(images=None):
+        """
+        The mass storage part of spec(); LUNs missing from `images` keep
+        their backing file.
+        """
+        return {
+            "functions": {"mass_storage.0": USBGadget._luns_spec(images or {})},
+            "configs": {"c.1": {"functions": ["mass_storage.0"]}},
+        }
+
+    @staticmethod
+    def add_mass_storage(images=None):
+        """
+        Ensure the mass_storage function exists, point its LUN files to the LUN images (or
+        the {lun: image} given) and link it into the active config. Safe to call when
+        gadget/config already exists.
+        """
+        if images is None:
+            images = dict(enumerate(USBStorage.lun_images()))
+        linked = os.path.join("configs", "c.1", "mass_storage.0") in USBGadget._cached()["links"]
+        ok = USBGadget.apply(USBGadget._mass_storage_spec(images))
+        if not linked:
+            # small delay to allow host to notice the function (reduces race on re-enumeration)
+            USBGadget._settle(0.05)
+        return ok
+
+    @staticmethod
+    def _ensure_mass_storage():
+        """
+        add_mass_storage() without touching the medium; with a warm cache
+        this performs no configfs writes at all.
+        """
+        return USBGadget.apply(USBGadget._mass_storage_spec())
+
+    @staticmethod
+    def _eject(lun):
+        """
+        Eject the LUN's medium (forced_eject if supported, else clear
+        lun/file) and wait until the kernel reports it gone.
+        """
+        lun_file = os.path.join(config.GADGET_PATH, lun, "file")
+        forced_eject_path = os.path.join(config.GADGET_PATH, lun, "forced_eject")
+        if not (USBGadget._read(lun_file) or "").strip():
+            # nothing loaded
+            return True
+        detached = False
+        if os.path.exists(forced_eject_path):
+            detached = USBGadget._write_retry(forced_eject_path, "1", 0.25)
+        if not detached:
+            detached = USBGadget._write_retry(lun_file, "", 0.5)
+        if detached:
+            detached = USBGadget._wait_until(
+                lambda: not (USBGadget._read(lun_file) or "").strip(), 0.5)
+        return detached
+
+    @staticmethod
+    def _attach(lun, path, timeout=1.0):
+        """
+        Point the LUN at `path` and wait until it reads back.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            if USBGadget._set(os.path.join(lun, "file"), path):
+                return True
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.02)
 
     @staticmethod
-    def replace_mass_storage_image(new_image_path):
+    def replace_mass_storage_image(new_image_path, lun=0):
         """
         Replace mass storage backing image without unbinding the gadget or
         removing the function symlink. We "eject" by writing an empty string to
-        the lun.0/file, then point it to the new image path. This triggers a
-        media change on the host without dropping the CDC ACM interface.
+        lun.N/file, then point it to the new image path. This triggers a
+        media change on the host without dropping the CDC ACM interface or
+        disturbing the other LUNs.
+
+        Waits are driven by the LUN attributes, the UDC state and the host
+        reading the new image: each step returns as soon as that is
+        observed, and the host settle windows (MEDIA_EJECT_SETTLE,
+        MEDIA_ATTACH_SETTLE) are only upper bounds that apply while a host
+        is actually connected.
         """
         if not USBGadget.is_initialized():
             # nothing to do — gadget not created
             return False
         try:
+            started = time.monotonic()
             # Ensure the mass_storage function exists and is linked
-            USBGadget.add_mass_storage()
-
-            funcs = os.path.join(config.GADGET_PATH, "functions")
-            ms = os.path.join(funcs, "mass_storage.0")
-            lun_dir = os.path.join(ms, "lun.0")
-            USBGadget._ensure_dir(lun_dir)
-            lun_file = os.path.join(lun_dir, "file")
+            USBGadget._ensure_mass_storage()
 
             # Step 1: forcibly eject current media if supported, otherwise clear file
-            detached = False
-            forced_eject_path = os.path.join(lun_dir, "forced_eject")
-            if os.path.exists(forced_eject_path):
-                for _ in range(5):
-                    if USBGadget._write(forced_eject_path, "1"):
-                        detached = True
-                        break
-                    time.sleep(0.05)
-            if not detached:
-                for _ in range(10):
-                    if USBGadget._write(lun_file, ""):
-                        detached = True
-                        break
-                    time.sleep(0.05)
-
-            # Give host a window to see media removal
-            time.sleep(0.4)
+            t0 = time.monotonic()
+            detached = USBGadget._eject(USBGadget._lun(lun))
+            t_eject = time.monotonic() - t0
+
+            # Give host a window to see media removal: done once lun.N/file
+            # reads back empty, the medium is gone and the host is told so
+            # (unit attention) on its next command
+            t_eject_settle = USBGadget._settle(config.MEDIA_EJECT_SETTLE,
+                                               USBGadget._lun_empty(USBGadget._lun(lun)))
 
             # Step 2: attach new image
             new_path = os.path.abspath(new_image_path)
-            attached = False
-            for _ in range(10):
-                if USBGadget._write(lun_file, new_path):
-                    attached = True
-                    break
-                time.sleep(0.1)
-
-            # Optional: verify write by reading back
-            if attached:
-                cur = (USBGadget._read(lun_file) or "").strip()
-                if cur != new_path:
-                    attached = False
-
-            # Nudge host
-            time.sleep(1.4)
+            host_read = USBGadget._host_read(new_path)
+            t0 = time.monotonic()
+            attached = USBGadget._attach(USBGadget._lun(lun), new_path)
+            t_attach = time.monotonic() - t0
+
+            # Nudge host: done once it has read the new medium, bounded by
+            # MEDIA_ATTACH_SETTLE where that can't be observed
+            t_attach_settle = USBGadget._settle(config.MEDIA_ATTACH_SETTLE,
+                                                host_read if attached else None)
 
             # Fallback: if attach didn't stick, briefly unlink/relink function to force re-enum
             if not attached:
-                cfg = os.path.join(config.GADGET_PATH, "configs", "c.1")
-                ms_link = os.path.join(cfg, "mass_storage.0")
-                try:
-                    if os.path.islink(ms_link) or os.path.exists(ms_link):
-                        os.unlink(ms_link)
-                    time.sleep(0.1)
-                except Exception:
-                    pass
-                # ensure file points to new image
-                USBGadget._write(lun_file, new_path)
-                try:
-                    if not os.path.exists(ms_link):
-                        os.symlink(ms, ms_link)
-                        time.sleep(0.2)
-                except Exception:
-                    pass
-                # final readback check
-                cur2 = (USBGadget._read(lun_file) or "").strip()
-                attached = (cur2 == new_path)
-
+                USBGadget.remove_mass_storage()
+                USBGadget._settle(0.1)
+                # ensure file points to new image, then relink
+                attached = USBGadget.add_mass_storage({lun: new_path})
+                USBGadget._settle(0.2)
+
+            Metrics.observe("receiveit_media_swap_seconds", time.monotonic() - started)
+            print(f"USBGadget: media swap lun={lun} udc_state={USBGadget.udc_state()} "
+                  f"eject={t_eject:.3f}s eject_settle={t_eject_settle:.3f}s "
+                  f"attach={t_attach:.3f}s attach_settle={t_attach_settle:.3f}s "
+                  f"total={time.monotonic() - started:.3f}s ok={detached and attached}")
             return detached and attached
         except Exception:
             return False
 
     @staticmethod
-    def detach_mass_storage_media():
+    def detach_mass_storage_media(lun=0):
         """
-        Temporarily detach the mass storage media by clearing lun.0/file.
+        Temporarily detach the mass storage media by clearing lun.N/file.
         Keeps the gadget and function active (e.g., ACM stays up), but the
         host will see the storage removed. Use before updating the image.
         """
@@ -361,50 +590,32 @@ class USBGadget:
             return False
 
         try:
-            USBGadget.add_mass_storage()
-            lun_dir = os.path.join(
-                config.GADGET_PATH, "functions", "mass_storage.0", "lun.0"
-            )
-            lun_file = os.path.join(lun_dir, "file")
-            forced_eject_path = os.path.join(lun_dir, "forced_eject")
-
-            # Prefer forced_eject if supported
-            if os.path.exists(forced_eject_path):
-                for _ in range(5):
-                    if USBGadget._write(forced_eject_path, "1"):
-                        time.sleep(0.2)
-                        return True
-                    time.sleep(0.05)
-
-            for _ in range(10):
-                if USBGadget._write(lun_file, ""):
-                    time.sleep(0.2)
-                    return True
-                time.sleep(0.05)
-            return False
+            started = time.monotonic()
+            USBGadget._ensure_mass_storage()
+            if not USBGadget._eject(USBGadget._lun(lun)):
+                return False
+            settle = USBGadget._settle(config.MEDIA_DETACH_SETTLE,
+                                       USBGadget._lun_empty(USBGadget._lun(lun)))
+            print(f"USBGadget: media detach lun={lun} udc_state={USBGadget.udc_state()} "
+                  f"settle={settle:.3f}s total={time.monotonic() - started:.3f}s")
+            return True
         except Exception:
             return False
 
     @staticmethod
-    def attach_mass_storage_media(image_path):
+    def attach_mass_storage_media(image_path, lun=0):
         """
         Attach the given image to the mass storage LUN (writes path to
-        lun.0/file). Triggers media insertion on the host.
+        lun.N/file). Triggers media insertion on the host.
         """
         if not USBGadget.is_initialized():
             return False
 
         try:
-            USBGadget.add_mass_storage()
-            lun_file = os.path.join(
-                config.GADGET_PATH, "functions", "mass_storage.0", "lun.0", "file"
-            )
-            new_path = os.path.abspath(image_path)
-            for _ in range(10):
-                if USBGadget._write(lun_file, new_path):
-                    time.sleep(0.1)
-                    return True
-                time.sleep(0.1)
+            USBGadget._ensure_mass_storage()
+            if USBGadget._attach(USBGadget._lun(lun), os.path.abspath(image_path)):
+                USBGadget._settle(0.1)
+                return True
             return False
         except Exception:
             return False
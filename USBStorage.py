@@ -1,39 +1,252 @@
+import json
 import os
 import subprocess
 import config
 import shutil
 import time
+from FastCopy import FastCopy
+from FAT32Image import FAT32Image
+from LoopDevice import LoopDevice
+from Profiler import Profiler
 
 
 class USBStorage:
+    # image currently mounted at DATA_DIR by this process, if any
+    _mounted_image = None
+    # whether that mount went through the LoopDevice pool
+    _native_mount = False
+    # loop device "losetup -f" bound for that mount, if any
+    _losetup_dev = None
+    # abspath -> ((st_ino, st_mtime_ns, st_size), free bytes)
+    _free_cache = {}
+
+    @staticmethod
+    def _run(cmd, **kwargs):
+        """
+        subprocess.run() traced as a "subprocess" span.
+        """
+        with Profiler.span("subprocess", cmd=" ".join(str(c) for c in cmd)):
+            return subprocess.run(cmd, **kwargs)
+
+    @staticmethod
+    def _image_state():
+        try:
+            with open(config.IMAGE_STATE_FILE, "r") as f:
+                state = json.load(f)
+            if state.get("active") in ("a", "b"):
+                return state
+        except Exception:
+            pass
+        return {"active": "a", "synced": True}
+
+    @staticmethod
+    def _save_image_state(state):
+        tmp = config.IMAGE_STATE_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, config.IMAGE_STATE_FILE)
+
+    @staticmethod
+    def active_image():
+        """
+        Returns the image currently presented to the host: DATA_IMAGE in
+        single mode, DATA_IMAGE_A or DATA_IMAGE_B in "ab" mode.
+        """
+        if config.IMAGE_MODE != "ab":
+            return config.DATA_IMAGE
+        if USBStorage._image_state()["active"] == "b":
+            return config.DATA_IMAGE_B
+        return config.DATA_IMAGE_A
+
+    @staticmethod
+    def inactive_image():
+        """
+        Returns the image commits are prepared in while the host keeps the
+        active one ("ab" mode only; same as active_image() otherwise).
+        """
+        if config.IMAGE_MODE != "ab":
+            return config.DATA_IMAGE
+        if USBStorage._image_state()["active"] == "b":
+            return config.DATA_IMAGE_A
+        return config.DATA_IMAGE_B
+
+    @staticmethod
+    def set_active_image(image, synced):
+        """
+        Record which A/B image is active and whether the inactive one holds
+        the same content.
+        """
+        active = "b" if os.path.abspath(image) == os.path.abspath(config.DATA_IMAGE_B) else "a"
+        USBStorage._save_image_state({"active": active, "synced": synced})
+
     @staticmethod
-    def image_create():
-        if os.path.exists(config.DATA_IMAGE):
+    def images_synced():
+        return config.IMAGE_MODE != "ab" or USBStorage._image_state().get("synced", True)
+
+    @staticmethod
+    def _lun_state():
+        count = config.MASS_STORAGE_LUNS
+        try:
+            with open(config.LUN_STATE_FILE, "r") as f:
+                state = json.load(f)
+            if len(state["images"]) == count and len(state["seq"]) == count:
+                return state
+        except Exception:
+            pass
+        return {"images": [config.LUN_IMAGE.format(n) for n in range(count)],
+                "seq": [0] * count}
+
+    @staticmethod
+    def lun_images():
+        """
+        Returns the image behind each LUN, indexed by LUN number. With a
+        single LUN this is just the active image.
+        """
+        if config.MASS_STORAGE_LUNS <= 1:
+            return [USBStorage.active_image()]
+        return list(USBStorage._lun_state()["images"])
+
+    @staticmethod
+    def lun_seq():
+        """
+        Returns the publish sequence number of each LUN (0 = never used);
+        the highest one holds the newest batch.
+        """
+        if config.MASS_STORAGE_LUNS <= 1:
+            return [0]
+        return list(USBStorage._lun_state()["seq"])
+
+    @staticmethod
+    def set_lun_images(images, seq):
+        """
+        Record which image each LUN presents and when it was published.
+        """
+        tmp = config.LUN_STATE_FILE + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"images": list(images), "seq": list(seq)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, config.LUN_STATE_FILE)
+
+    @staticmethod
+    def image_copy(src, dst):
+        """
+        Replace dst with a copy of src (via a temp file and rename).
+        """
+        tmp = dst + ".tmp"
+        FastCopy.clone_file(src, tmp)
+        os.replace(tmp, dst)
+        LoopDevice.release(dst)
+
+    @staticmethod
+    def image_move(src, dst):
+        """
+        Replace dst with src (a rename), e.g. an image built next to it.
+        """
+        USBStorage.release(src)
+        LoopDevice.release(src)
+        os.replace(src, dst)
+        LoopDevice.release(dst)
+
+    @staticmethod
+    def template_path():
+        return os.path.join(config.TEMPLATE_DIR, f"blank-{config.IMAGE_SIZE_MB}M.img")
+
+    @staticmethod
+    def template_create():
+        """
+        Ensure a freshly formatted, sparse image of IMAGE_SIZE_MB exists in
+        TEMPLATE_DIR and return its path. It is built once per size, with
+        FAT32Image.format() or, for the "mkfs" provisioner (or sizes too
+        small for FAT32), with parted + mkfs.vfat.
+        """
+        path = USBStorage.template_path()
+        if os.path.exists(path):
+            return path
+        os.makedirs(config.TEMPLATE_DIR, exist_ok=True)
+        tmp = path + ".tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        formatted = False
+        if config.IMAGE_PROVISIONER == "python":
+            try:
+                FAT32Image.format(tmp, config.IMAGE_SIZE_MB * 1024 * 1024, label="RECEIVEIT")
+                formatted = True
+            except ValueError as e:
+                print(f"USBStorage: {e}, formatting template with mkfs.vfat")
+        if not formatted:
+            USBStorage._image_format_mkfs(tmp)
+        os.replace(tmp, path)
+        return path
+
+    @staticmethod
+    def image_create(image=None):
+        """
+        Create `image` (default: the active image) if it doesn't exist, as a
+        sparse copy or reflink of the cached blank template.
+        """
+        image = image or USBStorage.active_image()
+        if os.path.exists(image):
             return
+        try:
+            USBStorage.image_copy(USBStorage.template_create(), image)
+        except Exception as e:
+            print(f"USBStorage: template provisioning failed ({e}), formatting {image} directly")
+            USBStorage._image_format_mkfs(image)
+
+    @staticmethod
+    def images_create():
+        """
+        image_create() for every image a LUN presents.
+        """
+        for image in USBStorage.lun_images():
+            USBStorage.image_create(image)
 
+    @staticmethod
+    def _image_format_mkfs(image):
         if shutil.which("fallocate"):
             # try fast allocation first
-            subprocess.run(
-                ["fallocate", "-l", f"{config.IMAGE_SIZE_MB}M", config.DATA_IMAGE], check=True
+            USBStorage._run(
+                ["fallocate", "-l", f"{config.IMAGE_SIZE_MB}M", image], check=True
             )
         else:
             # fallback to dd (slower but reliable)
-            subprocess.run(
+            USBStorage._run(
                 [
                     "dd",
                     "if=/dev/zero",
-                    f"of={config.DATA_IMAGE}",
+                    f"of={image}",
                     "bs=1M",
                     f"count={config.IMAGE_SIZE_MB}",
                 ],
                 check=True,
             )
 
+        if config.LOOP_ENGINE == "native" and shutil.which("parted") and shutil.which("mkfs.vfat"):
+            # parted works on the file itself; the FAT is then made through
+            # a loop device that starts at the new partition
+            USBStorage._run(["parted", "-s", image, "mklabel", "msdos"], check=True)
+            USBStorage._run(["parted", "-s", image, "mkpart",
+                            "primary", "fat32", "1MiB", "100%"], check=True)
+            try:
+                dev = LoopDevice.get(image)
+            except OSError as e:
+                print(f"USBStorage: native loop unavailable ({e}), using losetup")
+            else:
+                try:
+                    USBStorage._run(["mkfs.vfat", dev], check=True)
+                    LoopDevice.sync(image)
+                finally:
+                    LoopDevice.release(image)
+                return
+
         # Prefer creating a partition table
         if shutil.which("losetup") and shutil.which("parted") and shutil.which("mkfs.vfat"):
             loop = (
-                subprocess.run(
-                    ["losetup", "-f", "--show", config.DATA_IMAGE],
+                USBStorage._run(
+                    ["losetup", "-f", "--show", image],
                     capture_output=True,
                     text=True,
                     check=True,
@@ -43,13 +256,13 @@ class USBStorage:
 
             try:
                 # create msdos label and a single FAT32 partition
-                subprocess.run(
+                USBStorage._run(
                     ["parted", "-s", loop, "mklabel", "msdos"], check=True)
-                subprocess.run(["parted", "-s", loop, "mkpart",
-                               "primary", "fat32", "1MiB", "100%"], check=True)
+                USBStorage._run(["parted", "-s", loop, "mkpart",
+                                "primary", "fat32", "1MiB", "100%"], check=True)
 
                 # let kernel re-scan partitions; partprobe may help
-                subprocess.run(["partprobe", loop], check=False)
+                USBStorage._run(["partprobe", loop], check=False)
 
                 # partition node can be /dev/loopXp1 or /dev/loopX1 depending on system
                 part1 = loop + \
@@ -61,32 +274,54 @@ class USBStorage:
                         break
                     time.sleep(0.1)
 
-                subprocess.run(["mkfs.vfat", part1], check=True)
+                USBStorage._run(["mkfs.vfat", part1], check=True)
             finally:
-                subprocess.run(["losetup", "-d", loop], check=False)
+                USBStorage._run(["losetup", "-d", loop], check=False)
         else:
-            subprocess.run(["mkfs.vfat", config.DATA_IMAGE], check=True)
+            USBStorage._run(["mkfs.vfat", image], check=True)
 
     @staticmethod
-    def image_delete():
-        if os.path.exists(config.DATA_IMAGE):
-            os.remove(config.DATA_IMAGE)
+    def image_delete(image=None):
+        image = image or USBStorage.active_image()
+        LoopDevice.release(image)
+        if os.path.exists(image):
+            os.remove(image)
 
     @staticmethod
-    def image_exists():
-        return os.path.exists(config.DATA_IMAGE)
+    def image_exists(image=None):
+        return os.path.exists(image or USBStorage.active_image())
 
     @staticmethod
-    def mount():
+    def mount(image=None):
+        image = image or USBStorage.active_image()
+        # reuse a mount kept from an earlier commit; swap out any other image
+        if USBStorage.is_mounted():
+            if USBStorage._mounted_image == image:
+                return
+            USBStorage.umount(USBStorage._mounted_image)
         os.makedirs(config.DATA_DIR, exist_ok=True)
+        if config.LOOP_ENGINE == "native":
+            try:
+                dev = LoopDevice.get(image)
+                # the image may have been written directly since the last mount
+                LoopDevice.invalidate(image)
+                LoopDevice.mount(dev, config.DATA_DIR)
+                USBStorage._native_mount = True
+                # only a mount that succeeded counts as kept
+                USBStorage._mounted_image = image
+                return
+            except OSError as e:
+                print(f"USBStorage: native mount failed ({e}), using losetup")
+                # mount refuses a second loop device overlapping the pooled one
+                LoopDevice.release(image)
         # Prefer using losetup with partition scanning so we can mount the first
         # partition if the image contains a partition table. Fall back to direct
         # loop mount if losetup is not available or partition node not found.
         if shutil.which("losetup"):
             try:
                 loop = (
-                    subprocess.run(
-                        ["losetup", "-f", "--show", "-P", config.DATA_IMAGE],
+                    USBStorage._run(
+                        ["losetup", "-f", "--show", "-P", image],
                         capture_output=True,
                         text=True,
                         check=True,
@@ -108,87 +343,156 @@ class USBStorage:
                     time.sleep(0.05)
 
                 if os.path.exists(part1):
-                    subprocess.run(
-                        ["mount", part1, config.DATA_DIR], check=False)
-                    return
+                    ok = USBStorage._run(
+                        ["mount", part1, config.DATA_DIR], check=False).returncode == 0
                 else:
-                    # fall back to mounting the image directly
-                    subprocess.run(
-                        ["mount", "-o", "loop", config.DATA_IMAGE, config.DATA_DIR], check=False)
-                    return
+                    # fall back to mounting the image directly (its own autoclear device)
+                    USBStorage._run(["losetup", "-d", loop], check=False)
+                    loop = None
+                    ok = USBStorage._run(
+                        ["mount", "-o", "loop", image, config.DATA_DIR], check=False).returncode == 0
+                if ok:
+                    USBStorage._losetup_dev = loop
+                    USBStorage._mounted_image = image
+                elif loop:
+                    USBStorage._run(["losetup", "-d", loop], check=False)
+                return
 
         # fallback when losetup not present
-        subprocess.run(["mount", "-o", "loop", config.DATA_IMAGE,
-                       config.DATA_DIR], check=False)
+        if USBStorage._run(["mount", "-o", "loop", image,
+                            config.DATA_DIR], check=False).returncode == 0:
+            USBStorage._mounted_image = image
 
     @staticmethod
-    def umount():
+    def umount(image=None):
+        image = image or USBStorage.active_image()
+        USBStorage._mounted_image = None
+        if USBStorage._native_mount:
+            USBStorage._native_mount = False
+            try:
+                LoopDevice.umount(config.DATA_DIR)
+                # the device stays bound for the next mount
+                LoopDevice.sync(image)
+                return
+            except OSError as e:
+                print(f"USBStorage: native umount failed ({e}), using umount")
         # try to unmount the filesystem
-        subprocess.run(["umount", config.DATA_DIR], check=False)
+        USBStorage._run(["umount", config.DATA_DIR], check=False)
 
-        # ensure any loop device backing the image is detached.
-        # losetup -j <file> prints matching loop devices like: /dev/loop0: [..]: /path/to/file
-        try:
-            if shutil.which("losetup"):
-                p = subprocess.run(
-                    ["losetup", "-j", config.DATA_IMAGE], capture_output=True, text=True)
-                out = p.stdout.strip()
-                for line in out.splitlines():
-                    # extract device path up to the colon
-                    dev = line.split(":", 1)[0].strip()
-                    if dev:
-                        subprocess.run(["losetup", "-d", dev], check=False)
-        except Exception:
-            # best-effort only
-            pass
+        # detach only devices this process bound: the pooled one (its pool
+        # entry must go with it) and the one losetup set up for the mount;
+        # "mount -o loop" devices clear themselves on umount
+        LoopDevice.release(image)
+        if USBStorage._losetup_dev:
+            USBStorage._run(["losetup", "-d", USBStorage._losetup_dev], check=False)
+            USBStorage._losetup_dev = None
 
         # small delay to let kernel settle device nodes
         time.sleep(0.05)
 
+    @staticmethod
+    def mounted_image():
+        """
+        Returns the image this process left mounted at DATA_DIR, or None.
+        """
+        if USBStorage._mounted_image and USBStorage.is_mounted():
+            return USBStorage._mounted_image
+        return None
+
+    @staticmethod
+    def release(image):
+        """
+        Unmount `image` if it is still mounted at DATA_DIR, so it can be
+        written directly, copied or handed to the host.
+        """
+        if USBStorage._mounted_image == image:
+            USBStorage.umount(image)
+
+    @staticmethod
+    def image_free_bytes(image=None):
+        """
+        Returns the free space of the filesystem in `image`, or None if it
+        can't be read. The FAT is only re-read when the image file changed.
+        """
+        image = os.path.abspath(image or USBStorage.active_image())
+        if USBStorage._mounted_image and os.path.abspath(USBStorage._mounted_image) == image:
+            try:
+                return shutil.disk_usage(config.DATA_DIR).free
+            except OSError:
+                return None
+        try:
+            st = os.stat(image)
+        except OSError:
+            return None
+        key = (st.st_ino, st.st_mtime_ns, st.st_size)
+        cached = USBStorage._free_cache.get(image)
+        if cached and cached[0] == key:
+            return cached[1]
+        try:
+            with FAT32Image(image, writable=False) as img:
+                free = img.free_bytes()
+        except (OSError, ValueError):
+            return None
+        USBStorage._free_cache[image] = (key, free)
+        return free
+
     @staticmethod
     def is_mounted():
         os.makedirs(config.DATA_DIR, exist_ok=True)
-        result = subprocess.run(
+        if config.LOOP_ENGINE == "native":
+            return os.path.ismount(config.DATA_DIR)
+        result = USBStorage._run(
             ["mountpoint", "-q", config.DATA_DIR], check=False
         )
         return result.returncode == 0
 
     @staticmethod
-    def bump_fat_volume_metadata():
+    def bump_fat_volume_metadata(image=None):
         """
         Best-effort: tweak FAT volume metadata to encourage host re-cache.
         - Prefer setting a new FAT volume serial via mtools 'mlabel -N' if available.
         - Otherwise, update the volume label via fatlabel/dosfslabel.
-        Works on the partition node if present (/dev/loopXp1 or /dev/loopX1),
+        Works on the pooled loop device (which starts at the partition) or
+        on the partition node if present (/dev/loopXp1 or /dev/loopX1),
         falling back to the whole loop device. No-op on failure.
         """
-        # Requires losetup to address partitioned images cleanly.
-        if not shutil.which("losetup"):
-            return
+        image = image or USBStorage.active_image()
+        loop = None
+        dev = None
+        if config.LOOP_ENGINE == "native":
+            try:
+                dev = LoopDevice.get(image)
+            except OSError:
+                pass
+        if dev is None:
+            # Requires losetup to address partitioned images cleanly.
+            if not shutil.which("losetup"):
+                return
 
-        try:
-            loop = (
-                subprocess.run(
-                    ["losetup", "-f", "--show", "-P", config.DATA_IMAGE],
-                    capture_output=True,
-                    text=True,
-                    check=True,
-                ).stdout.strip()
-            )
-        except Exception:
-            return
+            try:
+                loop = (
+                    USBStorage._run(
+                        ["losetup", "-f", "--show", "-P", image],
+                        capture_output=True,
+                        text=True,
+                        check=True,
+                    ).stdout.strip()
+                )
+            except Exception:
+                return
 
         try:
-            part1 = loop + "p1" if os.path.exists(loop + "p1") else loop + "1"
-            dev = part1 if os.path.exists(part1) else loop
+            if loop:
+                part1 = loop + "p1" if os.path.exists(loop + "p1") else loop + "1"
+                dev = part1 if os.path.exists(part1) else loop
 
             # Prefer changing the volume label first (works well on Windows)
             tried = False
             if shutil.which("fatlabel"):
                 try:
                     label = f"RECEIVE{int(time.time()) % 100000:05d}"
-                    subprocess.run(["fatlabel", dev, label], check=False,
-                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    USBStorage._run(["fatlabel", dev, label], check=False,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
                     tried = True
                 except Exception:
                     pass
@@ -196,8 +500,8 @@ class USBStorage:
             if not tried and shutil.which("dosfslabel"):
                 try:
                     label = f"RECEIVE{int(time.time()) % 100000:05d}"
-                    subprocess.run(["dosfslabel", dev, label], check=False,
-                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    USBStorage._run(["dosfslabel", dev, label], check=False,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
                     tried = True
                 except Exception:
                     pass
@@ -206,12 +510,15 @@ class USBStorage:
             if not tried and shutil.which("mlabel"):
                 try:
                     serial = f"{int(time.time() * 1000) & 0xFFFFFFFF:08X}"
-                    subprocess.run(["mlabel", "-i", dev, "-N", serial, "::"], check=False,
-                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                    USBStorage._run(["mlabel", "-i", dev, "-N", serial, "::"], check=False,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
                 except Exception:
                     pass
         finally:
             try:
-                subprocess.run(["losetup", "-d", loop], check=False)
+                if loop:
+                    USBStorage._run(["losetup", "-d", loop], check=False)
+                else:
+                    LoopDevice.sync(image)
             except Exception:
                 pass
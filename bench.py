@@ -0,0 +1,349 @@
+#!/usr/bin/python3
+"""
+Hardware-free benchmark of the upload -> commit -> publish pipeline.
+
+Everything runs in a temp dir: config.GADGET_PATH, CONFIGFS_PATH and
+UDC_PATH point at a fake configfs tree with one dummy UDC, and the
+loop/mount layer of USBStorage is replaced by an in-process stand-in (each
+image gets a plain directory that DATA_DIR is linked to while "mounted",
+written back into the image with FAT32Image on umount, so with -e loop the
+umount phase stands in for the kernel's writeback and the index and verify
+phases read real data).
+Uploads, /commit and /clear are driven through the Flask test client and
+timed per step; commit and clear are broken down by Jobs.phase() using the
+receiveit_phase_seconds metric.
+
+    python3 bench.py                         # all workloads, direct engine
+    python3 bench.py -w many,nested -e loop  # mounted engine via the stand-in
+    python3 bench.py -w large --scale 0.05   # 1 x 200 MB instead of 4 GB
+    python3 bench.py --json > bench_output.txt
+"""
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import config
+import main
+from FAT32Image import FAT32Image
+from Jobs import Jobs
+from Metrics import Metrics
+from USBGadget import USBGadget
+from USBStorage import USBStorage
+
+
+WORKLOADS = {
+    # one file just under the FAT32 4 GiB limit
+    "large": lambda: [("large.bin", 4 * 1000 ** 3)],
+    "many": lambda: [(f"many/{i:04d}.bin", 100 * 1000) for i in range(1000)],
+    "nested": lambda: [(f"nested/d{a}/d{b}/f{c}.bin", 10 * 1000)
+                       for a in range(10) for b in range(10) for c in range(10)],
+}
+
+_BLOCK = os.urandom(1024 * 1024)
+
+
+class _MultipartBody:
+    """
+    A multipart/form-data body generated on the fly, so multi-GB uploads
+    need no memory or disk on the client side.
+    """
+
+    def __init__(self, files):
+        self.boundary = uuid.uuid4().hex
+        self.files = files
+        self.length = len(self._trailer())
+        for name, size in files:
+            self.length += len(self._header(name)) + size + 2
+        self._chunks = self._generate()
+        self._buf = b""
+        self._pos = 0
+        self._tell = 0
+
+    def tell(self):
+        return self._tell
+
+    def seek(self, offset, whence=0):
+        # the test client seeks to the end and back to size the body
+        self._tell = offset if whence == 0 else self.length + offset
+        return self._tell
+
+    def _header(self, name):
+        return (f"--{self.boundary}\r\n"
+                f"Content-Disposition: form-data; name=\"file\"; filename=\"{name}\"\r\n"
+                f"Content-Type: application/octet-stream\r\n\r\n").encode()
+
+    def _trailer(self):
+        return f"--{self.boundary}--\r\n".encode()
+
+    def _generate(self):
+        for name, size in self.files:
+            yield self._header(name)
+            while size:
+                n = min(size, len(_BLOCK))
+                yield _BLOCK[:n]
+                size -= n
+            yield b"\r\n"
+        yield self._trailer()
+
+    def read(self, n=-1):
+        while n < 0 or len(self._buf) < n:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+        if n < 0:
+            n = len(self._buf)
+        data, self._buf = self._buf[:n], self._buf[n:]
+        self._pos += len(data)
+        self._tell = self._pos
+        return data
+
+
+class _FakeMount:
+    """
+    In-process stand-in for USBStorage's loop/mount layer. The directory of
+    an image is filled from the image on mount if the image changed since
+    the stand-in last wrote it (e.g. cleared directly), and written back on
+    umount: changed files are stored, files gone from the directory are
+    removed.
+    """
+
+    root = None
+    # image -> its mtime_ns when its directory was last in sync with it
+    _synced = {}
+
+    @staticmethod
+    def _dir(image):
+        return os.path.join(_FakeMount.root, "mounts", os.path.basename(image))
+
+    @staticmethod
+    def _extract(image, path):
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        with FAT32Image(image, writable=False) as img, open(image, "rb") as f:
+            for rel, entry in img.walk():
+                dst = os.path.join(path, rel)
+                if entry.is_dir:
+                    os.makedirs(dst, exist_ok=True)
+                    continue
+                with open(dst, "wb") as out:
+                    for offset, length in img.extents(entry):
+                        f.seek(offset)
+                        out.write(f.read(length))
+                os.utime(dst, (entry.mtime, entry.mtime))
+
+    @staticmethod
+    def _write_back(image, path):
+        present = set()
+        with FAT32Image(image) as img:
+            for dirpath, dirnames, filenames in os.walk(path):
+                for name in dirnames:
+                    rel = os.path.relpath(os.path.join(dirpath, name), path)
+                    present.add(rel.lower())
+                    img.makedirs(rel)
+                for name in filenames:
+                    src = os.path.join(dirpath, name)
+                    rel = os.path.relpath(src, path)
+                    present.add(rel.lower())
+                    st = os.stat(src)
+                    cur = img.stat(rel)
+                    if cur is None or cur.size != st.st_size or abs(cur.mtime - st.st_mtime) > 2:
+                        img.write_file(rel, src)
+            for rel, entry in list(img.walk()):
+                if rel.lower() not in present:
+                    try:
+                        img.remove(rel)
+                    except FileNotFoundError:
+                        # below a directory removed just before
+                        pass
+        _FakeMount._synced[image] = os.stat(image).st_mtime_ns
+
+    @staticmethod
+    def mount(image=None):
+        image = image or USBStorage.active_image()
+        if USBStorage._mounted_image == image and os.path.islink(config.DATA_DIR):
+            return
+        _FakeMount.umount()
+        path = _FakeMount._dir(image)
+        if _FakeMount._synced.get(image) != os.stat(image).st_mtime_ns:
+            _FakeMount._extract(image, path)
+            _FakeMount._synced[image] = os.stat(image).st_mtime_ns
+        shutil.rmtree(config.DATA_DIR, ignore_errors=True)
+        os.symlink(path, config.DATA_DIR)
+        USBStorage._mounted_image = image
+
+    @staticmethod
+    def umount(image=None):
+        mounted = USBStorage._mounted_image
+        USBStorage._mounted_image = None
+        if os.path.islink(config.DATA_DIR):
+            os.unlink(config.DATA_DIR)
+            if mounted is not None:
+                _FakeMount._write_back(mounted, _FakeMount._dir(mounted))
+        os.makedirs(config.DATA_DIR, exist_ok=True)
+
+    @staticmethod
+    def is_mounted():
+        return os.path.islink(config.DATA_DIR)
+
+    @staticmethod
+    def bump_fat_volume_metadata(image=None):
+        pass
+
+    @staticmethod
+    def image_delete(image=None, _delete=USBStorage.image_delete):
+        image = image or USBStorage.active_image()
+        shutil.rmtree(_FakeMount._dir(image), ignore_errors=True)
+        _FakeMount._synced.pop(image, None)
+        _delete(image)
+
+
+def _environment(root, args, total):
+    """
+    Point config at a fresh tree below `root` and patch the hardware layers.
+    """
+    for name, rel in (("UPLOAD_DIR", "upload"), ("UPLOAD_TMP_DIR", "upload.tmp"),
+                      ("UPLOAD_SESSIONS_DIR", "upload.sessions"), ("UPLOAD_BATCHES_DIR", "upload.batches"),
+                      ("DATA_DIR", "data"),
+                      ("DATA_IMAGE", "data.img"), ("DATA_IMAGE_A", "data-a.img"),
+                      ("DATA_IMAGE_B", "data-b.img"), ("IMAGE_STATE_FILE", "image-state.json"),
+                      ("COMMIT_JOURNAL", "upload.journal"), ("LUN_IMAGE", "data-lun{}.img"),
+                      ("LUN_STATE_FILE", "lun-state.json"), ("UPLOAD_HASHES", "upload.hashes"),
+                      ("IMAGE_INDEX_DIR", "image.index"), ("CONFIGFS_PATH", "configfs"),
+                      ("UDC_PATH", "udc")):
+        setattr(config, name, os.path.join(root, rel))
+    config.GADGET_PATH = os.path.join(config.CONFIGFS_PATH, "usb_gadget", "receiveit")
+    config.TEMPLATE_DIR = os.path.join(args.dir, "templates")
+    config.IMAGE_SIZE_MB = max(256, (total * 5 // 4) // (1024 * 1024) + 64)
+    config.COMMIT_ENGINE = args.engine
+    config.COMMIT_MODE = args.mode
+    config.IMAGE_MODE = args.image_mode
+    config.JOBS_ASYNC = True
+    config.COMMIT_COALESCE_MS = 0
+
+    os.makedirs(config.CONFIGFS_PATH)
+    os.makedirs(os.path.join(config.UDC_PATH, "dummy_udc.0"))
+    with open(os.path.join(config.UDC_PATH, "dummy_udc.0", "state"), "w") as f:
+        f.write("configured\n" if args.host else "not attached\n")
+
+    _FakeMount.root = root
+    _FakeMount._synced = {}
+    for name in ("mount", "umount", "is_mounted", "bump_fat_volume_metadata", "image_delete"):
+        setattr(USBStorage, name, staticmethod(getattr(_FakeMount, name)))
+    USBStorage._mounted_image = None
+    USBStorage.images_create()
+    USBGadget.init()
+
+
+def _phases(kind):
+    """
+    Returns {phase: seconds} recorded for jobs of `kind` since the last reset.
+    """
+    phases = {}
+    for key, counts in Metrics._values["receiveit_phase_seconds"].items():
+        labels = dict(key)
+        if labels.get("job") == kind:
+            phases[labels["phase"]] = phases.get(labels["phase"], 0) + counts[-2]
+    return phases
+
+
+def _job(client, path):
+    for values in Metrics._values.values():
+        values.clear()
+    started = time.monotonic()
+    resp = client.post(path)
+    job = Jobs.get(resp.get_json()["id"])
+    job.done.wait()
+    seconds = time.monotonic() - started
+    if job.state != "done":
+        raise RuntimeError(f"{path} failed: {job.error}")
+    return seconds, job
+
+
+def run(name, args):
+    files = [(rel, max(1, int(size * args.scale))) for rel, size in WORKLOADS[name]()]
+    total = sum(size for _, size in files)
+    results = []
+    root = tempfile.mkdtemp(prefix=f"{name}-", dir=args.dir)
+    try:
+        if shutil.disk_usage(root).free < total * 3:
+            print(f"bench: skipping {name}, needs about {total * 3 // 2 ** 20} MiB free",
+                  file=sys.stderr)
+            return results
+        _environment(root, args, total)
+        client = main.app.test_client()
+
+        started = time.monotonic()
+        requests = 0
+        for i in range(0, len(files), args.files_per_request):
+            body = _MultipartBody(files[i:i + args.files_per_request])
+            resp = client.post("/upload", input_stream=body,
+                               content_type=f"multipart/form-data; boundary={body.boundary}")
+            if resp.status_code != 200:
+                raise RuntimeError(f"/upload returned {resp.status_code}")
+            requests += 1
+        seconds = time.monotonic() - started
+        results.append({"workload": name, "step": "upload", "seconds": seconds,
+                        "bytes": total, "files": len(files), "requests": requests})
+
+        for step in ("commit", "clear"):
+            seconds, job = _job(client, f"/{step}")
+            results.append({"workload": name, "step": step, "seconds": seconds,
+                            "bytes": job.bytes_copied, "files": job.files_copied,
+                            "phases": _phases(step)})
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+def _rate(nbytes, seconds):
+    return f"{nbytes / seconds / 1e6:.1f}" if nbytes and seconds else ""
+
+
+def report(results):
+    print(f"{'workload':<10}{'step':<30}{'seconds':>10}{'MB/s':>10}")
+    for r in results:
+        print(f"{r['workload']:<10}{r['step']:<30}{r['seconds']:>10.3f}"
+              f"{_rate(r['bytes'], r['seconds']):>10}")
+        for phase, seconds in sorted(r.get("phases", {}).items(), key=lambda p: -p[1]):
+            rate = _rate(r["bytes"], seconds) if phase == "copy" else ""
+            print(f"{'':<10}{'  ' + phase:<30}{seconds:>10.3f}{rate:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-w", "--workloads", default=",".join(WORKLOADS),
+                        help="comma separated: " + ", ".join(WORKLOADS))
+    parser.add_argument("-e", "--engine", default="direct", choices=("direct", "loop"))
+    parser.add_argument("--mode", default=config.COMMIT_MODE, choices=("full", "incremental"))
+    parser.add_argument("--image-mode", default=config.IMAGE_MODE, choices=("single", "ab"))
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply all file sizes")
+    parser.add_argument("--files-per-request", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--host", action="store_true",
+                        help="report the fake UDC as configured, so host settle delays apply")
+    parser.add_argument("--dir", default=tempfile.gettempdir(),
+                        help="where to create the benchmark trees")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    args.dir = tempfile.mkdtemp(prefix="receiveit-bench-", dir=args.dir)
+
+    results = []
+    try:
+        # keep the pipeline's own logging out of the report
+        with contextlib.redirect_stdout(sys.stderr):
+            for _ in range(args.repeat):
+                for name in args.workloads.split(","):
+                    results.extend(run(name.strip(), args))
+    finally:
+        shutil.rmtree(args.dir, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        report(results)
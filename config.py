@@ -5,3 +5,52 @@ IMAGE_SIZE_MB = 4096
 UPLOAD_OWNER = "receiveit"
 UPLOAD_GROUP = "receiveit"
 GADGET_PATH = "/sys/kernel/config/usb_gadget/receiveit"
+UPLOAD_TMP_DIR = "./upload.tmp"
+UPLOAD_STREAMING = True
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+UPLOAD_SESSIONS_DIR = "./upload.sessions"
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+COMMIT_ENGINE = "loop"  # "loop" (losetup + mount) or "direct" (FAT32Image, no mount)
+IMAGE_MODE = "single"  # "single" (DATA_IMAGE) or "ab" (double-buffered DATA_IMAGE_A/B)
+DATA_IMAGE_A = "./data-a.img"
+DATA_IMAGE_B = "./data-b.img"
+IMAGE_STATE_FILE = "./image-state.json"
+COMMIT_MODE = "full"  # "full" (scan UPLOAD_DIR) or "incremental" (journal of changed files)
+COMMIT_JOURNAL = "./upload.journal"
+SERVER = "pooled"  # "pooled" (bounded worker pool) or "flask" (Flask development server)
+SERVER_HOST = "0.0.0.0"
+SERVER_PORT = 80
+SERVER_THREADS = 8
+SERVER_BACKLOG = 8  # accepted connections that may wait for a free worker
+JOBS_ASYNC = True  # /commit, /clear, /reload return a job id unless ?wait=1
+JOBS_HISTORY = 50
+COMMIT_COALESCE_MS = 250  # merge commit/clear requests arriving within this window
+COMMIT_COALESCE_MAX_MS = 5000  # but never hold a job back longer than this
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+COPY_FLUSH = "syncfs"  # "syncfs" (target filesystem + image), "file" (fdatasync each file) or "global" (os.sync)
+COPY_REPORT_MIN_BYTES = 1024 * 1024  # log throughput for files at least this large
+IMAGE_PROVISIONER = "python"  # "python" (FAT32Image.format) or "mkfs" (parted + mkfs.vfat)
+TEMPLATE_DIR = "./templates"
+UDC_WAIT_TIMEOUT = None  # seconds to wait for a UDC at startup, None waits forever
+UDC_POLL_INTERVAL = 1.0  # re-check interval when uevents are unavailable
+MEDIA_EJECT_SETTLE = 0.4  # seconds a connected host gets to notice media removal
+MEDIA_ATTACH_SETTLE = 1.4  # ... and the new media after a swap
+MEDIA_DETACH_SETTLE = 0.2  # ... after detaching before a commit
+MASS_STORAGE_LUNS = 1  # >1 publishes each commit batch on its own LUN (IMAGE_MODE is then ignored)
+LUN_ROTATION = "round_robin"  # "round_robin" (batch goes to the oldest LUN) or "latest" (lun.0 always shows the newest batch)
+LUN_IMAGE = "./data-lun{}.img"  # backing image per LUN slot, formatted with the slot number
+LUN_STATE_FILE = "./lun-state.json"
+LOOP_ENGINE = "native"  # "native" (loop ioctls + mount(2), pooled devices) or "losetup" (losetup/mount/umount)
+CONFIGFS_PATH = "/sys/kernel/config"
+UDC_PATH = "/sys/class/udc"
+DEDUP = True  # skip copying files whose content (SHA-256 from upload) is already in the image
+UPLOAD_HASHES = "./upload.hashes"
+IMAGE_INDEX_DIR = "./image.index"
+CLEAR_MODE = "format"  # "format" (rewrite FAT + root directory in place), "template" (swap in a copy of the blank template) or "delete" (remove entries one by one)
+UPLOAD_BATCHES_DIR = "./upload.batches"  # per-request upload batches, sealed (renamed) when complete
+PROFILE_DIR = "./profiles"  # cProfile/tracemalloc output of armed operations (POST /debug/profile, SIGUSR2)
+PROFILE_KEEP = 20  # profiles kept in PROFILE_DIR, oldest removed first
+PROFILE_KINDS = ("upload", "publish", "commit", "clear")  # operations an armed profiler picks up
+PROFILE_SIGNAL_REQUESTS = 5  # operations SIGUSR2 arms the profiler for
+PROFILE_TRACEMALLOC_FRAMES = 10
+TRACE_SPANS = 1000  # subprocess/loop/configfs spans kept for GET /debug/trace
@@ -1,141 +1,446 @@
 #!/usr/bin/python3
 
+import base64
+import errno
+import signal
+import threading
 import time
-from flask import Flask, request
+from flask import Flask, Response, request
+from werkzeug.http import http_date, parse_content_range_header
 import os
-import shutil
-import subprocess
+import re
 import config
 from USBGadget import USBGadget
 from USBStorage import USBStorage
+from ImageCommit import ImageCommit
+from ImageDownload import ImageDownload
+from ImageIndex import ImageIndex
+from Server import Server
+from Jobs import Jobs
+from Metrics import Metrics
+from Profiler import Profiler
+from Staging import Staging
+from StreamingUpload import StreamingUpload
+from ArchiveUpload import ArchiveUpload
+from ResumableUpload import ResumableUpload
 
 
 app = Flask("ReceiveIt")
 
 
+def _receive():
+    """
+    Stage the request body, multipart or a tar/zip stream, into the
+    current batch.
+    """
+    if ArchiveUpload.accepts(request.mimetype):
+        return ArchiveUpload.receive(request.stream, request.args.get("dir", ""))
+    return StreamingUpload.receive(request.stream, request.content_type)
+
+
 @app.route("/upload", methods=["POST"])
+@Profiler.profiled("upload")
 def upload():
     os.makedirs(config.UPLOAD_DIR, exist_ok=True)
-    files = request.files.getlist("file")
+    # a tar/zip body instead of multipart: the whole batch in one stream
+    archive = ArchiveUpload.accepts(request.mimetype)
+    if not config.UPLOAD_STREAMING and not archive:
+        started = time.monotonic()
+        files = request.files.getlist("file")
 
-    for f in files:
-        path = os.path.join(config.UPLOAD_DIR, f.filename)
-        f.save(path)
+        nbytes = 0
+        stored = 0
+        with Staging.batch():
+            for f in files:
+                # like the streaming path: skip names that are empty or escape the batch
+                relpath = Staging.safe_relpath(f.filename)
+                if relpath is None:
+                    continue
+                tmp = Staging.tmp_file()
+                f.save(tmp)
+                nbytes += os.path.getsize(tmp)
+                Staging.place(tmp, relpath)
+                stored += 1
+        Staging.account("legacy", nbytes, time.monotonic() - started, stored)
 
-    return "OK\n"
+        return "OK\n"
 
+    # refuse up front if the body can't possibly fit on the SD card
+    free = Staging.free_space()
+    if request.content_length and free is not None and request.content_length > free:
+        return "Insufficient storage\n", 507
 
-@app.route("/commit", methods=["POST"])
-def commit():
-    # If gadget is active, detach media first so the backing file isn't busy
-    if USBGadget.is_initialized():
-        USBGadget.detach_mass_storage_media()
-        time.sleep(0.1)
-    # ensure backing image exists
-    USBStorage.image_create()
-
-    # mount image and copy uploaded files into it
-    os.makedirs(config.DATA_DIR, exist_ok=True)
-    USBStorage.mount()
     try:
-        if not os.path.isdir(config.UPLOAD_DIR):
-            # nothing to commit
-            pass
-        else:
-            for filename in os.listdir(config.UPLOAD_DIR):
-                src_path = os.path.join(config.UPLOAD_DIR, filename)
-                dst_path = os.path.join(config.DATA_DIR, filename)
-                try:
-                    if os.path.isdir(src_path):
-                        # copy directory
-                        if os.path.exists(dst_path):
-                            shutil.rmtree(dst_path)
-                        shutil.copytree(src_path, dst_path)
-                    else:
-                        shutil.copy2(src_path, dst_path)
-                    os.remove(src_path)
-                except Exception:
-                    # ignore individual file errors
-                    pass
-    finally:
-        USBStorage.umount()
-        # ensure data is flushed to image
-        try:
-            os.sync()
-        except Exception:
+        # the request's files become visible to commit all at once, when it ends
+        with Staging.batch() as batch:
             try:
-                subprocess.run(["sync"], check=False)
+                stored = _receive()
             except Exception:
-                pass
-        # tweak FAT volume metadata to prod Windows into re-caching
+                if archive:
+                    # a rejected archive is dropped whole, never half committed
+                    Staging.discard(batch)
+                raise
+    except ValueError as e:
+        return f"Bad upload: {e}\n", 400
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            return "Insufficient storage\n", 507
+        raise
+
+    if request.accept_mimetypes.best_match(["text/plain", "application/json"]) == "application/json":
+        return {"files": stored}
+    return "OK\n"
+
+
+@app.route("/publish", methods=["POST"])
+# profiles the receive half here; the publish job gets a profile of its own
+@Profiler.profiled("publish")
+def publish():
+    """
+    Upload and publish in one round trip: the body (multipart or tar/zip)
+    becomes a batch of its own that is committed and published right
+    away, all or nothing. Returns what landed in the image.
+    """
+    free = Staging.free_space()
+    if request.content_length and free is not None and request.content_length > free:
+        return "Insufficient storage\n", 507
+
+    with Staging.batch(seal=False) as batch:
         try:
-            USBStorage.bump_fat_volume_metadata()
-        except Exception:
-            pass
+            stored = _receive()
+        except ValueError as e:
+            Staging.discard(batch)
+            return f"Bad upload: {e}\n", 400
+        except OSError as e:
+            Staging.discard(batch)
+            if e.errno == errno.ENOSPC:
+                return "Insufficient storage\n", 507
+            raise
+    if not stored:
+        Staging.discard(batch)
+        return "Bad upload: no files\n", 400
 
-    # update mass storage media without touching serial function
-    if USBGadget.is_initialized():
-        USBGadget.replace_mass_storage_image(config.DATA_IMAGE)
-    else:
-        # gadget not previously initialized; create full gadget (includes serial + ms)
-        USBGadget.init()
+    job = Jobs.submit("publish", lambda: ImageCommit.transaction(batch + ".open"))
+    job.done.wait()
+    Staging.discard(batch)
+    if job.state == "failed":
+        return f"Failed, nothing published: {job.error}\n", 500
+    image, files = job.result
+    return {"image": os.path.basename(image), "files": files}
+
+
+@app.route("/uploads", methods=["POST"])
+def upload_session_create():
+    body = request.get_json(silent=True) or {}
+    name = body.get("name", request.args.get("name"))
+    size = body.get("size", request.args.get("size"))
+    try:
+        size = int(size) if size is not None else None
+    except (TypeError, ValueError):
+        return "Bad upload: invalid size\n", 400
+
+    free = Staging.free_space()
+    if size and free is not None and size > free:
+        return "Insufficient storage\n", 507
+
+    try:
+        state = ResumableUpload.create(name, size)
+    except ValueError as e:
+        return f"Bad upload: {e}\n", 400
+    return state, 201, {"Location": f"/uploads/{state['id']}", "Upload-Offset": "0"}
+
+
+@app.route("/uploads/<upload_id>", methods=["GET", "HEAD"])
+def upload_session_status(upload_id):
+    try:
+        state = ResumableUpload.status(upload_id)
+    except KeyError:
+        return "Unknown upload\n", 404
+    return state, 200, {"Upload-Offset": str(state["offset"])}
+
+
+@app.route("/uploads/<upload_id>", methods=["PATCH", "PUT"])
+def upload_session_write(upload_id):
+    # tus-style Upload-Offset, or a plain Content-Range: bytes start-end/total
+    offset = request.headers.get("Upload-Offset")
+    if offset is None:
+        rng = parse_content_range_header(request.headers.get("Content-Range"))
+        offset = rng.start if rng is not None else None
+    try:
+        offset = int(offset)
+    except (TypeError, ValueError):
+        return "Bad upload: missing Upload-Offset or Content-Range\n", 400
+
+    try:
+        state = ResumableUpload.write(upload_id, offset, request.stream)
+    except KeyError:
+        return "Unknown upload\n", 404
+    except ValueError as e:
+        state = ResumableUpload.status(upload_id)
+        return {"error": str(e), "offset": state["offset"]}, 409, {"Upload-Offset": str(state["offset"])}
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            return "Insufficient storage\n", 507
+        raise
+    return state, 200, {"Upload-Offset": str(state["offset"])}
+
+
+@app.route("/uploads/<upload_id>/finalize", methods=["POST"])
+def upload_session_finalize(upload_id):
+    body = request.get_json(silent=True) or {}
+    try:
+        stored = ResumableUpload.finalize(upload_id, body.get("sha256"))
+    except KeyError:
+        return "Unknown upload\n", 404
+    except ValueError as e:
+        return {"error": str(e)}, 409
+    return stored
+
+
+@app.route("/uploads/<upload_id>", methods=["DELETE"])
+def upload_session_abort(upload_id):
+    try:
+        ResumableUpload.abort(upload_id)
+    except KeyError:
+        return "Unknown upload\n", 404
     return "OK\n"
 
 
-@app.route("/reload", methods=["POST"])
-def reload():
-    # ensure backing image exists
-    USBStorage.image_create()
+_SHA256 = re.compile(r"^[0-9a-f]{64}$")
+
+
+@app.route("/hashes/<sha256>", methods=["GET", "HEAD"])
+def hash_status(sha256):
+    sha256 = sha256.lower()
+    if not _SHA256.match(sha256):
+        return "Bad hash\n", 400
+    found = ImageIndex.find(sha256, USBStorage.lun_images())
+    if not found["staged"] and not found["image"]:
+        return "Unknown content\n", 404
+    return {"sha256": sha256, **found}
+
+
+@app.route("/hashes", methods=["POST"])
+def hash_query():
+    body = request.get_json(silent=True) or {}
+    hashes = body.get("sha256")
+    if not isinstance(hashes, list) or not all(isinstance(h, str) for h in hashes):
+        return "Bad request: expected {\"sha256\": [...]}\n", 400
+    images = USBStorage.lun_images()
+    known, unknown = [], []
+    for sha256 in hashes:
+        found = _SHA256.match(sha256.lower()) and ImageIndex.find(sha256.lower(), images)
+        if found and (found["staged"] or found["image"]):
+            known.append(sha256)
+        else:
+            unknown.append(sha256)
+    return {"known": known, "unknown": unknown}
+
+
+@app.route("/uploads/by-hash", methods=["POST"])
+def upload_by_hash():
+    """
+    Stage a file the server already has content for, without sending it.
+    """
+    body = request.get_json(silent=True) or {}
+    relpath = Staging.safe_relpath(body.get("name"))
+    sha256 = str(body.get("sha256", "")).lower()
+    if relpath is None or not _SHA256.match(sha256):
+        return "Bad upload: name and sha256 required\n", 400
+    source = ImageCommit.stage_existing(sha256, relpath)
+    if source is None:
+        return "Unknown content\n", 404
+    return {"name": relpath, "sha256": sha256, "source": source}, 201 if source != "present" else 200
+
+
+def _lun_image():
+    """
+    Returns the image behind the ?lun= of the request, or None.
+    """
+    images = USBStorage.lun_images()
+    try:
+        lun = int(request.args.get("lun", 0))
+    except ValueError:
+        return None
+    return images[lun] if 0 <= lun < len(images) else None
 
-    # swap media without touching serial
-    if USBGadget.is_initialized():
-        USBGadget.replace_mass_storage_image(config.DATA_IMAGE)
+
+@app.route("/files", methods=["GET"])
+def files():
+    """
+    List what is on the USB disk from the image manifest, without mounting
+    it. ?prefix= limits the listing to a directory, ?refresh=1 re-reads the
+    manifest from the image first (after the host wrote to it).
+    """
+    image = _lun_image()
+    if image is None:
+        return "Unknown LUN\n", 404
+    if request.args.get("refresh", "").lower() in ("1", "true", "yes"):
+        Jobs.submit("index", lambda: ImageCommit.refresh_index(image)).done.wait()
+    status = ImageIndex.status(image)
+    if status is None:
+        return "No manifest yet, commit or ?refresh=1 first\n", 404
+    return {"image": os.path.basename(image), **status,
+            "entries": ImageIndex.listing(image, request.args.get("prefix", ""))}
+
+
+@app.route("/files/<path:relpath>", methods=["GET", "HEAD"])
+def file_download(relpath):
+    """
+    Serve one file as the host sees it, straight from the image (?lun=),
+    without detaching it. Supports single byte Range requests; the ETag is
+    the file's SHA-256 when the manifest knows it.
+    """
+    image = _lun_image()
+    if image is None:
+        return "Unknown LUN\n", 404
+    found = ImageDownload.open(image, relpath)
+    if found is None:
+        return "Not found\n", 404
+
+    size = found["size"]
+    headers = {"Accept-Ranges": "bytes", "Last-Modified": http_date(found["mtime"])}
+    etag = found["sha256"]
+    if etag is not None:
+        headers["ETag"] = f'"{etag}"'
+        headers["Repr-Digest"] = f"sha-256=:{base64.b64encode(bytes.fromhex(etag)).decode()}:"
+    start, stop, code = 0, size, 200
+    # a Range only applies while If-Range (if sent) still matches
+    if_range = request.if_range
+    if if_range.etag is not None:
+        use_range = if_range.etag == etag
+    elif if_range.date is not None:
+        use_range = int(if_range.date.timestamp()) == int(found["mtime"])
     else:
-        USBGadget.init()
+        use_range = True
+    if request.range is not None and use_range:
+        span = request.range.range_for_length(size)
+        if span is None and len(request.range.ranges) == 1:
+            found["file"].close()
+            return "Range not satisfiable\n", 416, {"Content-Range": f"bytes */{size}"}
+        if span is not None:
+            # multiple ranges are answered with the whole file
+            start, stop, code = span[0], span[1], 206
+            headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    headers["Content-Length"] = str(stop - start)
+
+    resp = Response(ImageDownload.stream(found, start, stop, request.environ.get("werkzeug.socket")),
+                    code, headers, mimetype="application/octet-stream", direct_passthrough=True)
+    resp.call_on_close(found["file"].close)
+    return resp
 
-    return "OK\n"
+
+@app.route("/status", methods=["GET"])
+def status():
+    """
+    Space and content summary of every image, from the manifests.
+    """
+    images = [(lun, image) for lun, image in enumerate(USBStorage.lun_images())]
+    if config.IMAGE_MODE == "ab" and config.MASS_STORAGE_LUNS <= 1:
+        images.append((None, USBStorage.inactive_image()))
+    return {
+        "images": [{"image": os.path.basename(image), "lun": lun,
+                    "manifest": ImageIndex.status(image)} for lun, image in images],
+        "staging_free_bytes": Staging.free_space(),
+        "batches": Staging.pending(),
+        "gadget": {"initialized": USBGadget.is_initialized(), "udc_state": USBGadget.udc_state()},
+        "jobs": [job.to_dict() for job in Jobs.recent() if job.state in ("queued", "running")],
+    }
+
+
+def _job_response(job):
+    """
+    Return the job id right away, or block until the job is finished when
+    the client asks for ?wait=1 (or JOBS_ASYNC is off).
+    """
+    wait = request.args.get("wait")
+    if wait is None:
+        wait = not config.JOBS_ASYNC
+    else:
+        wait = wait.lower() in ("1", "true", "yes")
+    if wait:
+        job.done.wait()
+        if job.state == "failed":
+            return f"Failed: {job.error}\n", 500
+        return "OK\n"
+    return job.to_dict(), 202, {"Location": f"/jobs/{job.id}"}
+
+
+@app.route("/commit", methods=["POST"])
+def commit():
+    return _job_response(Jobs.submit("commit", ImageCommit.commit, coalesce=True))
+
+
+@app.route("/reload", methods=["POST"])
+def reload():
+    return _job_response(Jobs.submit("reload", ImageCommit.reload))
 
 
 @app.route("/clear", methods=["POST"])
 def clear():
-    # Detach media first if gadget is active
-    if USBGadget.is_initialized():
-        USBGadget.detach_mass_storage_media()
-        time.sleep(0.1)
+    return _job_response(Jobs.submit("clear", ImageCommit.clear, coalesce=True))
 
-    USBStorage.image_create()
-    USBStorage.mount()
-    try:
-        for name in os.listdir(config.DATA_DIR):
-            path = os.path.join(config.DATA_DIR, name)
-            try:
-                if os.path.islink(path) or os.path.isfile(path):
-                    os.remove(path)
-                elif os.path.isdir(path):
-                    shutil.rmtree(path)
-            except Exception:
-                pass
-    finally:
-        USBStorage.umount()
-        try:
-            os.sync()
-        except Exception:
-            try:
-                subprocess.run(["sync"], check=False)
-            except Exception:
-                pass
+
+@app.route("/jobs", methods=["GET"])
+def jobs():
+    return {"jobs": [job.to_dict() for job in Jobs.recent()]}
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = Jobs.get(job_id)
+    if job is None:
+        return "Unknown job\n", 404
+    return job.to_dict()
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
+def _image_free():
+    samples = [({"image": os.path.basename(image)}, USBStorage.image_free_bytes(image))
+               for image in USBStorage.lun_images()]
+    if config.IMAGE_MODE == "ab" and config.MASS_STORAGE_LUNS <= 1:
+        image = USBStorage.inactive_image()
+        samples.append(({"image": os.path.basename(image)}, USBStorage.image_free_bytes(image)))
+    return samples
+
+
+Metrics.gauge("receiveit_image_free_bytes", "Free space in the backing images.", _image_free)
+Metrics.gauge("receiveit_staging_free_bytes", "Free space for staged uploads.",
+              lambda: [({}, Staging.free_space())])
+
+
+@app.route("/debug/profile", methods=["GET", "POST"])
+def debug_profile():
+    """
+    POST {"requests": n, "memory": bool} profiles the next n
+    upload/publish/commit/clear operations (0 disarms); GET shows what is
+    armed and the profiles on disk.
+    """
+    if request.method == "POST":
+        body = request.get_json(silent=True) or {}
         try:
-            USBStorage.bump_fat_volume_metadata()
-        except Exception:
-            pass
+            count = int(body.get("requests", request.args.get("requests", 1)))
+        except (TypeError, ValueError):
+            return "Bad request: requests must be a number\n", 400
+        memory = body.get("memory", request.args.get("memory", "")) in (True, "1", "true", "yes")
+        Profiler.arm(count, memory)
+    return Profiler.status()
 
-    # reattach media without touching serial
-    if USBGadget.is_initialized():
-        USBGadget.replace_mass_storage_image(config.DATA_IMAGE)
-    else:
-        USBGadget.init()
 
-    return "OK\n"
+@app.route("/debug/trace", methods=["GET"])
+def debug_trace():
+    """
+    The most recent subprocess, loop/mount and configfs spans (?limit=).
+    """
+    try:
+        limit = int(request.args.get("limit", 0))
+    except ValueError:
+        return "Bad request: limit must be a number\n", 400
+    return {"spans": Profiler.trace(limit)}
 
 
 @app.route("/", methods=["GET"])
@@ -143,20 +448,42 @@ def index():
     return "Upload Server is running.\n"
 
 
-if __name__ == "__main__":
-    time.sleep(3)
-    USBStorage.image_create()
+def startup():
+    """
+    Bring up storage and the gadget while HTTP is already being served:
+    the image check runs on the job worker, then the gadget is created as
+    soon as a UDC shows up (uevent driven, no fixed sleep).
+    """
+    Jobs.submit("image_create", USBStorage.images_create).done.wait()
 
     # try to initialize gadget early if configfs & UDC available. Non-fatal.
     try:
-        if USBGadget.is_ready() and not USBGadget.is_initialized():
-            try:
-                USBGadget.init()
-                print("USBGadget initialized at startup")
-            except Exception as e:
-                print("USBGadget init failed at startup:", e)
+        if not USBGadget.wait_for_udc(config.UDC_WAIT_TIMEOUT):
+            print("USBGadget: no UDC appeared, gadget will be created on first commit")
+            return
     except Exception:
         # ignore readiness checks failing on platforms without configfs
-        pass
+        return
 
-    app.run(host="0.0.0.0", port=80)
+    def init_gadget():
+        if USBGadget.is_initialized():
+            return
+        try:
+            USBGadget.init()
+            print("USBGadget initialized at startup")
+            Server.notify("STATUS=USB gadget initialized")
+        except Exception as e:
+            print("USBGadget init failed at startup:", e)
+
+    Jobs.submit("gadget_init", init_gadget)
+
+
+if __name__ == "__main__":
+    # `kill -USR2` arms the profiler without HTTP access; arm() takes a lock
+    # the interrupted main thread might hold, so hand it to a thread
+    signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(
+        target=Profiler.arm, args=(config.PROFILE_SIGNAL_REQUESTS,), daemon=True).start())
+    # before any upload can open a batch of its own
+    Staging.seal_orphans()
+    threading.Thread(target=startup, name="startup", daemon=True).start()
+    Server.serve(app)